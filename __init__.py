@@ -0,0 +1,2 @@
+__version__ = '3.1-dev'
+real_version = '3.1-dev'
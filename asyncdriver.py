@@ -0,0 +1,150 @@
+"""
+Socket handling driver using asyncio. This is enabled by setting "socket_driver: asyncio" in the
+pylink: configuration block, and runs the connect, read, send queue, ping, and autoconnect
+routines of every network on one event loop thread (instead of the selector driver loop plus a
+set of threads per network).
+"""
+
+import asyncio
+import threading
+
+from pylinkirc import world
+from pylinkirc.log import log
+
+__all__ = ['register', 'unregister', 'start', 'call_in_loop', 'call_later', 'run_coroutine',
+           'wait_for_fd']
+
+
+# How often (in seconds) the event loop checks whether PyLink is shutting down.
+SHUTDOWN_CHECK_INTERVAL = 0.5
+
+loop = asyncio.new_event_loop()
+_loop_thread = None
+
+def _in_loop_thread():
+    """Returns whether the caller is running in the event loop thread."""
+    return _loop_thread is not None and threading.current_thread() is _loop_thread
+
+def call_in_loop(func, *args):
+    """
+    Runs func(*args) on the event loop: immediately if we're already in its thread, or on the
+    next loop iteration otherwise. This is safe to call from any thread.
+    """
+    if _in_loop_thread():
+        func(*args)
+    else:
+        loop.call_soon_threadsafe(func, *args)
+
+def _run_irc(irc):
+    """Reader callback for network sockets."""
+    try:
+        if not irc._aborted.is_set():
+            irc._run_irc()
+    except:
+        log.exception('Error in asyncio driver loop:')
+
+def register(irc):
+    """
+    Registers a network's socket on the event loop.
+    """
+    log.debug('asyncdriver: registering %s for network %s', irc._socket, irc.name)
+    call_in_loop(loop.add_reader, irc._socket.fileno(), _run_irc, irc)
+
+def unregister(irc):
+    """
+    Removes a network's socket from the event loop.
+    """
+    fd = irc._socket.fileno()
+    if fd != -1:
+        log.debug('asyncdriver: de-registering %s for network %s', irc._socket, irc.name)
+        call_in_loop(loop.remove_reader, fd)
+    else:
+        log.debug('asyncdriver: skipping de-registering %s for network %s', irc._socket, irc.name)
+
+class _Timer():
+    """
+    Thread-safe event loop timer, mirroring the parts of the threading.Timer API that IRCNetwork uses.
+    """
+    def __init__(self, delay, func, name=None):
+        self.name = name
+        self._func = func
+        self._handle = None
+        self._cancelled = False
+        call_in_loop(self._schedule, delay)
+
+    def _schedule(self, delay):
+        if not self._cancelled:
+            self._handle = loop.call_later(delay, self._run)
+
+    def _run(self):
+        try:
+            self._func()
+        except:
+            log.exception('asyncdriver: error in timer callback %s:', self.name or self._func)
+
+    def _cancel(self):
+        if self._handle is not None:
+            self._handle.cancel()
+
+    def cancel(self):
+        """Cancels the timer if it hasn't fired yet."""
+        self._cancelled = True
+        call_in_loop(self._cancel)
+
+def call_later(delay, func, name=None):
+    """
+    Schedules func() to be called on the event loop after the given delay (in seconds). This
+    returns a timer object with a cancel() method.
+    """
+    return _Timer(delay, func, name=name)
+
+def run_coroutine(coro):
+    """
+    Schedules a coroutine to run on the event loop and returns a concurrent.futures.Future
+    for its result. This is safe to call from any thread.
+    """
+    return asyncio.run_coroutine_threadsafe(coro, loop)
+
+async def wait_for_fd(fd, write=False):
+    """
+    Waits until the given file descriptor is readable (or writable, if write is True).
+    """
+    future = loop.create_future()
+    if write:
+        add, remove = loop.add_writer, loop.remove_writer
+    else:
+        add, remove = loop.add_reader, loop.remove_reader
+
+    def _done():
+        if not future.done():
+            future.set_result(None)
+
+    add(fd, _done)
+    try:
+        await future
+    finally:
+        remove(fd)
+
+def _check_shutdown():
+    """Stops the event loop once PyLink is shutting down."""
+    if world.shutting_down.is_set():
+        loop.stop()
+    else:
+        loop.call_later(SHUTDOWN_CHECK_INTERVAL, _check_shutdown)
+
+def _process_conns():
+    """Main loop which runs the asyncio event loop."""
+    asyncio.set_event_loop(loop)
+    loop.call_soon(_check_shutdown)
+    try:
+        loop.run_forever()
+    finally:
+        log.debug('asyncdriver: event loop stopped')
+
+def start():
+    """
+    Starts a thread to run the event loop.
+    """
+    global _loop_thread
+    _loop_thread = t = threading.Thread(target=_process_conns, name="Asyncio driver loop")
+    t.start()
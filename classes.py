@@ -7,22 +7,25 @@ connections and objects used to represent IRC servers, users, and channels.
 Here be dragons.
 """
 
+import asyncio
 import collections
 import collections.abc
-import functools
 import hashlib
 import ipaddress
 import queue
 import re
+import select
 import socket
 import ssl
 import string
 import textwrap
 import threading
 import time
+import types
+import weakref
 
-from . import __version__, conf, selectdriver, structures, utils, world
-from .log import log, PyLinkChannelLogger
+from . import __version__, asyncdriver, conf, selectdriver, structures, utils, world
+from .log import log, debug_enabled, PyLinkChannelLogger
 from .utils import ProtocolError  # Compatibility with PyLink 1.x
 
 __all__ = ['ChannelState', 'User', 'UserMapping', 'PyLinkNetworkCore',
@@ -31,6 +34,20 @@ __all__ = ['ChannelState', 'User', 'UserMapping', 'PyLinkNetworkCore',
 
 QUEUE_FULL = queue.Full
 
+# Lanes of the outgoing queue, from highest to lowest priority. Lines in the keepalive lane are
+# never held back by flow control. All other lines are queued in the normal lane, in order; bulk
+# lines (PRIVMSG/NOTICE) are only moved to the bulk lane while flow control holds them back.
+SENDQ_LANE_KEEPALIVE = 0
+SENDQ_LANE_NORMAL = 1
+SENDQ_LANE_BULK = 2
+
+# Maps pylink::socket_driver values to the socket driver modules implementing them.
+SOCKET_DRIVERS = {'select': selectdriver, 'asyncio': asyncdriver}
+
+def _get_socket_driver():
+    """Returns the socket driver module in use, as chosen by world.socket_driver."""
+    return SOCKET_DRIVERS[world.socket_driver]
+
 
 ### Internal classes (users, servers, channels)
 
@@ -50,6 +67,8 @@ class ChannelState(structures.IRCCaseInsensitiveDict):
 
 class TSObject():
     """Base class for classes containing a type-normalized timestamp."""
+    __slots__ = ('_ts',)
+
     def __init__(self, *args, **kwargs):
         self._ts = int(time.time())
 
@@ -67,6 +86,16 @@ class TSObject():
 
 class User(TSObject):
     """PyLink IRC user class."""
+    # Plugins may still set their own attributes on users; these are stored in __dict__, which is
+    # only created when needed.
+    __slots__ = ('_nick', 'lower_nick', 'uid', '_ident', '_host', '_realhost', '_ip', 'realname',
+                 'modes', 'server', '_irc', 'account', 'opertype', 'services_account', '_channels',
+                 'away', 'manipulatable', 'cloaked_host', 'service', '__dict__', '__weakref__')
+
+    # Shared mode set for users without any modes. apply_modes() replaces mode sets instead of
+    # changing them in place, so this is never modified.
+    EMPTY_MODES = frozenset()
+
     def __init__(self, irc, nick, ts, uid, server, ident='null', host='null',
                  realname='PyLink dummy client', realhost='null',
                  ip='0.0.0.0', manipulatable=False, opertype='IRC Operator'):
@@ -76,12 +105,13 @@ class User(TSObject):
 
         self.ts = ts
         self.uid = uid
-        self.ident = ident
-        self.host = host
-        self.realhost = realhost
-        self.ip = ip
+        # These are properties updating the irc.users search index, which doesn't include us yet.
+        self._ident = ident
+        self._host = host
+        self._realhost = realhost
+        self._ip = ip
         self.realname = realname
-        self.modes = set()  # Tracks user modes
+        self.modes = self.EMPTY_MODES  # Tracks user modes
         self.server = server
         self._irc = irc
 
@@ -94,8 +124,8 @@ class User(TSObject):
         # Tracks external services identification status
         self.services_account = ''
 
-        # Tracks channels the user is in
-        self.channels = structures.IRCCaseInsensitiveSet(self._irc)
+        # Tracks channels the user is in; this is created on first use.
+        self._channels = None
 
         # Tracks away message status
         self.away = ''
@@ -133,16 +163,64 @@ class User(TSObject):
 
         # Update the new nick.
         self._irc.users.bynick.setdefault(self.lower_nick, []).append(self.uid)
+        self._irc.users.update_index(self)
+
+    @property
+    def ident(self):
+        return self._ident
+
+    @ident.setter
+    def ident(self, ident):
+        self._ident = ident
+        self._irc.users.update_index(self)
+
+    @property
+    def host(self):
+        return self._host
+
+    @host.setter
+    def host(self, host):
+        self._host = host
+        self._irc.users.update_index(self)
+
+    @property
+    def realhost(self):
+        return self._realhost
+
+    @realhost.setter
+    def realhost(self, realhost):
+        self._realhost = realhost
+        self._irc.users.update_index(self)
+
+    @property
+    def ip(self):
+        return self._ip
+
+    @ip.setter
+    def ip(self, ip):
+        self._ip = ip
+        self._irc.users.update_index(self)
+
+    @property
+    def channels(self):
+        if self._channels is None:
+            self._channels = structures.IRCCaseInsensitiveSet(self._irc)
+        return self._channels
+
+    @channels.setter
+    def channels(self, value):
+        self._channels = value
 
     def get_fields(self):
         """
         Returns all template/substitution-friendly fields for the User object in a read-only dictionary.
         """
-        fields = self.__dict__.copy()
+        fields = {attr: getattr(self, attr) for attr in self._get_slot_fields() if hasattr(self, attr)}
+        fields.update(self.__dict__)
 
         # These don't really make sense in text substitutions
-        for field in ('manipulatable', '_irc', 'channels', 'modes'):
-            del fields[field]
+        for field in ('manipulatable', '_irc', '_channels', 'modes'):
+            fields.pop(field, None)
 
         # Swap SID and server name for convenience
         fields['sid'] = self.server
@@ -154,9 +232,27 @@ class User(TSObject):
         # Network name
         fields['netname'] = self._irc.name
 
-        # Add the nick attribute; this isn't in __dict__ because it's a property
+        # Add the nick, ident, and host attributes; these aren't slots because they're properties
         fields['nick'] = self._nick
+        for attr in ('ident', 'host', 'realhost', 'ip'):
+            fields[attr] = fields.pop('_' + attr)
+
+        return fields
 
+    @classmethod
+    def _get_slot_fields(cls):
+        """Returns the names of all slot attributes of this class, in definition order."""
+        # This is cached on each class separately, since subclasses (e.g. relay clients) can add slots.
+        try:
+            return cls.__dict__['_fields']
+        except KeyError:
+            pass
+        fields = []
+        for klass in reversed(cls.__mro__):
+            for attr in klass.__dict__.get('__slots__', ()):
+                if attr not in ('__dict__', '__weakref__') and attr not in fields:
+                    fields.append(attr)
+        cls._fields = fields = tuple(fields)
         return fields
 
     def __repr__(self):
@@ -177,6 +273,21 @@ class UserMapping(collections.abc.MutableMapping, structures.CopyWrapper):
             self._data = {}
         self.bynick = collections.defaultdict(list)
         self._irc = irc
+        # Search index for match_all(); this is created on first use.
+        self._index = None
+
+    @property
+    def index(self):
+        """Returns the UserIndex for this mapping, creating it if needed."""
+        index = self._index
+        if index is None or index.casemapping != self._irc.casemapping:
+            index = self._index = UserIndex(self._irc, self._data.values())
+        return index
+
+    def update_index(self, userobj):
+        """Updates the search index after changing the given User object's nick or host."""
+        if self._index is not None and self._data.get(userobj.uid) is userobj:
+            self._index.add(userobj)
 
     def __getitem__(self, key):
         return self._data[key]
@@ -189,6 +300,8 @@ class UserMapping(collections.abc.MutableMapping, structures.CopyWrapper):
 
         self._data[key] = userobj
         self.bynick.setdefault(userobj.lower_nick, []).append(key)
+        if self._index is not None:
+            self._index.add(userobj)
 
     def __delitem__(self, key):
         # Remove this entry from the bynick index
@@ -198,6 +311,8 @@ class UserMapping(collections.abc.MutableMapping, structures.CopyWrapper):
             if not self.bynick[self[key].lower_nick]:
                 del self.bynick[self[key].lower_nick]
 
+        if self._index is not None:
+            self._index.discard(key)
         del self._data[key]
 
     # Generic container methods. XXX: consider abstracting this out in structures?
@@ -216,6 +331,141 @@ class UserMapping(collections.abc.MutableMapping, structures.CopyWrapper):
     def __copy__(self):
         return self.__class__(self._irc, data=self._data.copy())
 
+class UserIndex():
+    """
+    Search index of a network's users by nick, ident, host and IP address. This is used by
+    match_all() to find the users a hostmask could match without checking every user.
+
+    Hosts, real hosts, and IPs are indexed both as is and reversed, so that masks with a literal
+    host prefix (*!*@1.2.3.*) or suffix (*!*@*.example.com) can be looked up. IP addresses are also
+    stored in a radix tree, so that CIDR masks can find all users in their range.
+    """
+    def __init__(self, irc, users=()):
+        self._irc = irc
+        self.casemapping = irc.casemapping
+        self.nicks = structures.PrefixIndex()
+        self.idents = structures.PrefixIndex()
+        self.hosts = structures.PrefixIndex()
+        self.reversed_hosts = structures.PrefixIndex()
+        self.ips = structures.IPRadixTree()
+
+        # Users with "!" or "@" in their nick, ident, or hosts can't be split into these parts
+        # reliably, so they are returned by every search.
+        self.unindexed = set()
+
+        # Maps UIDs to the keys they are indexed under, so that they can be removed after their
+        # nick or host has already changed.
+        self._keys = {}
+
+        for userobj in users:
+            self.add(userobj)
+
+    def add(self, userobj):
+        """Adds the given User object to the index, replacing any older entry for it."""
+        uid = userobj.uid
+        self.discard(uid)
+
+        fold = self._irc.to_lower
+        nick = fold(str(userobj.nick))
+        ident = fold(str(userobj.ident))
+        hosts = {fold(str(host)) for host in (userobj.host, userobj.realhost, userobj.ip)}
+
+        if any('!' in text or '@' in text for text in (nick, ident, *hosts)):
+            self.unindexed.add(uid)
+            self._keys[uid] = None
+            return
+
+        ip = userobj.ip
+        try:
+            self.ips.add(ip, uid)
+        except (TypeError, ValueError):
+            ip = None
+
+        self.nicks.add(nick, uid)
+        self.idents.add(ident, uid)
+        for host in hosts:
+            self.hosts.add(host, uid)
+            self.reversed_hosts.add(host[::-1], uid)
+        self._keys[uid] = (nick, ident, hosts, ip)
+
+    def discard(self, uid):
+        """Removes the given UID from the index, if present."""
+        try:
+            keys = self._keys.pop(uid)
+        except KeyError:
+            return
+
+        if keys is None:
+            self.unindexed.discard(uid)
+            return
+
+        nick, ident, hosts, ip = keys
+        self.nicks.discard(nick, uid)
+        self.idents.discard(ident, uid)
+        for host in hosts:
+            self.hosts.discard(host, uid)
+            self.reversed_hosts.discard(host[::-1], uid)
+        if ip is not None:
+            self.ips.discard(ip, uid)
+
+    @staticmethod
+    def _get_lookup(index, glob, reverse_index=None):
+        """
+        Returns a (size estimate, lookup function) pair for the given nick, ident, or host glob,
+        or None if the glob has no literal prefix (or suffix, if reverse_index is given).
+        """
+        wildcards = [pos for pos, char in enumerate(glob) if char in '*?']
+        if not wildcards:
+            return (len(index.get(glob)), lambda: index.get(glob))
+
+        prefix = glob[:wildcards[0]]
+        suffix = glob[wildcards[-1]+1:][::-1]
+        if reverse_index is not None and len(suffix) > len(prefix):
+            return (reverse_index.count_prefix(suffix), lambda: reverse_index.find_prefix(suffix))
+        elif prefix:
+            return (index.count_prefix(prefix), lambda: index.find_prefix(prefix))
+        return None
+
+    def find(self, mask):
+        """
+        Returns a set of UIDs that the given utils.CompiledMask can match. This is a superset of
+        the actual matches, which still need to be checked. If the mask can't be looked up in the
+        index (e.g. exttargets and inverted masks), None is returned instead.
+        """
+        if mask.invert or mask.exttarget_name is not None:
+            return None
+        elif type(self._irc).get_hostmask is not PyLinkNetworkCoreWithUtils.get_hostmask:
+            # This index only works with nick!user@host style hostmasks.
+            return None
+
+        try:
+            nickglob, identhost = mask.glob.split('!', 1)
+            identglob, hostglob = identhost.split('@', 1)
+        except ValueError:
+            return None
+        if '!' in identhost or '@' in hostglob:
+            return None
+
+        lookups = [self._get_lookup(self.nicks, nickglob), self._get_lookup(self.idents, identglob)]
+
+        hostlookup = self._get_lookup(self.hosts, hostglob, reverse_index=self.reversed_hosts)
+        if hostlookup and mask.cidr is not None:
+            # The host part can match either as text, or as a CIDR range containing the user's IP.
+            hostsize, hostfunc = hostlookup
+            hostlookup = (hostsize + self.ips.count_within(mask.cidr),
+                          lambda: hostfunc() | self.ips.within(mask.cidr))
+        lookups.append(hostlookup)
+
+        lookups = [lookup for lookup in lookups if lookup]
+        if not lookups:
+            return None
+
+        # Use the most specific lookup, unless it would return most users anyway.
+        size, func = min(lookups, key=lambda lookup: lookup[0])
+        if size > len(self._keys) // 2:
+            return None
+        return func() | self.unindexed
+
 class PyLinkNetworkCore(structures.CamelCaseToSnakeCase):
     """Base IRC object for PyLink."""
 
@@ -223,6 +473,12 @@ class PyLinkNetworkCore(structures.CamelCaseToSnakeCase):
 
         self.loghandlers = []
         self.name = netname
+        # Per-network casefolder used by to_lower(). This must exist before the casemapping is set.
+        # to_lower() is called very often, so it is bound to the casefolder directly, unless a
+        # protocol module overrides it.
+        self._casefolder = structures.IRCCasefolder()
+        if getattr(type(self), 'to_lower', None) in (None, PyLinkNetworkCoreWithUtils.to_lower):
+            self.to_lower = self._casefolder.fold
         self.conf = conf.conf
         if not hasattr(self, 'sid'):
             self.sid = None
@@ -258,6 +514,14 @@ class PyLinkNetworkCore(structures.CamelCaseToSnakeCase):
 
         self._init_vars()
 
+    @property
+    def casemapping(self):
+        return self._casefolder.casemapping
+
+    @casemapping.setter
+    def casemapping(self, casemapping):
+        self._casefolder.set_casemapping(casemapping)
+
     def log_setup(self):
         """
         Initializes any channel loggers defined for the current network.
@@ -384,36 +648,39 @@ class PyLinkNetworkCore(structures.CamelCaseToSnakeCase):
         # Always make sure TS is sent.
         if 'ts' not in parsed_args:
             parsed_args['ts'] = int(time.time())
-        hook_cmd = command
-        hook_map = self.hook_map
 
-        # If the hook name is present in the protocol module's hook_map, then we
-        # should set the hook name to the name that points to instead.
+        # Individual handlers can return a 'parse_as' key to send their payload
+        # to a different hook. An example of this is "/join 0" being interpreted
+        # as leaving all channels (PART).
+        # Otherwise, if the hook name is present in the protocol module's hook_map,
+        # then we should set the hook name to the name that points to instead.
         # For example, plugins will read SETHOST as CHGHOST, EOS (end of sync)
         # as ENDBURST, etc.
-        if command in hook_map:
-            hook_cmd = hook_map[command]
+        hook_cmd = parsed_args.get('parse_as') or self.hook_map.get(command, command)
 
-        # However, individual handlers can also return a 'parse_as' key to send
-        # their payload to a different hook. An example of this is "/join 0"
-        # being interpreted as leaving all channels (PART).
-        hook_cmd = parsed_args.get('parse_as') or hook_cmd
+        debug = debug_enabled()
+        if debug:
+            log.debug('(%s) Raw hook data: [%r, %r, %r] received from %s handler '
+                      '(calling hook %s)', self.name, numeric, hook_cmd, parsed_args,
+                      command, hook_cmd)
 
-        log.debug('(%s) Raw hook data: [%r, %r, %r] received from %s handler '
-                  '(calling hook %s)', self.name, numeric, hook_cmd, parsed_args,
-                  command, hook_cmd)
+        profile = conf.conf['pylink'].get('hook_profiling')
 
-        # Iterate over registered hook functions, catching errors accordingly.
-        for hook_pair in world.hooks[hook_cmd].copy():
-            hook_func = hook_pair[1]
+        # Iterate over registered hook functions, catching errors accordingly. The dispatch
+        # table holds immutable tuples, so this is safe even if hooks are changed mid-loop.
+        for hook_func in world._hook_dispatch.get(hook_cmd, ()):
+            if profile:
+                started = time.perf_counter()
             try:
-                log.debug('(%s) Calling hook function %s from plugin "%s"', self.name,
-                          hook_func, hook_func.__module__)
+                if debug:
+                    log.debug('(%s) Calling hook function %s from plugin "%s"', self.name,
+                              hook_func, hook_func.__module__)
                 retcode = hook_func(self, numeric, command, parsed_args)
 
                 if retcode is False:
-                    log.debug('(%s) Stopping hook loop for %r (command=%r)', self.name,
-                              hook_func, command)
+                    if debug:
+                        log.debug('(%s) Stopping hook loop for %r (command=%r)', self.name,
+                                  hook_func, command)
                     break
 
             except Exception:
@@ -423,6 +690,11 @@ class PyLinkNetworkCore(structures.CamelCaseToSnakeCase):
                 log.error('(%s) The offending hook data was: %s', self.name,
                           hook_args)
                 continue
+            finally:
+                if profile:
+                    utils._record_timing(world.hook_stats,
+                                         (hook_func.__module__, hook_func.__name__, hook_cmd),
+                                         time.perf_counter() - started, self)
 
     def call_command(self, source, text):
         """
@@ -584,20 +856,18 @@ class PyLinkNetworkCore(structures.CamelCaseToSnakeCase):
             log.error("(%s) Configuration error: %s", self.name, e)
             raise
 
-    def _run_autoconnect(self):
-        """Blocks for the autoconnect time and returns True if autoconnect is enabled."""
+    def _get_autoconnect_delay(self):
+        """
+        Returns the delay (in seconds) before the next autoconnect attempt, or None if
+        autoconnect is disabled.
+        """
         if world.shutting_down.is_set():
             log.debug('(%s) _run_autoconnect: aborting autoconnect attempt since we are shutting down.', self.name)
             return
 
         autoconnect = self.serverdata.get('autoconnect')
-
-        # Sets the autoconnect growth multiplier (e.g. a value of 2 multiplies the autoconnect
-        # time by 2 on every failure, etc.)
-        autoconnect_multiplier = self.serverdata.get('autoconnect_multiplier', 2)
         autoconnect_max = self.serverdata.get('autoconnect_max', 1800)
-        # These values must at least be 1.
-        autoconnect_multiplier = max(autoconnect_multiplier, 1)
+        # This value must at least be 1.
         autoconnect_max = max(autoconnect_max, 1)
 
         log.debug('(%s) _run_autoconnect: Autoconnect delay set to %s seconds.', self.name, autoconnect)
@@ -608,23 +878,41 @@ class PyLinkNetworkCore(structures.CamelCaseToSnakeCase):
             autoconnect = min(autoconnect, autoconnect_max)
 
             log.info('(%s) _run_autoconnect: Going to auto-reconnect in %s seconds.', self.name, autoconnect)
-            # Continue when either self._aborted is set or the autoconnect time passes.
-            # Compared to time.sleep(), this allows us to stop connections quicker if we
-            # break while while for autoconnect.
-            self._aborted.clear()
-            self._aborted.wait(autoconnect)
+            return autoconnect
+        else:
+            log.debug('(%s) _run_autoconnect: Stopping connect loop (autoconnect value %r is < 1).', self.name, autoconnect)
+            return
 
-            # Store in the local state what the autoconnect multiplier currently is.
-            self.autoconnect_active_multiplier *= autoconnect_multiplier
+    def _finish_autoconnect_delay(self):
+        """
+        Updates the autoconnect multiplier once an autoconnect delay has passed, and returns True
+        if the network should still be reconnected.
+        """
+        # Sets the autoconnect growth multiplier (e.g. a value of 2 multiplies the autoconnect
+        # time by 2 on every failure, etc.). This value must at least be 1.
+        autoconnect_multiplier = max(self.serverdata.get('autoconnect_multiplier', 2), 1)
 
-            if self not in world.networkobjects.values():
-                log.debug('(%s) _run_autoconnect: Stopping stale connect loop', self.name)
-                return
-            return True
+        # Store in the local state what the autoconnect multiplier currently is.
+        self.autoconnect_active_multiplier *= autoconnect_multiplier
 
-        else:
-            log.debug('(%s) _run_autoconnect: Stopping connect loop (autoconnect value %r is < 1).', self.name, autoconnect)
+        if self not in world.networkobjects.values():
+            log.debug('(%s) _run_autoconnect: Stopping stale connect loop', self.name)
             return
+        return True
+
+    def _run_autoconnect(self):
+        """Blocks for the autoconnect time and returns True if autoconnect is enabled."""
+        autoconnect = self._get_autoconnect_delay()
+        if autoconnect is None:
+            return
+
+        # Continue when either self._aborted is set or the autoconnect time passes.
+        # Compared to time.sleep(), this allows us to stop connections quicker if we
+        # break while while for autoconnect.
+        self._aborted.clear()
+        self._aborted.wait(autoconnect)
+
+        return self._finish_autoconnect_delay()
 
     def _pre_disconnect(self):
         """
@@ -648,8 +936,9 @@ class PyLinkNetworkCore(structures.CamelCaseToSnakeCase):
         # Internal hook signifying that a network has disconnected.
         self.call_hooks([None, 'PYLINK_DISCONNECT', {'was_successful': self.was_successful}])
 
-        # Clear the to_lower cache.
-        self.to_lower.cache_clear()
+        # Clear this network's to_lower cache.
+        log.debug('(%s) Casefolding cache stats: %s', self.name, self._casefolder.get_stats())
+        self._casefolder.clear()
 
     def _remove_client(self, numeric):
         """
@@ -747,28 +1036,22 @@ class PyLinkNetworkCore(structures.CamelCaseToSnakeCase):
 structures._BLACKLISTED_COPY_TYPES.append(PyLinkNetworkCore)
 
 class PyLinkNetworkCoreWithUtils(PyLinkNetworkCore):
+    # Maximum amount of compiled masks cached by compile_mask().
+    MASK_CACHE_SIZE = 16384
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # Lock for updateTS to make sure only one thread can change the channel TS at one time.
         self._ts_lock = threading.Lock()
+        self._mask_cache = collections.OrderedDict()
 
-    @functools.lru_cache(maxsize=8192)
     def to_lower(self, text):
         """
         Returns the lowercase representation of text. This respects IRC casemappings defined by the protocol module.
+
+        Unless it is overridden, this is replaced with the network's casefolder on each instance.
         """
-        if (not text) or (not isinstance(text, str)):
-            return text
-        if self.casemapping == 'rfc1459':
-            text = text.replace('{', '[')
-            text = text.replace('}', ']')
-            text = text.replace('|', '\\')
-            text = text.replace('~', '^')
-        # Encode the text as bytes first, and then lowercase it so that only ASCII characters are
-        # changed. Unicode in channel names, etc. *is* case sensitive!
-        # Interesting, a quick emperical test found that this method is actually faster than str.translate()?!
-        return text.encode().lower().decode()
+        return self._casefolder.fold(text)
 
     _NICK_REGEX = r'^[A-Za-z\|\\_\[\]\{\}\^\`][A-Z0-9a-z\-\|\\_\[\]\{\}\^\`]*$'
     @classmethod
@@ -932,14 +1215,32 @@ class PyLinkNetworkCoreWithUtils(PyLinkNetworkCore):
         modestring = args[0]
         args = args[1:]
 
-        existing = set(existing)
-        existing_casemap = {}
-        for modepair in existing:
-            arg = modepair[1]
-            if arg is not None:
-                existing_casemap[(modepair[0], self.to_lower(arg))] = modepair
+        if not isinstance(existing, structures.IRCModeStore):
+            existing = structures.IRCModeStore(self, existing)
+        list_modes = supported_modes['*A']
+        # Modes parsed earlier in this query are tentatively applied here instead of on "existing",
+        # so that queries like +b-b *!*@example.com *!*@example.com behave correctly (we can't rely
+        # on the original mode list to check whether a mode currently exists):
+        # (mode char, case folded argument) -> mode pair (or None if removed) for list modes, and
+        # mode char -> mode pair (or None) for other modes.
+        pending_lists = {}
+        pending_modes = {}
+
+        def _find_existing(mode, arg):
+            """Returns the mode pair currently set for a list mode or a mode with parameters."""
+            if mode in list_modes:
+                key = (mode, self.to_lower(arg))
+                if key in pending_lists:
+                    return pending_lists[key]
+                return existing.find(mode, arg)
+            if mode in pending_modes:
+                modepair = pending_modes[mode]
             else:
-                existing_casemap[modepair] = modepair
+                args = existing.get_args(mode)
+                modepair = (mode, args[0]) if args else None
+            if arg is None or modepair is None or self.to_lower(modepair[1]) == self.to_lower(arg):
+                return modepair
+            return None
 
         res = []
         for mode in modestring:
@@ -973,17 +1274,16 @@ class PyLinkNetworkCoreWithUtils(PyLinkNetworkCore):
                                 # as a single "*".
                                 # We'd need to know the real argument of +k for us to
                                 # be able to unset the mode.
-                                oldarg = dict(existing).get(mode)
+                                oldarg = (_find_existing(mode, None) or (None, None))[1]
                                 if oldarg:
                                     # Set the arg to the old one on the channel.
                                     arg = oldarg
                                     self._log_debug_modes("Mode %s: coersing argument of '*' to %r.", mode, arg)
 
-                            self._log_debug_modes('(%s) parse_modes: checking if +%s %s is in old modes list: %s; existing_casemap=%s', self.name, mode, arg, existing, existing_casemap)
+                            self._log_debug_modes('(%s) parse_modes: checking if +%s %s is in old modes list: %s', self.name, mode, arg, existing)
 
-                            arg = self.to_lower(arg)
-                            casefolded_modepair = existing_casemap.get((mode, arg))  # Case fold arguments as needed
-                            if casefolded_modepair not in existing:
+                            casefolded_modepair = _find_existing(mode, arg)  # Case fold arguments as needed
+                            if casefolded_modepair is None:
                                 # Ignore attempts to unset parameter modes that don't exist.
                                 self._log_debug_modes("(%s) parse_modes: ignoring removal of non-existent list mode +%s %s; casefolded_modepair=%s", self.name, mode, arg, casefolded_modepair)
                                 continue
@@ -1002,16 +1302,13 @@ class PyLinkNetworkCoreWithUtils(PyLinkNetworkCore):
                 newmode = (prefix + mode, arg)
                 res.append(newmode)
 
-                # Tentatively apply the new mode to the "existing" mode list. This is so queries
-                # like +b-b *!*@example.com *!*@example.com behave correctly
-                # (we can't rely on the original mode list to check whether a mode currently exists)
-                existing = self._apply_modes(existing, [newmode], is_channel=is_channel)
-
-                lowered_mode = (newmode[0][-1], self.to_lower(newmode[1]) if newmode[1] else newmode[1])
-                if prefix == '+' and lowered_mode not in existing_casemap:
-                    existing_casemap[lowered_mode] = (mode, arg)
-                elif prefix == '-' and lowered_mode in existing_casemap:
-                    del existing_casemap[lowered_mode]
+                # Tentatively apply the new mode (prefix modes aren't part of channel mode lists).
+                if is_channel and mode in self.prefixmodes:
+                    continue
+                if mode in list_modes:
+                    pending_lists[(mode, self.to_lower(arg))] = (mode, arg) if prefix == '+' else None
+                else:
+                    pending_modes[mode] = (mode, arg) if prefix == '+' else None
         return res
 
     def parse_modes(self, target, args, ignore_missing_args=False):
@@ -1039,8 +1336,9 @@ class PyLinkNetworkCoreWithUtils(PyLinkNetworkCore):
             self._log_debug_modes('(%s) Using self.cmodes for this query: %s', self.name, self.cmodes)
 
             supported_modes = self.cmodes
-            oldmodes = self._channels[target].modes
-            prefixmodes = self._channels[target].prefixmodes
+            # This only reads the channel's modes, so there's no need to unshare them from snapshots.
+            oldmodes = self._channels[target]._modes
+            prefixmodes = self._channels[target]._get_prefixmodes()
 
         return self._parse_modes(args, oldmodes, supported_modes, is_channel=is_channel,
                                  prefixmodes=prefixmodes, ignore_missing_args=ignore_missing_args)
@@ -1049,17 +1347,28 @@ class PyLinkNetworkCoreWithUtils(PyLinkNetworkCore):
                      prefixmodes=None):
         """
         Takes a list of parsed IRC modes, and applies them onto the given target mode list.
+
+        IRCModeStore mode lists are changed in place and returned; other mode lists are copied
+        into a new IRCModeStore first.
         """
-        modelist = set(old_modelist)
-        mapping = collections.defaultdict(set)
+        if isinstance(old_modelist, structures.IRCModeStore):
+            modelist = old_modelist
+        else:
+            modelist = structures.IRCModeStore(self, old_modelist)
 
         if is_channel:
             supported_modes = self.cmodes
         else:
             supported_modes = self.umodes
+        list_modes = supported_modes['*A']
+        param_modes = list_modes + supported_modes['*B']
 
-        for modepair in modelist:  # Make a mapping of mode chars to values
-            mapping[modepair[0]].add(modepair[1])
+        # Map prefix mode chars to the corresponding prefix mode lists (e.g. c.prefixmodes['op']
+        # for ops). We only handle +qaohv for now.
+        prefix_lists = {}
+        if prefixmodes is not None:
+            prefix_lists = {supported_modes[pmode]: pmodelist for pmode, pmodelist in prefixmodes.items()
+                            if pmode in supported_modes}
 
         for mode in changedmodes:
             # Chop off the +/- part that parse_modes gives; it's meaningless for a mode list.
@@ -1067,21 +1376,17 @@ class PyLinkNetworkCoreWithUtils(PyLinkNetworkCore):
                 real_mode = (mode[0][1], mode[1])
             except IndexError:
                 real_mode = mode
+            modechar, arg = real_mode
 
             if is_channel:
-                if prefixmodes is not None:
-                    # We only handle +qaohv for now. Iterate over every supported mode:
-                    # if the IRCd supports this mode and it is the one being set, add/remove
-                    # the person from the corresponding prefix mode list (e.g. c.prefixmodes['op']
-                    # for ops).
-                    for pmode, pmodelist in prefixmodes.items():
-                        if pmode in supported_modes and real_mode[0] == supported_modes[pmode]:
-                            if mode[0][0] == '+':
-                                pmodelist.add(mode[1])
-                            else:
-                                pmodelist.discard(mode[1])
-
-                if real_mode[0] in self.prefixmodes:
+                pmodelist = prefix_lists.get(modechar)
+                if pmodelist is not None:
+                    if mode[0][0] == '+':
+                        pmodelist.add(arg)
+                    else:
+                        pmodelist.discard(arg)
+
+                if modechar in self.prefixmodes:
                     # Don't add prefix modes to Channel.modes; they belong in the
                     # prefixmodes mapping handled above.
                     self._log_debug_modes('(%s) Not adding mode %s to Channel.modes because '
@@ -1090,34 +1395,20 @@ class PyLinkNetworkCoreWithUtils(PyLinkNetworkCore):
 
             if mode[0][0] != '-':  # Adding a mode; assume add if no explicit +/- is given
                 self._log_debug_modes('(%s) Adding mode %r on %s', self.name, real_mode, modelist)
-                existing = mapping.get(real_mode[0])
-                if existing and real_mode[0] not in supported_modes['*A']:
-                    # The mode we're setting takes a parameter, but is not a list mode (like +beI).
-                    # Therefore, only one version of it can exist at a time, and we must remove
-                    # any old modepairs using the same letter. Otherwise, we'll get duplicates when,
-                    # for example, someone sets mode "+l 30" on a channel already set "+l 25".
-                    self._log_debug_modes('(%s) Old modes for mode %r exist in %s, removing them: %s',
-                              self.name, real_mode, modelist, str(existing))
-                    while existing:
-                        oldvalue = existing.pop()
-                        modelist.discard((real_mode[0], oldvalue))
-
+                if modechar not in list_modes:
+                    # Only one version of a mode can exist at a time, unless it is a list mode
+                    # (like +beI). Otherwise, we'll get duplicates when, for example, someone sets
+                    # mode "+l 30" on a channel already set "+l 25".
+                    modelist.discard_mode(modechar)
                 modelist.add(real_mode)
-                mapping[real_mode[0]].add(real_mode[1])
             else:  # Removing a mode
                 self._log_debug_modes('(%s) Removing mode %r from %s', self.name, real_mode, modelist)
-
-                existing = mapping.get(real_mode[0])
-                arg = real_mode[1]
-                # Mode requires argument for removal (case insensitive)
-                if real_mode[0] in (supported_modes['*A'] + supported_modes['*B']):
-                    modelist.discard((real_mode[0], self.to_lower(arg)))
-                # Mode does not require argument for removal - remove all modes entries with the same character
+                if modechar in param_modes and arg is None:
+                    modelist.discard(real_mode)
                 else:
-                    while existing:
-                        oldvalue = existing.pop()
-                        if arg is None or self.to_lower(arg) == self.to_lower(oldvalue):
-                            modelist.discard((real_mode[0], oldvalue))
+                    # Mode arguments are matched case insensitively; modes that don't need an
+                    # argument for removal remove all entries with the same character.
+                    modelist.discard_mode(modechar, arg)
         self._log_debug_modes('(%s) Final modelist: %s', self.name, modelist)
         return modelist
 
@@ -1125,30 +1416,38 @@ class PyLinkNetworkCoreWithUtils(PyLinkNetworkCore):
         """Takes a list of parsed IRC modes, and applies them on the given target.
 
         The target can be either a channel or a user; this is handled automatically."""
+        if not changedmodes:
+            # Nothing to do; this also keeps shared (immutable) mode sets in place.
+            return
+
         is_channel = self.is_channel(target)
 
         prefixmodes = None
         try:
             if is_channel:
                 c = self._channels[target]
-                old_modelist = c.modes
-                prefixmodes = c.prefixmodes
+                old_modelist = c.modes  # This also unshares the channel's sets from any snapshots
+                # Only create the channel's prefix mode lists once a prefix mode is set.
+                prefixmodes = c._prefixmodes
+                if prefixmodes is None and any(mode[0][0] == '+' and mode[0][-1] in self.prefixmodes
+                                               for mode in changedmodes):
+                    prefixmodes = c.prefixmodes
             else:
                 old_modelist = self.users[target].modes
         except KeyError:
             log.warning('(%s) Possible desync? Mode target %s is unknown.', self.name, target)
             return
 
+        if changedmodes is old_modelist:
+            # Don't change the mode store while iterating over it.
+            changedmodes = list(changedmodes)
         modelist = self._apply_modes(old_modelist, changedmodes, is_channel=is_channel,
                                      prefixmodes=prefixmodes)
 
-        try:
-            if is_channel:
-                self._channels[target].modes = modelist
-            else:
-                self.users[target].modes = modelist
-        except KeyError:
-            log.warning("(%s) Invalid MODE target %s (is_channel=%s)", self.name, target, is_channel)
+        # Channel mode stores are changed in place. User mode lists are small, so these are kept
+        # as plain sets instead.
+        if not is_channel:
+            self.users[target].modes = set(modelist)
 
     @staticmethod
     def _flip(mode):
@@ -1185,27 +1484,30 @@ class PyLinkNetworkCoreWithUtils(PyLinkNetworkCore):
             modes = self.parse_modes(target, modes.split(" "))
 
         # Get the current mode list first.
+        prefix_lists = {}
         if self.is_channel(target):
             c = oldobj or self._channels[target]
-            oldmodes = c.modes.copy()
-            possible_modes = self.cmodes.copy()
-            # For channels, this also includes the list of prefix modes.
-            possible_modes['*A'] += ''.join(self.prefixmodes)
-            for name, userlist in c.prefixmodes.items():
-                try:
-                    # Add prefix modes to the list of old modes
-                    oldmodes |= {(self.cmodes[name], u) for u in userlist}
-                except KeyError:
-                    continue
+            # This only reads the channel's modes, so there's no need to unshare them from snapshots.
+            oldmodes = c._modes
+            # For channels, the list modes also include prefix modes. These are looked up in the
+            # channel's prefix mode lists.
+            list_modes = self.cmodes['*A'] + ''.join(self.prefixmodes)
+            prefix_lists = {self.cmodes[name]: userlist for name, userlist in c._get_prefixmodes().items()
+                            if name in self.cmodes}
+            possible_modes = self.cmodes
         else:
-            oldmodes = set(self.users[target].modes)
+            oldmodes = structures.IRCModeStore(self, self.users[target].modes)
             possible_modes = self.umodes
+            list_modes = possible_modes['*A']
+        param_modes = possible_modes['*B'] + possible_modes['*C']
 
-        oldmodes_mapping = dict(oldmodes)
-        oldmodes_lower = {(modepair[0], self.to_lower(modepair[1]) if modepair[1] else modepair[1])
-                          for modepair in oldmodes}
+        def _is_set(mchar, arg):
+            if mchar in prefix_lists:
+                return arg in prefix_lists[mchar]
+            return oldmodes.find(mchar, arg) is not None
 
         newmodes = []
+        seen = set()
         self._log_debug_modes('(%s) reverse_modes: old/current mode list for %s is: %s', self.name,
                               target, oldmodes)
         for char, arg in modes:
@@ -1215,11 +1517,12 @@ class PyLinkNetworkCoreWithUtils(PyLinkNetworkCore):
             # C = Mode that changes a setting and only has a parameter when set.
             # D = Mode that changes a setting and never has a parameter.
             mchar = char[-1]
-            if mchar in possible_modes['*B'] + possible_modes['*C']:
+            if mchar in param_modes:
                 # We need to look at the current mode list to reset modes that take arguments
                 # For example, trying to bounce +l 30 on a channel that had +l 50 set should
                 # give "+l 50" and not "-l".
-                oldarg = oldmodes_mapping.get(mchar)
+                oldargs = oldmodes.get_args(mchar)
+                oldarg = oldargs[0] if oldargs else None
 
                 if oldarg:  # Old mode argument for this mode existed, use that.
                     mpair = ('+%s' % mchar, oldarg)
@@ -1233,29 +1536,28 @@ class PyLinkNetworkCoreWithUtils(PyLinkNetworkCore):
             else:
                 mpair = (self._flip(char), arg)
 
-            if arg is not None:
-                arg = self.to_lower(arg)
-            if char[0] != '-' and (mchar, arg) in oldmodes:
+            if char[0] != '-' and _is_set(mchar, arg):
                 # Mode is already set.
                 self._log_debug_modes("(%s) reverse_modes: skipping reversing '%s %s' with %s since we're "
                                       "setting a mode that's already set.", self.name, char, arg, mpair)
                 continue
-            elif char[0] == '-' and (mchar, arg) not in oldmodes and mchar in possible_modes['*A']:
+            elif char[0] == '-' and mchar in list_modes and not _is_set(mchar, arg):
                 # We're unsetting a list or prefix mode that was never set - don't set it in response!
                 # TS6 IRCds lacks server-side verification for this and can cause annoying mode floods.
                 self._log_debug_modes("(%s) reverse_modes: skipping reversing '%s %s' with %s since it "
                                       "wasn't previously set.", self.name, char, arg, mpair)
                 continue
-            elif char[0] == '-' and mchar not in oldmodes_mapping:
+            elif char[0] == '-' and mchar not in list_modes and not oldmodes.has_mode(mchar):
                 # Check the same for regular modes that previously didn't exist
                 self._log_debug_modes("(%s) reverse_modes: skipping reversing '%s %s' with %s since it "
                                       "wasn't previously set.", self.name, char, arg, mpair)
                 continue
-            elif mpair in newmodes:
+            elif mpair in seen:
                 # Check the same for regular modes that previously didn't exist
                 self._log_debug_modes("(%s) reverse_modes: skipping duplicate reverse mode %s", self.name,  mpair)
                 continue
             newmodes.append(mpair)
+            seen.add(mpair)
 
         self._log_debug_modes('(%s) reverse_modes: new modes: %s', self.name, newmodes)
         if origstring:
@@ -1271,7 +1573,7 @@ class PyLinkNetworkCoreWithUtils(PyLinkNetworkCore):
         joins them into a string.
         """
         prefix = '+'  # Assume we're adding modes unless told otherwise
-        modelist = ''
+        modechars = []
         args = []
 
         # Sort modes alphabetically like a conventional IRCd.
@@ -1293,19 +1595,19 @@ class PyLinkNetworkCoreWithUtils(PyLinkNetworkCore):
                 # the prefix to the mode string. This prevents '+nt-lk' from turning
                 # into '+n+t-l-k' or '+ntlk'.
                 if prefix != curr_prefix:
-                    modelist += curr_prefix
+                    modechars.append(curr_prefix)
                     prefix = curr_prefix
-            modelist += mode
+            modechars.append(mode)
             if arg is not None:
-                args.append(arg)
-        if not modelist.startswith(('+', '-')):
+                args.append(str(arg))
+        if not modechars or modechars[0] not in ('+', '-'):
             # Our starting mode didn't have a prefix with it. Assume '+'.
-            modelist = '+' + modelist
+            modechars.insert(0, '+')
         if args:
             # Add the args if there are any.
-            modelist += ' '
-            modelist += ' '.join((str(arg) for arg in args))
-        return modelist
+            modechars.append(' ')
+            modechars.append(' '.join(args))
+        return ''.join(modechars)
 
     @classmethod
     def wrap_modes(cls, modes, limit, max_modes_per_msg=0):
@@ -1464,6 +1766,25 @@ class PyLinkNetworkCoreWithUtils(PyLinkNetworkCore):
             return True
         return False
 
+    def compile_mask(self, glob):
+        """
+        Returns a utils.CompiledMask for the given hostmask or exttarget. Compiled masks are
+        cached per network, and recompiled when the network's casemapping changes.
+        """
+        mask = self._mask_cache.get(glob)
+        if mask is None or mask.casemapping != self.casemapping:
+            mask = utils.CompiledMask(self, glob)
+            cache = self._mask_cache
+            if len(cache) >= self.MASK_CACHE_SIZE:
+                try:
+                    # Evict the oldest entry.
+                    cache.popitem(last=False)
+                except KeyError:
+                    # Another thread emptied the cache in the meantime.
+                    pass
+            cache[glob] = mask
+        return mask
+
     def match_host(self, glob, target, ip=True, realhost=True):
         """
         Checks whether the given host or given UID's hostmask matches the given glob
@@ -1474,88 +1795,10 @@ class PyLinkNetworkCoreWithUtils(PyLinkNetworkCore):
 
         This function respects IRC casemappings (rfc1459 and ascii). If the given target is a UID,
         and the 'ip' option is enabled, the host portion of the glob is also matched as a CIDR range.
-        """
-        # Allow queries like !$exttarget to invert the given match.
-        invert = glob.startswith('!')
-        if invert:
-            glob = glob.lstrip('!')
-
-        def match_host_core():
-            """
-            Core processor for match_host(), minus the inversion check.
-            """
-            # Work with variables in the match_host() scope, from
-            # http://stackoverflow.com/a/8178808
-            nonlocal glob
-
-            # Prepare a list of hosts to check against.
-            if target in self.users:
-
-                if not self.is_hostmask(glob):
-                    for specialchar in '$:()':
-                        # XXX: we should probably add proper rules on what's a valid account name
-                        if specialchar in glob:
-                            break
-                    else:
-                        # Implicitly convert matches for *sane* account names to "$pylinkacc:accountname".
-                        log.debug('(%s) Using target $pylinkacc:%s instead of raw string %r', self.name, glob, glob)
-                        glob = '$pylinkacc:' + glob
-
-                if glob.startswith('$'):
-                    # Exttargets start with $. Skip regular ban matching and find the matching ban handler.
-                    glob = glob.lstrip('$')
-                    exttargetname = glob.split(':', 1)[0]
-                    handler = world.exttarget_handlers.get(exttargetname)
-
-                    if handler:
-                        # Handler exists. Return what it finds.
-                        result = handler(self, glob, target)
-                        log.debug('(%s) Got %s from exttarget %s in match_host() glob $%s for target %s',
-                                  self.name, result, exttargetname, glob, target)
-                        return result
-                    else:
-                        log.debug('(%s) Unknown exttarget %s in match_host() glob $%s', self.name,
-                                  exttargetname, glob)
-                        return False
-
-                hosts = {self.get_hostmask(target)}
 
-                if ip:
-                    hosts.add(self.get_hostmask(target, ip=True))
-
-                    # HACK: support CIDR hosts in the hosts portion
-                    try:
-                        header, cidrtarget = glob.split('@', 1)
-                        # Try to parse the host portion as a CIDR range
-                        network = ipaddress.ip_network(cidrtarget)
-
-                        real_ip = self.users[target].ip
-                        if ipaddress.ip_address(real_ip) in network:
-                            # If the CIDR matches, hack around the host matcher by pretending that
-                            # the lookup target was the IP and not the CIDR range!
-                            glob = '@'.join((header, real_ip))
-                            log.debug('(%s) Found matching CIDR %s for %s, replacing target glob with IP %s', self.name,
-                                      cidrtarget, target, real_ip)
-                    except ValueError:
-                        pass
-
-                if realhost:
-                    hosts.add(self.get_hostmask(target, realhost=True))
-
-            else:  # We were given a host, use that.
-                hosts = [target]
-
-            # Iterate over the hosts to match, since we may have multiple (check IP/real host)
-            for host in hosts:
-                if self.match_text(glob, host):
-                    return True
-
-            return False
-
-        result = match_host_core()
-        if invert:
-            result = not result
-        return result
+        To match one target against many globs, use utils.MaskSet instead.
+        """
+        return self.compile_mask(glob).match(self, target, ip=ip, realhost=realhost)
 
     def match_text(self, glob, text):
         """
@@ -1567,11 +1810,27 @@ class PyLinkNetworkCoreWithUtils(PyLinkNetworkCore):
         """
         Returns all users matching the target hostmask/exttarget. Users can also be filtered by channel.
         """
+        mask = self.compile_mask(banmask)
+        candidates = self.users.index.find(mask)
+
         if channel:
-            banmask = "$and:(%s+$channel:%s)" % (banmask, channel)
+            chanobj = self.channels.get(channel)
+            if chanobj is None:
+                return
+            uids = chanobj.users.copy()
+            if candidates is not None:
+                uids &= candidates
+        elif candidates is not None:
+            uids = candidates
+        else:
+            uids = list(self.users)
 
-        for uid, userobj in self.users.copy().items():
-            if self.match_host(banmask, uid) and uid in self.users:
+        if channel or candidates is not None:
+            # Keep the output order predictable.
+            uids = sorted(uids)
+
+        for uid in uids:
+            if uid in self.users and mask.match(self, uid):
                 yield uid
 
     def match_all_re(self, re_mask, channel=None):
@@ -1579,9 +1838,18 @@ class PyLinkNetworkCoreWithUtils(PyLinkNetworkCore):
         Returns all users whose "nick!user@host [gecos]" mask matches the given regular expression. Users can also be filtered by channel.
         """
         regexp = re.compile(re_mask)
-        for uid, userobj in self.users.copy().items():
+        if channel:
+            chanobj = self.channels.get(channel)
+            uids = sorted(chanobj.users) if chanobj else ()
+        else:
+            uids = list(self.users)
+
+        for uid in uids:
+            userobj = self.users.get(uid)
+            if userobj is None:
+                continue
             target = '%s [%s]' % (self.get_hostmask(uid), userobj.realname)
-            if regexp.fullmatch(target) and ((not channel) or channel in userobj.channels):
+            if regexp.fullmatch(target):
                 yield uid
 
     def make_channel_ban(self, uid, ban_type='ban', ban_style=None):
@@ -1629,7 +1897,7 @@ class PyLinkNetworkCoreWithUtils(PyLinkNetworkCore):
             log.debug("(%s) Clearing local modes from channel %s due to TS change", self.name,
                       channel)
             self._channels[channel].modes.clear()
-            for p in self._channels[channel].prefixmodes.values():
+            for p in self._channels[channel]._get_prefixmodes().values():
                 for user in p.copy():
                     if not self.is_internal_client(user):
                         p.discard(user)
@@ -1702,6 +1970,29 @@ class PyLinkNetworkCoreWithUtils(PyLinkNetworkCore):
             return name
         return entityid  # Regular UID/SID, no change
 
+    async def _process_queue_async(self):
+        """Coroutine to process outgoing queue data (asyncio driver)."""
+        self._queue_event = event = asyncio.Event()
+        try:
+            while not self._aborted.is_set():
+                event.clear()
+                while True:
+                    try:
+                        lane, data = self._queue.get_lane(False)
+                    except queue.Empty:
+                        break
+                    batch, stop, delay = self._get_send_batch(data, lane)
+                    if batch:
+                        await self._send_batch_async(batch)
+                    if stop:
+                        return
+                    if delay:
+                        await asyncio.sleep(delay)
+                await event.wait()
+        finally:
+            self._queue_event = None
+            self._aborted_send.set()
+
     def wrap_message(self, source, target, text):
         """
         Wraps the given message text into multiple lines (length depends on how much the protocol
@@ -1717,6 +2008,23 @@ KEEPALIVE_MAX_MISSED = 2
 class IRCNetwork(PyLinkNetworkCoreWithUtils):
     S2S_BUFSIZE = 510
 
+    # Bounds for the adaptive socket read size: reads grow towards RECV_SIZE_MAX while the socket
+    # keeps filling the read buffer (e.g. during a netburst), and shrink back down once idle.
+    RECV_SIZE_MIN = 2048
+    RECV_SIZE_MAX = 65536
+
+    # Maximum amount of queued data (in bytes) to combine into one socket write.
+    SEND_BATCH_BYTES = 16384
+
+    # Maps outgoing commands to the queue lane they're sent in; anything not listed here uses
+    # SENDQ_LANE_NORMAL, so that lines depending on each other are always sent in order.
+    SEND_LANES = {'PING': SENDQ_LANE_KEEPALIVE, 'PONG': SENDQ_LANE_KEEPALIVE,
+                  'ERROR': SENDQ_LANE_KEEPALIVE, 'SQUIT': SENDQ_LANE_KEEPALIVE}
+
+    # Outgoing commands that flow control may hold back (in SENDQ_LANE_BULK) while the send bucket
+    # is empty, letting other lines go first. Lines from the same sender are never reordered.
+    SEND_BULK_COMMANDS = {'PRIVMSG', 'NOTICE'}
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -1724,8 +2032,17 @@ class IRCNetwork(PyLinkNetworkCoreWithUtils):
         self._ping_timer = None
         self._socket = None
         self._buffer = bytearray()
+        self._recv_buffer = bytearray(self.RECV_SIZE_MAX)
+        self._recv_size = self.RECV_SIZE_MIN
         self._reconnect_thread = None
         self._queue_thread = None
+        # Serializes writes to the socket between the queue thread and unqueued sends.
+        self._write_lock = threading.Lock()
+
+        # Used instead of the threads above when the asyncio socket driver is enabled.
+        self._reconnect_timer = None
+        self._queue_task = None
+        self._queue_event = None
 
     def _init_vars(self, *args, **kwargs):
         super()._init_vars(*args, **kwargs)
@@ -1735,7 +2052,27 @@ class IRCNetwork(PyLinkNetworkCoreWithUtils):
         self.pingfreq = self.serverdata.get('pingfreq') or 90
 
         self.maxsendq = self.serverdata.get('maxsendq', 4096)
-        self._queue = queue.Queue(self.maxsendq)
+        self._queue = structures.LaneQueue(self.maxsendq, lanes=SENDQ_LANE_BULK+1)
+        self._send_bucket = self._make_send_bucket()
+        # Counts the lines held back in SENDQ_LANE_BULK by sender.
+        self._held_sources = collections.Counter()
+        self._recv_size = self.RECV_SIZE_MIN
+
+        # Counts the lines, socket writes, and bytes sent on this connection.
+        self.send_stats = collections.Counter()
+
+    def _make_send_bucket(self):
+        """
+        Returns the token bucket used to pace outgoing lines, or None if flow control is disabled.
+        """
+        rate = self.serverdata.get('sendq_rate')
+        if rate:
+            return structures.TokenBucket(rate, self.serverdata.get('sendq_burst') or 1)
+
+        # Older configurations set a fixed delay between lines instead.
+        throttle_time = self.serverdata.get('throttle_time')
+        if throttle_time:
+            return structures.TokenBucket(1 / throttle_time, 1)
 
     def _schedule_ping(self):
         """Schedules periodic pings in a loop."""
@@ -1750,13 +2087,25 @@ class IRCNetwork(PyLinkNetworkCoreWithUtils):
             self.disconnect()
             return
 
-        self._ping_timer = threading.Timer(self.pingfreq, self._schedule_ping)
-        self._ping_timer.daemon = True
-        self._ping_timer.name = 'Ping timer loop for %s' % self.name
-        self._ping_timer.start()
+        self._ping_timer = self._start_timer(self.pingfreq, self._schedule_ping,
+                                             'Ping timer loop for %s' % self.name)
 
         log.debug('(%s) Ping scheduled at %s', self.name, time.time())
 
+    def _start_timer(self, delay, func, name):
+        """
+        Starts a timer calling func() after the given delay, and returns an object with a cancel()
+        method. With the asyncio driver, the timer runs on the event loop instead of in a thread.
+        """
+        if _get_socket_driver() is asyncdriver:
+            return asyncdriver.call_later(delay, func, name=name)
+
+        timer = threading.Timer(delay, func)
+        timer.daemon = True
+        timer.name = name
+        timer.start()
+        return timer
+
     def _log_connection_error(self, *args, **kwargs):
         # Log connection errors to ERROR unless were shutting down (in which case,
         # the given text goes to DEBUG).
@@ -1788,7 +2137,7 @@ class IRCNetwork(PyLinkNetworkCoreWithUtils):
 
         return context
 
-    def _setup_ssl(self):
+    def _setup_ssl(self, do_handshake_on_connect=True):
         """
         Initializes SSL/TLS for this network.
         """
@@ -1808,7 +2157,8 @@ class IRCNetwork(PyLinkNetworkCoreWithUtils):
                                self.name)
                  raise
 
-        self._socket = context.wrap_socket(self._socket, server_hostname=self.serverdata.get('ip'))
+        self._socket = context.wrap_socket(self._socket, server_hostname=self.serverdata.get('ip'),
+                                           do_handshake_on_connect=do_handshake_on_connect)
 
     def _verify_ssl(self):
         """
@@ -1848,6 +2198,88 @@ class IRCNetwork(PyLinkNetworkCoreWithUtils):
                          ' option in your server block.', self.name,
                          hashtype, fp)
 
+    def _make_socket(self):
+        """
+        Creates (and binds, if configured) the socket for this network. Returns the address family
+        that the uplink address should be resolved with.
+        """
+        ip = self.serverdata["ip"]
+
+        # Set the socket type (IPv6 or IPv4), auto detecting it if not specified.
+        isipv6 = self.serverdata.get("ipv6", utils.get_hostname_type(ip) == 2)
+
+        if (not isipv6) and 'bindhost' in self.serverdata:
+            # Also try detecting the socket type from the bindhost if specified.
+            isipv6 = utils.get_hostname_type(self.serverdata['bindhost']) == 2
+
+        stype = socket.AF_INET6 if isipv6 else socket.AF_INET
+
+        # Creat the socket.
+        self._socket = socket.socket(stype)
+
+        # Set the socket bind if applicable.
+        if 'bindhost' in self.serverdata:
+            self._socket.bind((self.serverdata['bindhost'], 0))
+
+        return stype
+
+    def _warn_plaintext(self, ip):
+        """
+        Warns about plain text links to anything but a loopback address.
+        """
+        if not ipaddress.ip_address(ip).is_loopback:
+            log.warning('(%s) This connection will be made via plain text, which is vulnerable '
+                        'to man-in-the-middle (MITM) attacks and passive eavesdropping. Consider '
+                        'enabling TLS/SSL with either certificate validation or fingerprint '
+                        'pinning to better secure your network traffic.', self.name)
+
+    def _start_link(self):
+        """
+        Sets up a freshly connected socket: this registers it with the socket driver, starts the
+        send queue and ping timer, and runs the protocol module's post_connect().
+        """
+        if self not in world.networkobjects.values():
+            log.debug("(%s) _connect: disconnecting socket %s as the network was removed",
+                      self.name, self._socket)
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+            finally:
+                self._socket.close()
+            return
+
+        # Make sure future reads never block, since select doesn't always guarantee this.
+        self._socket.setblocking(False)
+
+        driver = _get_socket_driver()
+        driver.register(self)
+
+        if self.ssl:
+            self._verify_ssl()
+
+        if driver is asyncdriver:
+            self._queue_task = asyncdriver.loop.create_task(self._process_queue_async())
+        else:
+            self._queue_thread = threading.Thread(name="Queue thread for %s" % self.name,
+                                                  target=self._process_queue, daemon=True)
+            self._queue_thread.start()
+
+        self.sid = self.serverdata.get("sid")
+        # All our checks passed, get the protocol module to connect and run the listen
+        # loop. This also updates any SID values should the protocol module do so.
+        self.post_connect()
+
+        log.info('(%s) Enumerating our own SID %s', self.name, self.sid)
+        host = self.hostname()
+
+        self.servers[self.sid] = Server(self, None, host, internal=True,
+                                        desc=self.serverdata.get('serverdesc')
+                                        or conf.conf['pylink']['serverdesc'])
+
+        log.info('(%s) Starting ping schedulers....', self.name)
+        self._schedule_ping()
+        log.info('(%s) Server ready; listening for data.', self.name)
+        self.autoconnect_active_multiplier = 1  # Reset any extra autoconnect delays
+
     def _connect(self):
         """
         Connects to the network.
@@ -1857,21 +2289,7 @@ class IRCNetwork(PyLinkNetworkCoreWithUtils):
         ip = self.serverdata["ip"]
         port = self.serverdata["port"]
         try:
-            # Set the socket type (IPv6 or IPv4), auto detecting it if not specified.
-            isipv6 = self.serverdata.get("ipv6", utils.get_hostname_type(ip) == 2)
-
-            if (not isipv6) and 'bindhost' in self.serverdata:
-                # Also try detecting the socket type from the bindhost if specified.
-                isipv6 = utils.get_hostname_type(self.serverdata['bindhost']) == 2
-
-            stype = socket.AF_INET6 if isipv6 else socket.AF_INET
-
-            # Creat the socket.
-            self._socket = socket.socket(stype)
-
-            # Set the socket bind if applicable.
-            if 'bindhost' in self.serverdata:
-                self._socket.bind((self.serverdata['bindhost'], 0))
+            stype = self._make_socket()
 
             # Resolve hostnames if it's not an IP address already.
             old_ip = ip
@@ -1882,11 +2300,8 @@ class IRCNetwork(PyLinkNetworkCoreWithUtils):
             self.ssl = self.serverdata.get('ssl')
             if self.ssl:
                 self._setup_ssl()
-            elif not ipaddress.ip_address(ip).is_loopback:
-                log.warning('(%s) This connection will be made via plain text, which is vulnerable '
-                            'to man-in-the-middle (MITM) attacks and passive eavesdropping. Consider '
-                            'enabling TLS/SSL with either certificate validation or fingerprint '
-                            'pinning to better secure your network traffic.', self.name)
+            else:
+                self._warn_plaintext(ip)
 
             log.info("Connecting to network %r on %s:%s", self.name, ip, port)
 
@@ -1895,45 +2310,62 @@ class IRCNetwork(PyLinkNetworkCoreWithUtils):
             # Start the actual connection
             self._socket.connect((ip, port))
 
-            if self not in world.networkobjects.values():
-                log.debug("(%s) _connect: disconnecting socket %s as the network was removed",
-                          self.name, self._socket)
-                try:
-                    self._socket.shutdown(socket.SHUT_RDWR)
-                finally:
-                    self._socket.close()
-                return
+            self._start_link()
 
-            # Make sure future reads never block, since select doesn't always guarantee this.
-            self._socket.setblocking(False)
+        # _run_irc() or the protocol module it called raised an exception, meaning we've disconnected
+        except:
+            self._log_connection_error('(%s) Disconnected from IRC:', self.name, exc_info=True)
+            if not self._aborted.is_set():
+                self.disconnect()
 
-            selectdriver.register(self)
+    async def _do_ssl_handshake_async(self):
+        """
+        Performs the TLS/SSL handshake on a non-blocking socket.
+        """
+        fd = self._socket.fileno()
+        while True:
+            try:
+                self._socket.do_handshake()
+                return
+            except ssl.SSLWantReadError:
+                await asyncdriver.wait_for_fd(fd)
+            except ssl.SSLWantWriteError:
+                await asyncdriver.wait_for_fd(fd, write=True)
 
-            if self.ssl:
-                self._verify_ssl()
+    async def _connect_async(self):
+        """
+        Connects to the network from the asyncio driver's event loop.
+        """
+        self._pre_connect()
 
-            self._queue_thread = threading.Thread(name="Queue thread for %s" % self.name,
-                                                 target=self._process_queue, daemon=True)
-            self._queue_thread.start()
+        loop = asyncdriver.loop
+        ip = self.serverdata["ip"]
+        port = self.serverdata["port"]
+        try:
+            stype = self._make_socket()
+            self._socket.setblocking(False)
 
-            self.sid = self.serverdata.get("sid")
-            # All our checks passed, get the protocol module to connect and run the listen
-            # loop. This also updates any SID values should the protocol module do so.
-            self.post_connect()
+            # Resolve hostnames if it's not an IP address already.
+            old_ip = ip
+            ip = (await loop.getaddrinfo(ip, port, family=stype))[0][-1][0]
+            log.debug('(%s) Resolving address %s to %s', self.name, old_ip, ip)
 
-            log.info('(%s) Enumerating our own SID %s', self.name, self.sid)
-            host = self.hostname()
+            self.ssl = self.serverdata.get('ssl')
+            if not self.ssl:
+                self._warn_plaintext(ip)
 
-            self.servers[self.sid] = Server(self, None, host, internal=True,
-                                            desc=self.serverdata.get('serverdesc')
-                                            or conf.conf['pylink']['serverdesc'])
+            log.info("Connecting to network %r on %s:%s", self.name, ip, port)
 
-            log.info('(%s) Starting ping schedulers....', self.name)
-            self._schedule_ping()
-            log.info('(%s) Server ready; listening for data.', self.name)
-            self.autoconnect_active_multiplier = 1  # Reset any extra autoconnect delays
+            # Start the actual connection, and then the SSL handshake if enabled. Unlike the
+            # threaded version, the socket is wrapped only after it is connected, since the
+            # handshake has to be driven by the event loop.
+            await asyncio.wait_for(loop.sock_connect(self._socket, (ip, port)), self.pingfreq)
+            if self.ssl:
+                self._setup_ssl(do_handshake_on_connect=False)
+                await asyncio.wait_for(self._do_ssl_handshake_async(), self.pingfreq)
+
+            self._start_link()
 
-        # _run_irc() or the protocol module it called raised an exception, meaning we've disconnected
         except:
             self._log_connection_error('(%s) Disconnected from IRC:', self.name, exc_info=True)
             if not self._aborted.is_set():
@@ -1941,8 +2373,13 @@ class IRCNetwork(PyLinkNetworkCoreWithUtils):
 
     def connect(self):
         """
-        Starts a thread to connect the network.
+        Starts a thread to connect the network. With the asyncio driver, the connection is
+        made from the event loop instead.
         """
+        if _get_socket_driver() is asyncdriver:
+            asyncdriver.run_coroutine(self._connect_async())
+            return
+
         connect_thread = threading.Thread(target=self._connect, daemon=True,
                                           name="Connect thread for %s" %
                                           self.name)
@@ -1957,16 +2394,15 @@ class IRCNetwork(PyLinkNetworkCoreWithUtils):
 
         # Stop the queue thread.
         if self._queue is not None:
-            try:
-                # XXX: queue.Queue.queue isn't actually documented, so this is probably not reliable in the long run.
-                with self._queue.mutex:
-                    self._queue.queue[0] = None
-            except IndexError:
-                self._queue.put(None)
+            self._queue.put_front(None, SENDQ_LANE_KEEPALIVE)
+
+        if self._queue_task is not None:
+            asyncdriver.call_in_loop(self._queue_task.cancel)
+            self._queue_task = None
 
         if self._socket is not None:
             try:
-                selectdriver.unregister(self)
+                _get_socket_driver().unregister(self)
             except KeyError:
                 pass
             try:
@@ -1985,6 +2421,10 @@ class IRCNetwork(PyLinkNetworkCoreWithUtils):
         if self._ping_timer:
             log.debug('(%s) Canceling pingTimer at %s due to disconnect() call', self.name, time.time())
             self._ping_timer.cancel()
+        # Stop any pending reconnect (asyncio driver only).
+        if self._reconnect_timer:
+            self._reconnect_timer.cancel()
+            self._reconnect_timer = None
         self._buffer.clear()
         self._post_disconnect()
 
@@ -2003,9 +2443,26 @@ class IRCNetwork(PyLinkNetworkCoreWithUtils):
             if self._run_autoconnect():
                 self.connect()
 
+        def _reconnect_async():
+            self._reconnect_timer = None
+            if self._finish_autoconnect_delay():
+                self.connect()
+
         if self not in world.networkobjects.values():
             log.debug('(%s) _start_reconnect: Stopping reconnect timer as the network was removed', self.name)
             return
+        elif _get_socket_driver() is asyncdriver:
+            if self._reconnect_timer is not None:
+                log.debug('(%s) Ignoring attempt to reschedule reconnect as one is in progress.', self.name)
+                return
+            # With the asyncio driver, wait for the autoconnect delay on the event loop instead.
+            autoconnect = self._get_autoconnect_delay()
+            if autoconnect is not None:
+                # Clear the aborted flag like _run_autoconnect() does, so that a disconnect()
+                # during the delay can cancel the reconnect.
+                self._aborted.clear()
+                self._reconnect_timer = asyncdriver.call_later(
+                    autoconnect, _reconnect_async, name="Reconnecting network %s" % self.name)
         elif self._reconnect_thread is None or not self._reconnect_thread.is_alive():
             self._reconnect_thread = threading.Thread(target=_reconnect, name="Reconnecting network %s" % self.name)
             self._reconnect_thread.start()
@@ -2047,40 +2504,73 @@ class IRCNetwork(PyLinkNetworkCoreWithUtils):
             log.debug('(%s) Ignoring attempt to read data because self._socket is None', self.name)
             return
 
-        data = bytearray()
-        try:
-            data = self._socket.recv(2048)
-        except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
-            log.debug('(%s) No data to read, trying again later...', self.name, exc_info=True)
-            return
-        except OSError:
-            # Suppress socket read warnings from lingering recv() calls if
-            # we've been told to shutdown.
-            if self._aborted.is_set():
+        recv_view = memoryview(self._recv_buffer)
+        received = 0
+        while True:
+            try:
+                size = self._recv_size
+                nbytes = self._socket.recv_into(recv_view, size)
+            except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                if received:
+                    break
+                log.debug('(%s) No data to read, trying again later...', self.name, exc_info=True)
                 return
-            raise
+            except OSError:
+                # Suppress socket read warnings from lingering recv() calls if
+                # we've been told to shutdown.
+                if self._aborted.is_set():
+                    return
+                raise
 
-        self._buffer += data
-        if not data:
-            self._log_connection_error('(%s) Connection lost, disconnecting.', self.name)
-            self.disconnect()
-            return
+            if not nbytes:
+                if received:
+                    # Process what we have first; the next read will pick up the disconnect.
+                    break
+                self._log_connection_error('(%s) Connection lost, disconnecting.', self.name)
+                self.disconnect()
+                return
 
-        while b'\n' in self._buffer:
-            line, self._buffer = self._buffer.split(b'\n', 1)
-            line = line.strip(b'\r')
-            line = line.decode(self.encoding, "replace")
-            self.parse_irc_command(line)
+            received += nbytes
+            self._buffer += recv_view[:nbytes]
+
+            # Grow the read size while reads keep filling it, and shrink it again when they don't.
+            if nbytes == size:
+                self._recv_size = min(size * 2, self.RECV_SIZE_MAX)
+            elif nbytes < size // 4:
+                self._recv_size = max(size // 2, self.RECV_SIZE_MIN)
+
+            # SSL sockets may have decrypted data buffered that select() won't report as readable,
+            # so keep reading until that's drained.
+            if not (self.ssl and self._socket.pending()):
+                break
+
+        self._process_buffer()
 
         # Update the last message received time
         self.lastping = time.time()
 
-    def _send(self, data):
-        """Sends raw text to the uplink server."""
-        if self._aborted.is_set():
-            log.debug("(%s) Not sending message %r since the connection is dead", self.name, data)
-            return
+    def _process_buffer(self):
+        """
+        Parses every complete line in the read buffer, leaving any partial line at the end of it.
+        """
+        buf = self._buffer
+        encoding = self.encoding
+        start = 0
+        while True:
+            end = buf.find(b'\n', start)
+            if end == -1:
+                break
+            line = buf[start:end].decode(encoding, "replace").strip('\r')
+            start = end + 1
+            self.parse_irc_command(line)
+            if not buf:
+                # The buffer was cleared by a disconnect.
+                return
+        # Only shift the buffer once, after all the complete lines are read.
+        del buf[:start]
 
+    def _encode_line(self, data):
+        """Encodes a line of outgoing text, including its line ending."""
         # Safeguard against newlines in input!! Otherwise, each line gets
         # treated as a separate command, which is particularly nasty.
         data = data.replace('\n', ' ')
@@ -2090,12 +2580,93 @@ class IRCNetwork(PyLinkNetworkCoreWithUtils):
         encoded_data += b"\r\n"
 
         log.debug("(%s) -> %s", self.name, data)
+        return encoded_data
 
+    def _write(self, data):
+        """
+        Writes all of the given bytes to the socket, waiting for it to become writable as needed
+        (the socket is non-blocking, so sendall() can't be used here).
+
+        Writes are serialized using the network's write lock, so that lines from different threads
+        are never interleaved. This blocks the calling thread (which may be the one reading from
+        the socket) for up to pingfreq seconds in total, after which socket.timeout is raised.
+        """
+        view = memoryview(data)
+        deadline = time.monotonic() + self.pingfreq
+        with self._write_lock:
+            while view:
+                try:
+                    view = view[self._socket.send(view):]
+                except (BlockingIOError, ssl.SSLWantWriteError):
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0 or not select.select([], [self._socket], [], timeout)[1]:
+                        raise socket.timeout("Timed out waiting for socket to become writable")
+                except ssl.SSLWantReadError:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0 or not select.select([self._socket], [], [], timeout)[0]:
+                        raise socket.timeout("Timed out waiting for socket to become readable")
+
+    async def _write_async(self, data):
+        """
+        Coroutine version of _write() for the asyncio driver. This is only called from the queue
+        task, which also sends unqueued lines (see send()), so writes can't be interleaved.
+        """
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[self._socket.send(view):]
+            except (BlockingIOError, ssl.SSLWantWriteError):
+                await asyncio.wait_for(asyncdriver.wait_for_fd(self._socket.fileno(), write=True),
+                                       self.pingfreq)
+            except ssl.SSLWantReadError:
+                await asyncio.wait_for(asyncdriver.wait_for_fd(self._socket.fileno()),
+                                       self.pingfreq)
+
+    def _count_sent(self, batch, nbytes):
+        """Updates the send statistics after writing a batch of lines."""
+        self.send_stats['lines'] += len(batch)
+        self.send_stats['writes'] += 1
+        self.send_stats['bytes'] += nbytes
+
+    def _send_batch(self, batch):
+        """Sends a list of encoded lines to the uplink server in one write."""
+        if self._aborted.is_set():
+            log.debug("(%s) Not sending %s line(s) since the connection is dead", self.name, len(batch))
+            return
+
+        data = b''.join(batch)
         try:
-            self._socket.send(encoded_data)
+            self._write(data)
         except:
-            log.exception("(%s) Failed to send message %r; aborting!", self.name, data)
+            log.exception("(%s) Failed to send %s line(s) %r; aborting!", self.name, len(batch), data)
             self.disconnect()
+        else:
+            self._count_sent(batch, len(data))
+
+    async def _send_batch_async(self, batch):
+        """Coroutine version of _send_batch() for the asyncio driver."""
+        if self._aborted.is_set():
+            log.debug("(%s) Not sending %s line(s) since the connection is dead", self.name, len(batch))
+            return
+
+        data = b''.join(batch)
+        try:
+            await self._write_async(data)
+        except asyncio.CancelledError:
+            raise
+        except:
+            log.exception("(%s) Failed to send %s line(s) %r; aborting!", self.name, len(batch), data)
+            self.disconnect()
+        else:
+            self._count_sent(batch, len(data))
+
+    def _send(self, data):
+        """Sends raw text to the uplink server."""
+        if self._aborted.is_set():
+            log.debug("(%s) Not sending message %r since the connection is dead", self.name, data)
+            return
+
+        self._send_batch([self._encode_line(data)])
 
     def send(self, data, queue=True):
         """send() wrapper with optional queueing support."""
@@ -2106,34 +2677,123 @@ class IRCNetwork(PyLinkNetworkCoreWithUtils):
             # XXX: we don't really know how to handle blocking queues yet, so
             # it's better to not expose that yet.
             try:
-                self._queue.put_nowait(data)
+                self._queue.put_nowait(data, self._get_send_lane(data))
             except QUEUE_FULL:
                 log.error('(%s) Max SENDQ exceeded (%s), disconnecting!', self.name, self._queue.maxsize)
                 self.disconnect()
                 raise
+            self._wake_queue_task()
+        elif self._queue_event is not None:
+            # With the asyncio driver, the queue task may be partway through a write. Put the
+            # line at the front of the queue instead, so that it is sent next without being
+            # interleaved with another line.
+            self._queue.put_front(data, SENDQ_LANE_KEEPALIVE)
+            self._wake_queue_task()
         else:
             self._send(data)
 
+    def _wake_queue_task(self):
+        """Wakes up the asyncio queue task, if there is one."""
+        event = self._queue_event
+        if event is not None and not event.is_set():
+            asyncdriver.call_in_loop(event.set)
+
+    def _get_send_command(self, data):
+        """Returns the command name of an outgoing line."""
+        if data.startswith(':'):
+            # Skip the sender prefix
+            data = data.split(' ', 1)[-1]
+        return data.split(' ', 1)[0].upper()
+
+    def _get_send_source(self, data):
+        """Returns the sender prefix of an outgoing line, or None if there is none."""
+        if data.startswith(':'):
+            return data[1:].split(' ', 1)[0]
+        return None
+
+    def _get_send_lane(self, data):
+        """Returns the outgoing queue lane that the given line should be queued in."""
+        if not data:
+            return SENDQ_LANE_NORMAL
+        return self.SEND_LANES.get(self._get_send_command(data), SENDQ_LANE_NORMAL)
+
+    def _hold_line(self, data, source):
+        """Moves a line from the normal lane to the end of the bulk lane."""
+        self._queue.put_back(data, SENDQ_LANE_BULK)
+        self._held_sources[source] += 1
+
+    def _get_send_batch(self, data, lane=SENDQ_LANE_NORMAL):
+        """
+        Builds a batch of encoded lines to send, starting with the given queue item (taken from
+        the given lane) and then draining the queue until it's empty, SEND_BATCH_BYTES is reached,
+        or flow control holds back the next line.
+
+        While the send bucket is empty, bulk lines are moved to SENDQ_LANE_BULK so that other
+        lines can go first once tokens are available again. Any later bulk lines, and lines from
+        a sender with held back lines, are moved there too, so that their order is kept.
+
+        Returns a (batch, stop, delay) tuple, where stop is True if the queue thread should stop
+        after sending the batch, and delay is the time to wait before the next batch.
+        """
+        batch = []
+        size = 0
+        # Bursts are sent at line rate.
+        bucket = self._send_bucket if self.connected.is_set() else None
+        held = self._held_sources
+        while True:
+            if data is None:
+                log.debug('(%s) Stopping queue due to getting None as item', self.name)
+                return batch, True, 0
+            elif self not in world.networkobjects.values():
+                log.debug('(%s) Stopping stale queue; no longer matches world.networkobjects', self.name)
+                return batch, True, 0
+            elif self._aborted.is_set():
+                # The _aborted flag may have changed while we were waiting for an item,
+                # so check for it again.
+                log.debug('(%s) Stopping queue since the connection is dead', self.name)
+                return batch, True, 0
+            elif data:
+                send = True
+                if lane != SENDQ_LANE_KEEPALIVE:
+                    delay = bucket.delay() if bucket is not None else 0
+                    source = self._get_send_source(data)
+                    if lane == SENDQ_LANE_NORMAL and (held[source] or (
+                            (held or delay) and self._get_send_command(data) in self.SEND_BULK_COMMANDS)):
+                        self._hold_line(data, source)
+                        send = False
+                    elif delay:
+                        # Out of tokens: put the line back and wait.
+                        self._queue.put_front(data, lane)
+                        return batch, False, delay
+                    else:
+                        if bucket is not None:
+                            bucket.take()
+                        if lane == SENDQ_LANE_BULK:
+                            held[source] -= 1
+                            if not held[source]:
+                                del held[source]
+
+                if send:
+                    encoded_data = self._encode_line(data)
+                    batch.append(encoded_data)
+                    size += len(encoded_data)
+
+            if size >= self.SEND_BATCH_BYTES:
+                return batch, False, 0
+            try:
+                lane, data = self._queue.get_lane(False)
+            except queue.Empty:
+                return batch, False, 0
+
     def _process_queue(self):
         """Loop to process outgoing queue data."""
-        while True:
-            throttle_time = self.serverdata.get('throttle_time', 0)
-            if not self._aborted.wait(throttle_time):
-                data = self._queue.get()
-                if data is None:
-                    log.debug('(%s) Stopping queue thread due to getting None as item', self.name)
-                    break
-                elif self not in world.networkobjects.values():
-                    log.debug('(%s) Stopping stale queue thread; no longer matches world.networkobjects', self.name)
-                    break
-                elif self._aborted.is_set():
-                    # The _aborted flag may have changed while we were waiting for an item,
-                    # so check for it again.
-                    log.debug('(%s) Stopping queue thread since the connection is dead', self.name)
-                    break
-                elif data:
-                    self._send(data)
-            else:
+        delay = 0
+        while not self._aborted.wait(delay):
+            lane, data = self._queue.get_lane()
+            batch, stop, delay = self._get_send_batch(data, lane)
+            if batch:
+                self._send_batch(batch)
+            if stop:
                 break
 
         # Once we're done here, shut down the write part of the socket.
@@ -2184,6 +2844,8 @@ class Server():
     internal: Boolean, whether the server is an internal PyLink server.
     desc: Sets the server description if relevant.
     """
+    __slots__ = ('uplink', 'users', 'internal', 'name', 'desc', '_irc', 'hopcount', 'has_eob',
+                 '__dict__', '__weakref__')
 
     def __init__(self, irc, uplink, name, internal=False, desc="(None given)"):
         self.uplink = uplink
@@ -2213,15 +2875,24 @@ IrcServer = Server
 
 class Channel(TSObject, structures.CamelCaseToSnakeCase, structures.CopyWrapper):
     """PyLink IRC channel class."""
+    __slots__ = ('_users', '_modes', 'topic', '_prefixmodes', '_irc', 'topicset', 'name',
+                 '_shared_with', '__dict__', '__weakref__')
+
+    PREFIX_MODES = ('op', 'halfop', 'voice', 'owner', 'admin')
+    # Read-only prefix mode lists for channels where no prefix modes have been set yet.
+    EMPTY_PREFIXMODES = types.MappingProxyType({mode: frozenset() for mode in PREFIX_MODES})
 
     def __init__(self, irc, name=None):
         super().__init__()
         # Initialize variables, such as the topic, user list, TS, who's opped, etc.
-        self.users = set()
-        self.modes = set()
+        # Weak references to the snapshots (or for a snapshot, the channel) that the user, mode and
+        # prefix mode sets may be shared with, or None: see snapshot().
+        self._shared_with = None
+        self._users = set()
+        self._modes = structures.IRCModeStore(irc)
         self.topic = ''
-        self.prefixmodes = {'op': set(), 'halfop': set(), 'voice': set(),
-                            'owner': set(), 'admin': set()}
+        # Prefix mode lists are created on first use: see the prefixmodes property.
+        self._prefixmodes = None
         self._irc = irc
 
         # Determines whether a topic has been set here or not. Protocol modules
@@ -2234,32 +2905,122 @@ class Channel(TSObject, structures.CamelCaseToSnakeCase, structures.CopyWrapper)
     def __repr__(self):
         return 'Channel(%s)' % self.name
 
+    def snapshot(self):
+        """
+        Returns a copy-on-write snapshot of the channel, for passing its earlier state to hooks
+        (e.g. as channeldata). Taking a snapshot is cheap: the snapshot and the channel share
+        their user, mode and prefix mode sets until one of them accesses them, at which point
+        that side makes its own copies and the other keeps the originals. Snapshots that are
+        freed before then are never copied.
+        """
+        snapshot = self.copy()
+        snapshot._shared_with = [weakref.ref(self)]
+        self._shared_with = (self._shared_with or []) + [weakref.ref(snapshot)]
+        return snapshot
+
+    def _unshare(self):
+        """
+        Copies the containers shared with a snapshot (or the snapshotted channel), if it still
+        exists, before they are used.
+        """
+        refs = self._shared_with
+        self._shared_with = None
+        copied = False
+        for ref in refs:
+            partner = ref()
+            if partner is None or not partner._shared_with:
+                continue
+            partner_refs = [partner_ref for partner_ref in partner._shared_with if partner_ref() is not self]
+            if len(partner_refs) == len(partner._shared_with):
+                # The partner already made its own copies.
+                continue
+            # The partner keeps the originals, and no longer needs to copy them.
+            partner._shared_with = partner_refs or None
+            if not copied:
+                copied = True
+                self._users = self._users.copy()
+                self._modes = self._modes.copy()
+                if self._prefixmodes is not None:
+                    self._prefixmodes = {mode: userlist.copy() for mode, userlist in self._prefixmodes.items()}
+
+    @property
+    def users(self):
+        if self._shared_with is not None:
+            self._unshare()
+        return self._users
+
+    @users.setter
+    def users(self, value):
+        if self._shared_with is not None:
+            self._unshare()
+        self._users = value
+
+    @property
+    def modes(self):
+        if self._shared_with is not None:
+            self._unshare()
+        return self._modes
+
+    @modes.setter
+    def modes(self, value):
+        if self._shared_with is not None:
+            self._unshare()
+        if not isinstance(value, structures.IRCModeStore):
+            value = structures.IRCModeStore(self._irc, value)
+        self._modes = value
+
+    @property
+    def prefixmodes(self):
+        if self._shared_with is not None:
+            self._unshare()
+        if self._prefixmodes is None:
+            self._prefixmodes = {mode: set() for mode in self.PREFIX_MODES}
+        return self._prefixmodes
+
+    @prefixmodes.setter
+    def prefixmodes(self, value):
+        if self._shared_with is not None:
+            self._unshare()
+        self._prefixmodes = value
+
+    def _get_prefixmodes(self):
+        """
+        Returns the channel's prefix mode lists for reading, without creating them if no prefix
+        modes have been set.
+        """
+        if self._prefixmodes is None:
+            return self.EMPTY_PREFIXMODES
+        return self._prefixmodes
+
     def remove_user(self, target):
         """Removes a user from a channel."""
-        for s in self.prefixmodes.values():
-            s.discard(target)
-        self.users.discard(target)
+        if self._shared_with is not None:
+            self._unshare()
+        if self._prefixmodes is not None:
+            for s in self._prefixmodes.values():
+                s.discard(target)
+        self._users.discard(target)
     removeuser = remove_user
 
     def is_voice(self, uid):
         """Returns whether the given user is voice in the channel."""
-        return uid in self.prefixmodes['voice']
+        return uid in self._get_prefixmodes()['voice']
 
     def is_halfop(self, uid):
         """Returns whether the given user is halfop in the channel."""
-        return uid in self.prefixmodes['halfop']
+        return uid in self._get_prefixmodes()['halfop']
 
     def is_op(self, uid):
         """Returns whether the given user is op in the channel."""
-        return uid in self.prefixmodes['op']
+        return uid in self._get_prefixmodes()['op']
 
     def is_admin(self, uid):
         """Returns whether the given user is admin (&) in the channel."""
-        return uid in self.prefixmodes['admin']
+        return uid in self._get_prefixmodes()['admin']
 
     def is_owner(self, uid):
         """Returns whether the given user is owner (~) in the channel."""
-        return uid in self.prefixmodes['owner']
+        return uid in self._get_prefixmodes()['owner']
 
     def is_voice_plus(self, uid):
         """Returns whether the given user is voice or above in the channel."""
@@ -2268,15 +3029,17 @@ class Channel(TSObject, structures.CamelCaseToSnakeCase, structures.CopyWrapper)
 
     def is_halfop_plus(self, uid):
         """Returns whether the given user is halfop or above in the channel."""
+        prefixmodes = self._get_prefixmodes()
         for mode in ('halfop', 'op', 'admin', 'owner'):
-            if uid in self.prefixmodes[mode]:
+            if uid in prefixmodes[mode]:
                 return True
         return False
 
     def is_op_plus(self, uid):
         """Returns whether the given user is op or above in the channel."""
+        prefixmodes = self._get_prefixmodes()
         for mode in ('op', 'admin', 'owner'):
-            if uid in self.prefixmodes[mode]:
+            if uid in prefixmodes[mode]:
                 return True
         return False
 
@@ -2303,11 +3066,11 @@ class Channel(TSObject, structures.CamelCaseToSnakeCase, structures.CopyWrapper)
         setter before their modes are processed and added to the channel state.
         """
 
-        if uid not in self.users:
+        if uid not in self._users:
             raise KeyError("User %s does not exist or is not in the channel" % uid)
 
         result = []
-        prefixmodes = prefixmodes or self.prefixmodes
+        prefixmodes = prefixmodes or self._get_prefixmodes()
 
         for mode, modelist in prefixmodes.items():
             if uid in modelist:
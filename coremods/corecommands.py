@@ -103,6 +103,7 @@ def unload(irc, source, args):
                     # If the hookfuncs list is empty, remove it.
                     if not hookpairs:
                         del world.hooks[hookname]
+        utils._rebuild_hook_dispatch()
 
         # Call the die() function in the plugin, if present.
         if hasattr(pl, 'die'):
@@ -164,4 +165,4 @@ def clearqueue(irc, source, args):
 
     Clears the outgoing text queue for the current connection."""
     permissions.check_permissions(irc, source, ['core.clearqueue'])
-    irc._queue.queue.clear()
+    irc._queue.clear()
@@ -1,9 +1,10 @@
 """
 exttargets.py - Implements extended targets like $account:xyz, $oper, etc.
 """
+import functools
 
-from pylinkirc import world
-from pylinkirc.log import log
+from pylinkirc import utils, world
+from pylinkirc.log import debug_enabled, log
 
 __all__ = []
 
@@ -15,19 +16,28 @@ def bind(func):
     world.exttarget_handlers[func.__name__] = func
     return func
 
-@bind
-def account(irc, host, uid):
+def compiled(compiler):
     """
-    $account exttarget handler. The following forms are supported, with groups separated by a
-    literal colon. Account matching is case insensitive, while network name matching IS case
-    sensitive.
+    Turns an exttarget compile step into an exttarget handler.
 
-    $account -> Returns True (a match) if the target is registered.
-    $account:accountname -> Returns True if the target's account name matches the one given, and the
-    target is connected to the local network.
-    $account:accountname:netname -> Returns True if both the target's account name and origin
-    network name match the ones given.
-    $account:*:netname -> Matches all logged in users on the given network.
+    Compile steps take a network and an exttarget (minus the leading "$"), and return a function
+    taking a network and a UID which checks whether that user matches. utils.CompiledMask only
+    runs the compile step once per mask, so that matching does no string parsing.
+    """
+    @functools.wraps(compiler)
+    def handler(irc, host, uid):
+        return compiler(irc, host)(irc, uid)
+    handler.compile = compiler
+    return handler
+
+def _match_none(irc, uid):
+    """Predicate for invalid exttargets, which don't match anything."""
+    return False
+
+def _get_services_account(irc, uid):
+    """
+    Returns the (casefolded) services account and home network of the given user, or None if
+    the user is a relay client whose origin user doesn't exist.
     """
     userobj = irc.users[uid]
     homenet = irc.name
@@ -35,35 +45,63 @@ def account(irc, host, uid):
         # User is a PyLink Relay pseudoclient. Use their real services account on their
         # origin network.
         homenet, realuid = userobj.remote
-        log.debug('(%s) exttargets.account: Changing UID of relay client %s to %s/%s', irc.name,
-                  uid, homenet, realuid)
+        if debug_enabled():
+            log.debug('(%s) exttargets.account: Changing UID of relay client %s to %s/%s', irc.name,
+                      uid, homenet, realuid)
         try:
             userobj = world.networkobjects[homenet].users[realuid]
         except KeyError:  # User lookup failed. Bail and return False.
             log.exception('(%s) exttargets.account: KeyError finding %s/%s:', irc.name,
                           homenet, realuid)
-            return False
+            return None
 
-    slogin = irc.to_lower(str(userobj.services_account))
+    return (irc.to_lower(str(userobj.services_account)), homenet)
 
+@bind
+@compiled
+def account(irc, host):
+    """
+    $account exttarget handler. The following forms are supported, with groups separated by a
+    literal colon. Account matching is case insensitive, while network name matching IS case
+    sensitive.
+
+    $account -> Returns True (a match) if the target is registered.
+    $account:accountname -> Returns True if the target's account name matches the one given, and the
+    target is connected to the local network.
+    $account:accountname:netname -> Returns True if both the target's account name and origin
+    network name match the ones given.
+    $account:*:netname -> Matches all logged in users on the given network.
+    """
     # Split the given exttarget host into parts, so we know how many to look for.
     groups = host.split(':')
     log.debug('(%s) exttargets.account: groups to match: %s', irc.name, groups)
 
     if len(groups) == 1:
         # First scenario. Return True if user is logged in.
-        return bool(slogin)
+        def check(irc, slogin, homenet):
+            return bool(slogin)
     elif len(groups) == 2:
         # Second scenario. Return True if the user's account matches the one given.
-        return slogin == irc.to_lower(groups[1]) and homenet == irc.name
+        query = irc.to_lower(groups[1])
+        def check(irc, slogin, homenet):
+            return slogin == query and homenet == irc.name
     else:
         # Third or fourth scenario. If there are more than 3 groups, the rest are ignored.
         # In other words: Return True if the user is logged in, the query matches either '*' or the
         # user's login, and the user is connected on the network requested.
-        return slogin and (irc.to_lower(groups[1]) in ('*', slogin)) and (homenet == groups[2])
+        query = irc.to_lower(groups[1])
+        netname = groups[2]
+        def check(irc, slogin, homenet):
+            return bool(slogin) and query in ('*', slogin) and homenet == netname
+
+    def match(irc, uid):
+        login = _get_services_account(irc, uid)
+        return login is not None and check(irc, *login)
+    return match
 
 @bind
-def ircop(irc, host, uid):
+@compiled
+def ircop(irc, host):
     """
     $ircop exttarget handler. The following forms are supported, with groups separated by a
     literal colon. Oper types are matched case insensitively.
@@ -77,13 +115,15 @@ def ircop(irc, host, uid):
 
     if len(groups) == 1:
         # 1st scenario.
-        return irc.is_oper(uid)
-    else:
-        # 2nd scenario. Match the opertype glob to the opertype.
-        return irc.match_text(groups[1], irc.users[uid].opertype)
+        return lambda irc, uid: irc.is_oper(uid)
+
+    # 2nd scenario. Match the opertype glob to the opertype.
+    matcher = utils._compile_glob(irc.to_lower(groups[1]))
+    return lambda irc, uid: bool(matcher(irc.to_lower(irc.users[uid].opertype)))
 
 @bind
-def server(irc, host, uid):
+@compiled
+def server(irc, host):
     """
     $server exttarget handler. The following forms are supported, with groups separated by a
     literal colon. Server names are matched case insensitively, but SIDs ARE case sensitive.
@@ -95,16 +135,21 @@ def server(irc, host, uid):
     groups = host.split(':')
     log.debug('(%s) exttargets.server: groups to match: %s', irc.name, groups)
 
-    if len(groups) >= 2:
+    if len(groups) < 2:
+        # $server alone is invalid. Don't match anything.
+        return _match_none
+
+    query = groups[1]
+    matcher = utils._compile_glob(irc.to_lower(query))
+    def match(irc, uid):
         sid = irc.get_server(uid)
-        query = groups[1]
         # Return True if the SID matches the query or the server's name glob matches it.
-        return sid == query or irc.match_text(query, irc.get_friendly_name(sid))
-    # $server alone is invalid. Don't match anything.
-    return False
+        return sid == query or bool(matcher(irc.to_lower(irc.get_friendly_name(sid))))
+    return match
 
 @bind
-def channel(irc, host, uid):
+@compiled
+def channel(irc, host):
     """
     $channel exttarget handler. The following forms are supported, with groups separated by a
     literal colon. Channel names are matched case insensitively.
@@ -119,21 +164,25 @@ def channel(irc, host, uid):
     try:
         channel = groups[1]
     except IndexError:  # No channel given, abort.
-        return False
-
-    if channel not in irc.channels:
-        # Channel doesn't even exist...
-        return False
+        return _match_none
 
     if len(groups) == 2:
         # Just #channel was given as query
-        return uid in irc.channels[channel].users
-    elif len(groups) >= 3:
+        def match(irc, uid):
+            chanobj = irc.channels.get(channel)
+            return chanobj is not None and uid in chanobj.users
+    else:
         # For things like #channel:op, check if the query is in the user's prefix modes.
-        return (uid in irc.channels[channel].users) and (groups[2].lower() in irc.channels[channel].get_prefix_modes(uid))
+        prefix = groups[2].lower()
+        def match(irc, uid):
+            chanobj = irc.channels.get(channel)
+            return chanobj is not None and uid in chanobj.users and \
+                prefix in chanobj.get_prefix_modes(uid)
+    return match
 
 @bind
-def pylinkacc(irc, host, uid):
+@compiled
+def pylinkacc(irc, host):
     """
     $pylinkacc (PyLink account) exttarget handler. The following forms are supported, with groups
     separated by a literal colon. Account matching is case insensitive.
@@ -141,19 +190,21 @@ def pylinkacc(irc, host, uid):
     $pylinkacc -> Returns True if the target is logged in to PyLink.
     $pylinkacc:accountname -> Returns True if the target's PyLink login matches the one given.
     """
-    login = irc.to_lower(irc.users[uid].account)
     groups = list(map(irc.to_lower, host.split(':')))
     log.debug('(%s) exttargets.pylinkacc: groups to match: %s', irc.name, groups)
 
     if len(groups) == 1:
         # First scenario. Return True if user is logged in.
-        return bool(login)
+        return lambda irc, uid: bool(irc.users[uid].account)
     elif len(groups) == 2:
         # Second scenario. Return True if the user's login matches the one given.
-        return login == groups[1]
+        query = groups[1]
+        return lambda irc, uid: irc.to_lower(irc.users[uid].account) == query
+    return _match_none
 
 @bind
-def network(irc, host, uid):
+@compiled
+def network(irc, host):
     """
     $network exttarget handler. This exttarget takes one argument: a network name, and returns
     a match for all users on that network.
@@ -163,19 +214,21 @@ def network(irc, host, uid):
     try:
         targetnet = host.split(':')[1]
     except IndexError:  # No network arg given, bail.
-        return False
-
-    userobj = irc.users[uid]
-    if hasattr(userobj, 'remote'):
-        # User is a PyLink Relay client; set the correct network name.
-        homenet = userobj.remote[0]
-    else:
-        homenet = irc.name
-
-    return homenet == targetnet
+        return _match_none
+
+    def match(irc, uid):
+        userobj = irc.users[uid]
+        if hasattr(userobj, 'remote'):
+            # User is a PyLink Relay client; set the correct network name.
+            homenet = userobj.remote[0]
+        else:
+            homenet = irc.name
+        return homenet == targetnet
+    return match
 
 # Note: "and" can't be a function name so we use this.
-def exttarget_and(irc, host, uid):
+@compiled
+def exttarget_and(irc, host):
     """
     $and exttarget handler. This exttarget takes a series of exttargets (or hostmasks) joined with
     a "+", and returns True if all sub exttargets match.
@@ -189,17 +242,19 @@ def exttarget_and(irc, host, uid):
     targets = host.split(':', 1)[-1]
     # For readability, this requires that the exttarget list be wrapped in brackets.
     if not (targets.startswith('(') and targets.endswith(')')):
-        return False
+        return _match_none
 
     targets = targets[1:-1]
     targets = list(filter(None, targets.split('+')))
     log.debug('exttargets_and: using raw subtargets list %r (original query=%r)', targets, host)
-    # Wrap every subtarget into irc.match_host and return True if all subtargets return True.
-    return all(map(lambda sub_exttarget: irc.match_host(sub_exttarget, uid), targets))
+    # Compile every subtarget like irc.match_host() does, and return True if all subtargets match.
+    subtargets = [irc.compile_mask(sub_exttarget) for sub_exttarget in targets]
+    return lambda irc, uid: all(subtarget.match(irc, uid) for subtarget in subtargets)
 world.exttarget_handlers['and'] = exttarget_and
 
 @bind
-def realname(irc, host, uid):
+@compiled
+def realname(irc, host):
     """
     $realname exttarget handler. This takes one argument: a glob, which is compared case-insensitively to the user's real name.
 
@@ -207,11 +262,15 @@ def realname(irc, host, uid):
     $realname:*James* -> matches anyone with "James" in their real name.
     """
     groups = host.split(':')
-    if len(groups) >= 2:
-        return irc.match_text(groups[1], irc.users[uid].realname)
+    if len(groups) < 2:
+        return _match_none
+
+    matcher = utils._compile_glob(irc.to_lower(groups[1]))
+    return lambda irc, uid: bool(matcher(irc.to_lower(irc.users[uid].realname)))
 
 @bind
-def service(irc, host, uid):
+@compiled
+def service(irc, host):
     """
     $service exttarget handler. This takes one optional argument: a glob, which is compared case-insensitively to the target user's service name (if present).
 
@@ -219,11 +278,14 @@ def service(irc, host, uid):
     $service -> Matches any PyLink service bot.
     $service:automode -> Matches the Automode service bot.
     """
-    if not irc.users[uid].service:
-        return False
-
     groups = host.split(':')
+    matcher = utils._compile_glob(irc.to_lower(groups[1])) if len(groups) >= 2 else None
 
-    if len(groups) >= 2:
-        return irc.match_text(groups[1], irc.users[uid].service)
-    return True  # It *is* a service bot because of the check at the top.
+    def match(irc, uid):
+        service = irc.users[uid].service
+        if not service:
+            return False
+        elif matcher is not None:
+            return bool(matcher(irc.to_lower(service)))
+        return True  # It *is* a service bot because of the check at the top.
+    return match
@@ -13,34 +13,59 @@ __all__ = ['default_permissions', 'add_default_permissions',
 # Global variables: these store mappings of hostmasks/exttargets to lists of permissions each target has.
 default_permissions = defaultdict(set)
 
+# The merged permissions table (configured permissions plus defaults) is compiled once per
+# rehash or change to the default permissions. This tracks the objects it was compiled from.
+_table_source = None
+_defaults_version = 0
+
+# Maps network names to (casemapping, {permission: (MaskSet, volatile)}) pairs. Each MaskSet holds
+# the hosts granted a permission on that network, so a check is one MaskSet lookup.
+_compiled = {}
+
+# Maps network names to {UID: (PyLink account, {permission: result})} dicts of cached check results.
+# These are invalidated by the hooks at the bottom of this module.
+_decisions = defaultdict(dict)
+_hits = _misses = 0
+
+# Exttargets that depend on state that can change without a hook being called (e.g. PyLink's own
+# mode changes), so results involving them aren't cached.
+_VOLATILE_EXTTARGETS = ('$channel',)
+
+def _clear_cache():
+    """Clears the compiled permissions table and all cached results."""
+    global _table_source
+    _table_source = None
+    _compiled.clear()
+    _decisions.clear()
 
 def add_default_permissions(perms):
     """Adds default permissions to the index."""
-    global default_permissions
+    global default_permissions, _defaults_version
     for target, permlist in perms.items():
         default_permissions[target] |= set(permlist)
+    _defaults_version += 1
 addDefaultPermissions = add_default_permissions
 
 def remove_default_permissions(perms):
     """Remove default permissions from the index."""
-    global default_permissions
+    global default_permissions, _defaults_version
     for target, permlist in perms.items():
         default_permissions[target] -= set(permlist)
+    _defaults_version += 1
 removeDefaultPermissions = remove_default_permissions
 
-def check_permissions(irc, uid, perms, also_show=[]):
-    """
-    Checks permissions of the caller. If the caller has any of the permissions listed in perms,
-    this function returns True. Otherwise, NotAuthorizedError is raised.
-    """
-    # For old (< 1.1 login blocks):
-    # If the user is logged in, they automatically have all permissions.
-    olduser = conf.conf['login'].get('user')
-    if olduser and irc.match_host('$pylinkacc:%s' % olduser, uid):
-        log.debug('permissions: overriding permissions check for old-style admin user %s',
-                  irc.get_hostmask(uid))
-        return True
+def _check_table():
+    """Drops the compiled permissions table and cached results if the permissions changed."""
+    global _table_source
+    source = (conf.conf.get('permissions'), conf.conf.get('permissions_merge_defaults', True),
+              conf.conf['login'].get('user'), _defaults_version)
+    # The permissions block is compared by identity: a rehash always loads a new one.
+    if _table_source is None or any(old is not new for old, new in zip(_table_source, source)):
+        _clear_cache()
+        _table_source = source
 
+def _get_permissions():
+    """Returns the merged permissions table: a dict mapping hosts to sets of permissions."""
     permissions = defaultdict(set)
     # Enumerate the configured permissions list.
     for k, v in (conf.conf.get('permissions') or {}).items():
@@ -50,18 +75,125 @@ def check_permissions(irc, uid, perms, also_show=[]):
     if conf.conf.get('permissions_merge_defaults', True):
         for k, v in default_permissions.items():
             permissions[k] |= v
+    return permissions
+
+def _compile_permission(irc, perm):
+    """
+    Returns a (MaskSet, volatile) pair for the hosts granted the given permission on the network.
+    """
+    casemapping, compiled = _compiled.get(irc.name, (None, None))
+    if casemapping != irc.casemapping:
+        # Permission globs are matched case insensitively, so start over if the casemapping changes.
+        compiled = {}
+        _compiled[irc.name] = (irc.casemapping, compiled)
+
+    try:
+        return compiled[perm]
+    except KeyError:
+        pass
+
+    hosts = []
+    for host, permlist in _get_permissions().items():
+        # Use irc.match_host to expand globs in an IRC-case insensitive and wildcard
+        # friendly way. e.g. 'xyz.*.#Channel\' will match 'xyz.manage.#channel|' on IRCds
+        # using the RFC1459 casemapping.
+        if any(irc.match_host(permglob, perm) for permglob in permlist):
+            hosts.append(host)
+
+    volatile = any(exttarget in host for host in hosts for exttarget in _VOLATILE_EXTTARGETS)
+    compiled[perm] = result = (utils.MaskSet(irc, hosts), volatile)
+    return result
+
+def _check_permission(irc, uid, perm, olduser):
+    """Returns whether the user has the given permission, without using the result cache."""
+    # For old (< 1.1 login blocks):
+    # If the user is logged in, they automatically have all permissions.
+    if olduser and irc.match_host('$pylinkacc:%s' % olduser, uid):
+        log.debug('permissions: overriding permissions check for old-style admin user %s',
+                  irc.get_hostmask(uid))
+        return True
 
-    for host, permlist in permissions.items():
-        log.debug('permissions: permlist for %s: %s', host, permlist)
-        if irc.match_host(host, uid):
-            # Now, iterate over all the perms we are looking for.
-            for perm in permlist:
-                # Use irc.match_host to expand globs in an IRC-case insensitive and wildcard
-                # friendly way. e.g. 'xyz.*.#Channel\' will match 'xyz.manage.#channel|' on IRCds
-                # using the RFC1459 casemapping.
-                log.debug('permissions: checking if %s glob matches anything in %s', perm, permlist)
-                if any(irc.match_host(perm, p) for p in perms):
-                    return True
+    masks, _ = _compile_permission(irc, perm)
+    matches = masks.match(uid)
+    if matches:
+        log.debug('permissions: %s is granted %s by %s', uid, perm, matches[0][0])
+    return bool(matches)
+
+def check_permissions(irc, uid, perms, also_show=[]):
+    """
+    Checks permissions of the caller. If the caller has any of the permissions listed in perms,
+    this function returns True. Otherwise, NotAuthorizedError is raised.
+    """
+    global _hits, _misses
+    _check_table()
+    olduser = conf.conf['login'].get('user')
+
+    userobj = irc.users.get(uid)
+    # Our own clients' state is changed without hooks being called, so don't cache their results.
+    if userobj is None or irc.is_internal_client(uid):
+        cache = None
+    else:
+        # PyLink logins don't call hooks either, so results are only kept for the same account.
+        account, cache = _decisions[irc.name].get(uid, (None, None))
+        if account != userobj.account:
+            cache = {}
+            _decisions[irc.name][uid] = (userobj.account, cache)
+
+    for perm in perms:
+        if cache is not None and perm in cache:
+            _hits += 1
+            result = cache[perm]
+        else:
+            _misses += 1
+            result = _check_permission(irc, uid, perm, olduser)
+            if cache is not None and not _compile_permission(irc, perm)[1]:
+                cache[perm] = result
+
+        if result:
+            return True
     raise utils.NotAuthorizedError("You are missing one of the following permissions: %s" %
                                    (', '.join(perms+also_show)))
 checkPermissions = check_permissions
+
+def get_stats():
+    """Returns a dict of permission check cache statistics."""
+    lookups = _hits + _misses
+    return {'users': sum(len(users) for users in _decisions.copy().values()),
+            'hits': _hits, 'misses': _misses, 'hit_rate': _hits / lookups if lookups else 0.0}
+
+def _invalidate(irc, *uids):
+    """Drops cached permission check results for the given users."""
+    decisions = _decisions.get(irc.name)
+    if decisions:
+        for uid in uids:
+            decisions.pop(uid, None)
+
+def handle_source_change(irc, source, command, args):
+    """Drops cached results for a user whose nick, oper status or services account changed."""
+    _invalidate(irc, source)
+for hook in ('NICK', 'CLIENT_OPERED', 'CLIENT_SERVICES_LOGIN', 'PYLINK_RELAY_SERVICES_LOGIN', 'QUIT'):
+    utils.add_hook(handle_source_change, hook)
+
+def handle_target_change(irc, source, command, args):
+    """Drops cached results for a user whose host, ident, real name or user modes changed."""
+    _invalidate(irc, args['target'])
+for hook in ('CHGHOST', 'CHGIDENT', 'CHGNAME', 'KILL', 'SAVE'):
+    utils.add_hook(handle_target_change, hook)
+
+def handle_mode(irc, source, command, args):
+    """Drops cached results for a user whose user modes changed (e.g. deopering)."""
+    # Results that depend on channel modes ($channel exttargets) are never cached.
+    if args['target'] in irc.users:
+        _invalidate(irc, args['target'])
+utils.add_hook(handle_mode, 'MODE')
+
+def handle_squit(irc, source, command, args):
+    """Drops cached results for users lost in a netsplit."""
+    _invalidate(irc, *args['users'])
+utils.add_hook(handle_squit, 'SQUIT')
+
+def handle_disconnect(irc, source, command, args):
+    """Drops all cached results for a disconnected network."""
+    _decisions.pop(irc.name, None)
+    _compiled.pop(irc.name, None)
+utils.add_hook(handle_disconnect, 'PYLINK_DISCONNECT')
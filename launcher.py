@@ -21,7 +21,7 @@ def _main():
     conf.load_conf(args.config)
 
     from pylinkirc.log import log
-    from pylinkirc import classes, utils, coremods, selectdriver
+    from pylinkirc import classes, utils, coremods
 
     # Write and check for an existing PID file unless specifically told not to.
     if not args.no_pid:
@@ -127,6 +127,15 @@ def _main():
         with open(pidfile, 'w') as f:
             f.write(str(os.getpid()))
 
+    # Pick the socket driver; this can't be changed without a restart.
+    driver = conf.conf['pylink'].get('socket_driver', 'select')
+    if driver not in classes.SOCKET_DRIVERS:
+        log.error('Invalid socket driver %r in pylink::socket_driver; valid options include: %s',
+                  driver, ', '.join(sorted(classes.SOCKET_DRIVERS)))
+        sys.exit(1)
+    world.socket_driver = driver
+    log.debug('Using socket driver %r', driver)
+
     # Load configured plugins
     to_load = conf.conf['plugins']
     utils._reset_module_dirs()
@@ -163,7 +172,7 @@ def _main():
 
     world.started.set()
     log.info("Loaded plugins: %s", ', '.join(sorted(world.plugins.keys())))
-    selectdriver.start()
+    classes._get_socket_driver().start()
 
 def main():
     import argparse
@@ -42,6 +42,17 @@ log.addHandler(world.console_handler)
 # the root logger. https://stackoverflow.com/questions/16624695
 log.setLevel(1)
 
+def debug_enabled():
+    """
+    Returns whether any log handler will output debug messages. Because of the above, the logger
+    itself always builds log records, so hot code paths should check this before calling
+    log.debug().
+    """
+    for handler in log.handlers:
+        if handler.level <= logging.DEBUG:
+            return True
+    return False
+
 def _make_file_logger(filename, level=None):
     """
     Initializes a file logging target with the given filename and level.
@@ -23,6 +23,9 @@ datastore = structures.JSONDataStore('automode', dbname, default_db=collections.
 
 db = datastore.store
 
+# Caches MaskSets for each DB entry, used by match().
+mask_sets = {}
+
 # The default set of Automode permissions.
 default_permissions = {"$ircop": ['automode.manage.relay_owned', 'automode.sync.relay_owned',
                                   'automode.list']}
@@ -93,6 +96,17 @@ def _check_automode_access(irc, uid, channel, command):
             return True
         raise
 
+def _get_mask_set(irc, channel, dbentry):
+    """
+    Returns a MaskSet of the masks in the given channel's DB entry, reusing the previous one if the
+    entry's masks haven't changed. Modes are always looked up in the DB entry itself.
+    """
+    key = irc.name+channel
+    masks = mask_sets.get(key)
+    if masks is None or masks.irc is not irc or masks.masks.keys() != dbentry.keys():
+        masks = mask_sets[key] = utils.MaskSet(irc, dbentry.keys())
+    return masks
+
 def match(irc, channel, uids=None):
     """
     Set modes on matching users. If uids is not given, check all users in the channel and give
@@ -115,14 +129,15 @@ def match(irc, channel, uids=None):
     # If UIDs are given, match those. Otherwise, match all users in the given channel.
     uids = uids or irc.channels[channel].users
 
-    for mask, modes in dbentry.items():
-        for uid in uids:
-            if irc.match_host(mask, uid):
-                # User matched a mask. Filter the mode list given to only those that are valid
-                # prefix mode characters.
-                outgoing_modes += [('+'+mode, uid) for mode in modes if mode in irc.prefixmodes]
-                log.debug("(%s) automode: Filtered mode list of %s to %s (protocol:%s)",
-                          irc.name, modes, outgoing_modes, irc.protoname)
+    masks = _get_mask_set(irc, channel, dbentry)
+    for uid in uids:
+        for mask, _ in masks.match(uid):
+            # User matched a mask. Filter the mode list given to only those that are valid
+            # prefix mode characters.
+            modes = dbentry[mask]
+            outgoing_modes += [('+'+mode, uid) for mode in modes if mode in irc.prefixmodes]
+            log.debug("(%s) automode: Filtered mode list of %s to %s (protocol:%s)",
+                      irc.name, modes, outgoing_modes, irc.protoname)
 
     if outgoing_modes:
         # If the Automode bot is missing, send the mode through the PyLink server.
@@ -10,6 +10,19 @@ from pylinkirc.log import log
 # Characters allowed in a hostname.
 allowed_chars = string.ascii_letters + '-./:' + string.digits
 
+# Caches the MaskSet of configured hosts for each network, used by _changehost().
+mask_sets = {}
+
+def _get_mask_set(irc, hosts):
+    """
+    Returns a MaskSet of the given changehost::hosts block, reusing the previous one for the
+    network if the block hasn't changed.
+    """
+    masks = mask_sets.get(irc.name)
+    if masks is None or masks.irc is not irc or masks.masks != hosts:
+        masks = mask_sets[irc.name] = utils.MaskSet(irc, hosts)
+    return masks
+
 def _changehost(irc, target):
     changehost_conf = conf.conf.get("changehost")
 
@@ -43,34 +56,33 @@ def _changehost(irc, target):
 
     log.debug('(%s) Changehost args: %s', irc.name, args)
 
-    for host_glob, host_template in changehost_hosts.items():
-        log.debug('(%s) Changehost: checking mask %s', irc.name, host_glob)
-        if irc.match_host(host_glob, target, ip=match_ip, realhost=match_realhosts):
-            log.debug('(%s) Changehost matched mask %s', irc.name, host_glob)
-            # This uses template strings for simple substitution:
-            # https://docs.python.org/3/library/string.html#template-strings
-            template = string.Template(host_template)
-
-            # Substitute using the fields provided the hook data. This means
-            # that the following variables are available for substitution:
-            # $uid, $ts, $nick, $realhost, $ident, and $ip.
-            try:
-                new_host = template.substitute(args)
-            except KeyError as e:
-                log.warning('(%s) Bad expansion %s in template %s' % (irc.name, e, host_template))
-                continue
-
-            # Replace characters that are not allowed in hosts with "-".
-            for char in new_host:
-                if char not in allowed_chars:
-                    new_host = new_host.replace(char, '-')
-
-            # Only send a host change if something has changed
-            if new_host != irc.users[target].host:
-                irc.update_client(target, 'HOST', new_host)
-
-            # Only operate on the first match.
-            break
+    masks = _get_mask_set(irc, changehost_hosts)
+    for host_glob, host_template in masks.match(target, ip=match_ip, realhost=match_realhosts):
+        log.debug('(%s) Changehost matched mask %s', irc.name, host_glob)
+        # This uses template strings for simple substitution:
+        # https://docs.python.org/3/library/string.html#template-strings
+        template = string.Template(host_template)
+
+        # Substitute using the fields provided the hook data. This means
+        # that the following variables are available for substitution:
+        # $uid, $ts, $nick, $realhost, $ident, and $ip.
+        try:
+            new_host = template.substitute(args)
+        except KeyError as e:
+            log.warning('(%s) Bad expansion %s in template %s' % (irc.name, e, host_template))
+            continue
+
+        # Replace characters that are not allowed in hosts with "-".
+        for char in new_host:
+            if char not in allowed_chars:
+                new_host = new_host.replace(char, '-')
+
+        # Only send a host change if something has changed
+        if new_host != irc.users[target].host:
+            irc.update_client(target, 'HOST', new_host)
+
+        # Only operate on the first match.
+        break
 
 def handle_uid(irc, sender, command, args):
     """
@@ -1,14 +1,16 @@
 # relay.py: PyLink Relay plugin
 import base64
+import functools
 import inspect
 import string
+import sys
 import threading
 import time
 from collections import defaultdict
 
-from pylinkirc import conf, structures, utils, world
+from pylinkirc import classes, conf, structures, utils, world
 from pylinkirc.coremods import permissions
-from pylinkirc.log import log
+from pylinkirc.log import debug_enabled, log
 
 CHANNEL_DELINKED_MSG = "Channel delinked."
 RELAY_UNLOADED_MSG = "Relay plugin unloaded."
@@ -27,10 +29,16 @@ else:
     USE_UNIDECODE = conf.conf.get('relay', {}).get('use_unidecode', True)
 
 ### GLOBAL (statekeeping) VARIABLES
-relayusers = defaultdict(dict)
+relayusers = {}
+# Secondary index of relayusers: maps network names to the (network, UID) pairs in relayusers that
+# either originate from the network or have a relay client on it.
+relayusers_by_net = defaultdict(set)
 relayservers = defaultdict(dict)
 spawnlocks = defaultdict(threading.Lock)
 spawnlocks_servers = defaultdict(threading.Lock)
+# Locks client spawns on each target network, since several relay burst threads can introduce
+# clients on the same network at once (see spawn_relay_user()).
+spawnlocks_targets = defaultdict(threading.Lock)
 
 # Claim bounce cache to prevent kick/mode/topic loops
 __claim_bounce_timeout = conf.conf.get('relay', {}).get('claim_bounce_timeout', 5)
@@ -41,6 +49,15 @@ dbname = conf.get_database_name('pylinkrelay')
 datastore = structures.PickleDataStore('pylinkrelay', dbname)
 db = datastore.store
 
+# Reverse index of the relay DB: maps (network, channel) pairs of leaf channels to the
+# (network, channel) pair of the relay they are linked to.
+relay_links = {}
+
+# Cached relay fan-out plans: maps (relay entry, source network name) pairs to lists of
+# (remote network object, remote channel, relay server SID) targets.
+relay_plans = {}
+relay_plans_lock = threading.Lock()
+
 default_permissions = {"*!*@*": ['relay.linked'],
                        "$ircop": ['relay.linkacl*']}
 default_oper_permissions = {"$ircop": ['relay.create', 'relay.destroy', 'relay.link',
@@ -48,20 +65,162 @@ default_oper_permissions = {"$ircop": ['relay.create', 'relay.destroy', 'relay.l
 
 ### INTERNAL FUNCTIONS
 
+def _rebuild_relay_links():
+    """Rebuilds the leaf channel index from the relay DB."""
+    relay_links.clear()
+    for entry, entrydata in db.items():
+        for link in entrydata['links']:
+            relay_links[link] = entry
+    log.debug('relay: indexed %s leaf channels across %s relays', len(relay_links), len(db))
+
+def _add_relay_user(userpair, netname, uid):
+    """Records uid as the relay client for the (network, UID) pair userpair on netname."""
+    relayusers.setdefault(userpair, {})[netname] = uid
+    relayusers_by_net[userpair[0]].add(userpair)
+    relayusers_by_net[netname].add(userpair)
+
+def _remove_relay_user(userpair, netname):
+    """Forgets the relay client for the (network, UID) pair userpair on netname."""
+    del relayusers[userpair][netname]
+    if netname != userpair[0]:
+        relayusers_by_net[netname].discard(userpair)
+
+def _remove_relay_users(userpair):
+    """Forgets all relay clients for the (network, UID) pair userpair."""
+    for netname in relayusers.pop(userpair, ()):
+        relayusers_by_net[netname].discard(userpair)
+    relayusers_by_net[userpair[0]].discard(userpair)
+
+def _clear_relay_plans():
+    """Invalidates all cached relay fan-out plans."""
+    with relay_plans_lock:
+        relay_plans.clear()
+
+def _add_link(entry, link):
+    """Adds a leaf channel pair to the given relay entry."""
+    db[entry]['links'].add(link)
+    relay_links[link] = entry
+    _clear_relay_plans()
+
+def _remove_link(entry, link):
+    """Removes a leaf channel pair from the given relay entry."""
+    db[entry]['links'].discard(link)
+    if relay_links.get(link) == entry:
+        del relay_links[link]
+    _clear_relay_plans()
+
+def _remove_relay(entry):
+    """Removes a relay entry and all of its leaf channels from the relay DB."""
+    for link in db.pop(entry)['links']:
+        if relay_links.get(link) == entry:
+            del relay_links[link]
+    _clear_relay_plans()
+
+def _plan_burst(irc):
+    """
+    Plans a relay burst for the given IRC object. Returns a tuple of all relay channels on the
+    network, and a dict mapping each connected remote network name to a list of
+    (local channel, remote channel) pairs shared with it.
+    """
+    channels = set()
+    targets = defaultdict(list)
+    for chanpair, entrydata in db.copy().items():
+        members = [chanpair, *entrydata['links']]
+
+        # Initialize all channels that are relevant to the called network (i.e. channels either hosted there or a relay leaf channels)
+        for network, channel in members:
+            if network != irc.name:
+                continue
+            channels.add(channel)
+
+            for remotenet, remotechan in members:
+                remoteirc = world.networkobjects.get(remotenet)
+                # Skip remote networks without an IRC object (e.g. they were removed from the
+                # config), or that aren't ready yet.
+                if remotenet == irc.name or remoteirc is None or not remoteirc.connected.is_set():
+                    continue
+                targets[remotenet].append((channel, remotechan))
+    return channels, targets
+
+def _burst_network(irc, remoteirc, chanpairs):
+    """
+    Bursts the given (local channel, remote channel) pairs between irc and remoteirc: relay clients
+    for both sides are introduced first, followed by the joins for each channel.
+    """
+    started = time.time()
+
+    # This is a batch-like event, so fetch the relay server SIDs for both sides only once.
+    rsid = get_relay_server_sid(remoteirc, irc)
+    remote_rsid = get_relay_server_sid(irc, remoteirc)
+
+    # Introduce every relay client needed for the shared channels.
+    spawned = 0
+    for sourceirc, targetirc, sid, sourcechans in ((irc, remoteirc, rsid, [c[0] for c in chanpairs]),
+                                                   (remoteirc, irc, remote_rsid, [c[1] for c in chanpairs])):
+        users = set()
+        for channel in sourcechans:
+            if channel in sourceirc.channels:
+                users |= sourceirc.channels[channel].users
+
+        for user in users:
+            if user in sourceirc.users and not is_relay_client(sourceirc, user) and \
+                    get_remote_user(sourceirc, targetirc, user, reuse_sid=sid):
+                spawned += 1
+
+    # Then join them to each shared channel.
+    for channel, remotechan in chanpairs:
+        # Join their (remote) users and set their modes, if applicable.
+        if remotechan in remoteirc.channels:
+            rc = remoteirc.channels[remotechan]
+            relay_joins(remoteirc, remotechan, rc.users, rc.ts, targetirc=irc, reuse_sid=remote_rsid)
+
+            # Only update the topic if it's different from what we already have,
+            # and topic bursting is complete.
+            if rc.topicset and rc.topic != irc.channels[channel].topic:
+                irc.topic_burst(irc.sid, channel, rc.topic)
+
+        # Send our users and channel modes to the other net.
+        if channel in irc.channels:
+            c = irc._channels[channel]
+            relay_joins(irc, channel, c.users, c.ts, targetirc=remoteirc, reuse_sid=rsid)
+
+    log.info('(%s) relay: burst %s channel(s) and %s relay client(s) with %s in %.3f seconds',
+             irc.name, len(chanpairs), spawned, remoteirc.name, time.time() - started)
+
+def _burst_network_thread(irc, remoteirc, chanpairs):
+    """Runs _burst_network() in a relay burst thread, logging any errors."""
+    try:
+        _burst_network(irc, remoteirc, chanpairs)
+    except Exception:
+        log.exception('(%s) relay: failed to burst channels %s with %s', irc.name,
+                      [chanpair[0] for chanpair in chanpairs], remoteirc.name)
+
 def initialize_all(irc):
     """Initializes all relay channels for the given IRC object."""
 
     def _initialize_all():
-        for chanpair, entrydata in db.items():
-            network, channel = chanpair
+        started = time.time()
+        channels, targets = _plan_burst(irc)
+        log.debug('(%s) relay.initialize_all: planned burst to %s', irc.name,
+                  {netname: len(chanpairs) for netname, chanpairs in targets.items()})
+
+        # Burst to each remote network in parallel.
+        threads = []
+        for netname, chanpairs in targets.items():
+            t = threading.Thread(target=_burst_network_thread, daemon=True,
+                                 args=(irc, world.networkobjects[netname], chanpairs),
+                                 name='relay burst thread from network %r to %r' % (irc.name, netname))
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
 
-            # Initialize all channels that are relevant to the called network (i.e. channels either hosted there or a relay leaf channels)
-            if network == irc.name:
-                initialize_channel(irc, channel)
-            for link in entrydata['links']:
-                network, channel = link
-                if network == irc.name:
-                    initialize_channel(irc, channel)
+        if 'pylink' in world.services:
+            for channel in channels:
+                world.services['pylink'].add_persistent_channel(irc, 'relay', channel)
+
+        log.info('(%s) relay: finished bursting %s channel(s) to %s network(s) in %.3f seconds',
+                 irc.name, len(channels), len(targets), time.time() - started)
 
     t = threading.Thread(target=_initialize_all, daemon=True,
                          name='relay initialize_all thread from network %r' % irc.name)
@@ -71,6 +230,7 @@ def main(irc=None):
     """Main function, called during plugin loading at start."""
     log.debug('relay.main: loading links database')
     datastore.load()
+    _rebuild_relay_links()
 
     permissions.add_default_permissions(default_permissions)
 
@@ -114,6 +274,8 @@ def die(irc=None):
     # 2) Clear our internal servers and users caches.
     relayservers.clear()
     relayusers.clear()
+    relayusers_by_net.clear()
+    _clear_relay_plans()
 
     # 3) Unload our permissions.
     permissions.remove_default_permissions(default_permissions)
@@ -133,6 +295,9 @@ IRC_ASCII_ALLOWED_CHARS = string.digits + string.ascii_letters + '/^|\\-_[]{}`'
 FALLBACK_SEPARATOR = '|'
 FALLBACK_CHARACTER = '-'
 
+# Maximum amount of normalized nicks to cache
+NICK_CACHE_SIZE = 8192
+
 def _replace_special(text):
     """
     Replaces brackets and spaces by similar IRC-representable characters.
@@ -149,18 +314,16 @@ def _sanitize(text, extrachars=''):
             text = text.replace(char, FALLBACK_CHARACTER)
     return text
 
-def normalize_nick(irc, netname, nick, times_tagged=0, uid=''):
+@functools.lru_cache(maxsize=NICK_CACHE_SIZE)
+def _normalize_nick_base(casemapping, encoding, keep_slashes, netname, nick):
     """
-    Creates a normalized nickname for the given nick suitable for introduction to a remote network
-    (as a relay client).
+    Runs the parts of nick normalization that only depend on the target network's casemapping,
+    encoding and slash support, and on the source network name and nick.
 
-    UID is optional for checking regular nick changes, to make sure that the sender doesn't get
-    marked as nick-colliding with itself.
+    Returns a tuple of the nick (for forcetag matching), the sanitized nick (before truncation
+    and tagging), and the normalized network name.
     """
-    if irc.has_cap('freeform-nicks'):  # ☺
-        return nick
-
-    is_unicode_capable = irc.casemapping in ('utf8', 'utf-8', 'rfc7700')
+    is_unicode_capable = casemapping in ('utf8', 'utf-8', 'rfc7700')
     if USE_UNIDECODE and not is_unicode_capable:
         decoded_nick = unidecode.unidecode(nick).strip()
         netname = unidecode.unidecode(netname).strip()
@@ -170,46 +333,18 @@ def normalize_nick(irc, netname, nick, times_tagged=0, uid=''):
             # XXX: The decoded version of the nick is empty, YUCK!
             # Base64 the nick for now, since (interestingly) we don't enforce UIDs to always be
             # ASCII strings.
-            nick = base64.b64encode(nick.encode(irc.encoding, 'replace'), altchars=b'[]')
+            nick = base64.b64encode(nick.encode(encoding, 'replace'), altchars=b'[]')
             nick = nick.decode()
 
     # Normalize spaces to hyphens, () => []
     nick = _replace_special(nick)
     netname = _replace_special(netname)
-
-    # Get the nick/net separator
-    separator = irc.serverdata.get('separator') or \
-        conf.conf.get('relay', {}).get('separator') or "/"
-
-    # Figure out whether we tag nicks or not.
-    if times_tagged == 0:
-        # Check the following options in order, before falling back to True:
-        #  1) servers::<netname>::relay_tag_nicks
-        #  2) relay::tag_nicks
-        if irc.serverdata.get('relay_tag_nicks', conf.conf.get('relay', {}).get('tag_nicks', True)):
-            times_tagged = 1
-        else:
-            forcetag_nicks = set(conf.conf.get('relay', {}).get('forcetag_nicks', []))
-            forcetag_nicks |= set(irc.serverdata.get('relay_forcetag_nicks', []))
-            log.debug('(%s) relay.normalize_nick: checking if globs %s match %s.', irc.name, forcetag_nicks, nick)
-            for glob in forcetag_nicks:
-                if irc.match_text(glob, nick):
-                    # User matched a nick to force tag nicks for. Tag them.
-                    times_tagged = 1
-                    break
-
-    log.debug('(%s) relay.normalize_nick: using %r as separator.', irc.name, separator)
     orig_nick = nick
-    maxnicklen = irc.maxnicklen
 
     # Charybdis, IRCu, etc. don't allow / in nicks, and will SQUIT with a protocol
     # violation if it sees one. Or it might just ignore the client introduction and
     # cause bad desyncs.
-    protocol_allows_slashes = irc.has_cap('slash-in-nicks') or \
-        irc.serverdata.get('relay_force_slashes')
-
-    if '/' not in separator or not protocol_allows_slashes:
-        separator = separator.replace('/', FALLBACK_SEPARATOR)
+    if not keep_slashes:
         nick = nick.replace('/', FALLBACK_SEPARATOR)
 
     # Loop over every character in the nick, making sure that it only contains valid
@@ -231,6 +366,12 @@ def normalize_nick(irc, netname, nick, times_tagged=0, uid=''):
         # Nicks starting with - are likewise not valid.
         nick = '_' + nick[1:]
 
+    return orig_nick, nick, netname
+
+def _tag_nick(nick, netname, separator, times_tagged, maxnicklen):
+    """
+    Truncates the given sanitized nick to maxnicklen, adding a network tag if times_tagged >= 1.
+    """
     # Maximum allowed length that relay nicks may have, minus the /network tag if used.
     allowedlength = maxnicklen
 
@@ -246,23 +387,76 @@ def normalize_nick(irc, netname, nick, times_tagged=0, uid=''):
     nick = nick[:allowedlength]
     if times_tagged >= 1:
         nick += suffix
+    return nick
+
+def normalize_nick(irc, netname, nick, times_tagged=0, uid=''):
+    """
+    Creates a normalized nickname for the given nick suitable for introduction to a remote network
+    (as a relay client).
 
-    while irc.nick_to_uid(nick) not in (None, uid):
+    UID is optional for checking regular nick changes, to make sure that the sender doesn't get
+    marked as nick-colliding with itself.
+    """
+    if irc.has_cap('freeform-nicks'):  # ☺
+        return nick
+
+    # Get the nick/net separator
+    separator = irc.serverdata.get('separator') or \
+        conf.conf.get('relay', {}).get('separator') or "/"
+    protocol_allows_slashes = irc.has_cap('slash-in-nicks') or \
+        irc.serverdata.get('relay_force_slashes')
+    keep_slashes = '/' in separator and bool(protocol_allows_slashes)
+
+    orig_nick, nick, netname = _normalize_nick_base(irc.casemapping, irc.encoding, keep_slashes,
+                                                    netname, nick)
+
+    # Figure out whether we tag nicks or not.
+    if times_tagged == 0:
+        # Check the following options in order, before falling back to True:
+        #  1) servers::<netname>::relay_tag_nicks
+        #  2) relay::tag_nicks
+        if irc.serverdata.get('relay_tag_nicks', conf.conf.get('relay', {}).get('tag_nicks', True)):
+            times_tagged = 1
+        else:
+            forcetag_nicks = set(conf.conf.get('relay', {}).get('forcetag_nicks', []))
+            forcetag_nicks |= set(irc.serverdata.get('relay_forcetag_nicks', []))
+            log.debug('(%s) relay.normalize_nick: checking if globs %s match %s.', irc.name, forcetag_nicks, orig_nick)
+            for glob in forcetag_nicks:
+                if irc.match_text(glob, orig_nick):
+                    # User matched a nick to force tag nicks for. Tag them.
+                    times_tagged = 1
+                    break
+
+    debug = debug_enabled()
+    if debug:
+        log.debug('(%s) relay.normalize_nick: using %r as separator.', irc.name, separator)
+    if not keep_slashes:
+        separator = separator.replace('/', FALLBACK_SEPARATOR)
+
+    maxnicklen = irc.maxnicklen
+    newnick = _tag_nick(nick, netname, separator, times_tagged, maxnicklen)
+
+    bynick = irc.users.bynick
+    while True:
+        uids = bynick.get(irc.to_lower(newnick))
+        if not uids or uids[-1] == uid:
+            break
         # The nick we want exists: Increase the separator length by 1 if the user was already
         # tagged, but couldn't be created due to a nick conflict. This can happen when someone
         # steals a relay user's nick.
         # However, if a user is changing from, say, a long, cut-off nick to another long, cut-off
         # nick, we would skip tagging the nick twice if they originate from the same UID.
         times_tagged += 1
-        log.debug('(%s) relay.normalize_nick: nick %r is in use; incrementing times tagged to %s.',
-                  irc.name, nick, times_tagged)
-        nick = normalize_nick(irc, netname, orig_nick, times_tagged=times_tagged, uid=uid)
+        if debug:
+            log.debug('(%s) relay.normalize_nick: nick %r is in use; incrementing times tagged to %s.',
+                      irc.name, newnick, times_tagged)
+        newnick = _tag_nick(nick, netname, separator, times_tagged, maxnicklen)
 
-    finalLength = len(nick)
+    finalLength = len(newnick)
     assert finalLength <= maxnicklen, "Normalized nick %r went over max " \
-        "nick length (got: %s, allowed: %s!)" % (nick, finalLength, maxnicklen)
+        "nick length (got: %s, allowed: %s!)" % (newnick, finalLength, maxnicklen)
 
-    return nick
+    return newnick
 
 def normalize_host(irc, host):
     """Creates a normalized hostname for the given host suitable for
@@ -339,6 +533,7 @@ def spawn_relay_server(irc, remoteirc):
 
         # Assign the newly spawned server as our relay server for the target net.
         relayservers[irc.name][remoteirc.name] = sid
+        _clear_relay_plans()
 
         return sid
     else:
@@ -389,6 +584,23 @@ def _has_common_pool(sourcenet, targetnet, namespace):
             return True
     return False
 
+def _intern(text):
+    """Interns the given text if it is a string."""
+    return sys.intern(text) if isinstance(text, str) else text
+
+class RelayClient(classes.User):
+    """
+    Compact User class for relay clients. Strings that are repeated across many clients (server
+    SIDs, idents, hosts, IPs) are interned.
+    """
+    __slots__ = ('remote',)
+
+    def __init__(self, irc, nick, ts, uid, server, ident='null', host='null',
+                 realname='PyLink dummy client', realhost='null', ip='0.0.0.0', **kwargs):
+        super().__init__(irc, nick, ts, uid, _intern(server), ident=_intern(ident),
+                         host=_intern(host), realname=realname, realhost=_intern(realhost),
+                         ip=_intern(ip), **kwargs)
+
 def spawn_relay_user(irc, remoteirc, user, times_tagged=0, reuse_sid=None):
     """
     Spawns a relay user representing "user" from "irc" (the local network) on remoteirc (the target network).
@@ -399,8 +611,6 @@ def spawn_relay_user(irc, remoteirc, user, times_tagged=0, reuse_sid=None):
         # been connected yet... Oh well!
         return
 
-    nick = normalize_nick(remoteirc, irc.name, userobj.nick, times_tagged=times_tagged)
-
     # Sanitize UTF8 for networks that don't support it
     ident = _sanitize(userobj.ident, extrachars='~')
 
@@ -441,7 +651,7 @@ def spawn_relay_user(irc, remoteirc, user, times_tagged=0, reuse_sid=None):
         rsid = get_relay_server_sid(remoteirc, irc)
         if not rsid:
             log.debug('(%s) spawn_relay_user: aborting user spawn for %s/%s @ %s (failed to retrieve a '
-                      'working SID).', irc.name, user, nick, remoteirc.name)
+                      'working SID).', irc.name, user, userobj.nick, remoteirc.name)
             return
 
     # This is the legacy (< 2.0-beta1) control for relay IP sharing
@@ -462,11 +672,18 @@ def spawn_relay_user(irc, remoteirc, user, times_tagged=0, reuse_sid=None):
         realhost = None
         ip = '0.0.0.0'
 
-    u = remoteirc.spawn_client(nick, ident=ident, host=host, realname=realname, modes=modes,
-                               opertype=opertype, server=rsid, ip=ip, realhost=realhost).uid
+    userpair = (irc.name, user)
+    # Spawns on the same target network must be serialized, so that the nick collision check and
+    # the target's UID generator don't race. This lock is always taken last (i.e. while holding
+    # spawnlocks[irc.name]) and is only held here.
+    with spawnlocks_targets[remoteirc.name]:
+        nick = normalize_nick(remoteirc, irc.name, userobj.nick, times_tagged=times_tagged)
+        u = remoteirc.spawn_client(nick, ident=ident, host=host, realname=realname, modes=modes,
+                                   opertype=opertype, server=rsid, ip=ip, realhost=realhost,
+                                   user_class=RelayClient).uid
     try:
-        remoteirc.users[u].remote = (irc.name, user)
-        remoteirc.users[u].opertype = opertype
+        remoteirc.users[u].remote = userpair
+        remoteirc.users[u].opertype = _intern(opertype)
         away = userobj.away
         if away:
             remoteirc.away(u, away)
@@ -476,7 +693,7 @@ def spawn_relay_user(irc, remoteirc, user, times_tagged=0, reuse_sid=None):
         # invalid nick, etc.
         raise
 
-    relayusers[(irc.name, user)][remoteirc.name] = u
+    _add_relay_user(userpair, remoteirc.name, u)
     return u
 
 def get_remote_user(irc, remoteirc, user, spawn_if_missing=True, times_tagged=0, reuse_sid=None):
@@ -565,9 +782,7 @@ def get_relay(irc, channel):
     if chanpair in db:  # This chanpair is a shared channel; others link to it
         return chanpair
     # This chanpair is linked *to* a remote channel
-    for name, dbentry in db.items():
-        if chanpair in dbentry['links']:
-            return name
+    return relay_links.get(chanpair)
 
 def get_remote_channel(irc, remoteirc, channel):
     """Returns the linked channel name for the given channel on remoteirc,
@@ -584,6 +799,33 @@ def get_remote_channel(irc, remoteirc, channel):
             if link[0] == remotenetname:
                 return link[1]
 
+def get_relay_targets(irc, channel):
+    """
+    Returns the fan-out plan for the given channel on irc: a list of (remote network object,
+    remote channel, relay server SID) tuples for every connected network sharing the channel.
+    The relay server SID is None if one hasn't been spawned yet.
+    """
+    relay = get_relay(irc, channel)
+    if relay is None:
+        return []
+
+    key = (relay, irc.name)
+    with relay_plans_lock:
+        if key in relay_plans:
+            return relay_plans[key]
+
+        targets = []
+        for netname, remotechan in [relay, *db[relay]['links']]:
+            remoteirc = world.networkobjects.get(netname)
+            if netname == irc.name or remoteirc is None or not remoteirc.connected.is_set():
+                continue
+            targets.append((remoteirc, remotechan, relayservers.get(netname, {}).get(irc.name)))
+
+        log.debug('(%s) relay: caching fan-out plan for %s%s: %s', irc.name, relay[0], relay[1],
+                  [(remoteirc.name, remotechan, rsid) for remoteirc, remotechan, rsid in targets])
+        relay_plans[key] = targets
+        return targets
+
 def initialize_channel(irc, channel):
     """Initializes a relay channel (merge local/remote users, set modes, etc.)."""
 
@@ -664,7 +906,7 @@ def remove_channel(irc, channel):
                     irc.part(user, channel, CHANNEL_DELINKED_MSG)
                     if user != irc.pseudoclient.uid and not irc.users[user].channels:
                         remoteuser = get_orig_user(irc, user)
-                        del relayusers[remoteuser][irc.name]
+                        _remove_relay_user(remoteuser, irc.name)
                         irc.quit(user, 'Left all shared channels.')
 
 def _claim_should_bounce(irc, channel):
@@ -798,6 +1040,20 @@ def iterate_all(origirc, func, extra_args=(), kwargs=None):
 
         func(origirc, remoteirc, *extra_args, **kwargs)
 
+def iterate_relay(origirc, channel, func, extra_args=(), kwargs=None):
+    """
+    Runs the given function 'func' on all connected networks sharing the given channel with
+    origirc. 'func' must take at least four arguments: the original network object, the remote
+    network object, the remote channel name, and the SID of the relay server representing
+    origirc on the remote network (or None if one hasn't been spawned yet).
+    """
+    if kwargs is None:
+        kwargs = {}
+
+    for remoteirc, remotechan, rsid in get_relay_targets(origirc, channel):
+        if remoteirc.connected.is_set():
+            func(origirc, remoteirc, remotechan, rsid, *extra_args, **kwargs)
+
 def iterate_all_present(origirc, origuser, func, extra_args=(), kwargs=None):
     """
     Runs the given function 'func' on all networks where the UID 'origuser'
@@ -809,16 +1065,16 @@ def iterate_all_present(origirc, origuser, func, extra_args=(), kwargs=None):
     if kwargs is None:
         kwargs = {}
 
-    for netname, user in relayusers[(origirc.name, origuser)].copy().items():
+    for netname, user in relayusers.get((origirc.name, origuser), {}).copy().items():
         remoteirc = world.networkobjects[netname]
         func(origirc, remoteirc, user, *extra_args, **kwargs)
 
 ### EVENT HANDLER INTERNALS
 
-def relay_joins(irc, channel, users, ts, targetirc=None, **kwargs):
+def relay_joins(irc, channel, users, ts, targetirc=None, reuse_sid=None, **kwargs):
     """
     Relays one or more users' joins from a channel to its relay links. If targetirc is given, only burst
-    to that specific network.
+    to that specific network, optionally reusing the given relay server SID.
     """
 
     log.debug('(%s) relay.relay_joins: called on %r with users %r, targetirc=%s', irc.name, channel,
@@ -831,20 +1087,11 @@ def relay_joins(irc, channel, users, ts, targetirc=None, **kwargs):
 
     claim_passed = check_claim(irc, channel, irc.uplink)
 
-    def _relay_joins_loop(irc, remoteirc, channel, users, ts, burst=True):
+    def _relay_joins_loop(irc, remoteirc, remotechan, rsid, channel, users, ts, burst=True):
         queued_users = []
 
-        if not remoteirc.connected.is_set():
-            return  # Remote network is not ready yet.
-
-        remotechan = get_remote_channel(irc, remoteirc, channel)
-        if remotechan is None:
-            # If there is no link on the current network for the channel in question,
-            # just skip it.
-            return
-
         # This is a batch-like event, so try to reuse a relay server SID as much as possible.
-        rsid = get_relay_server_sid(remoteirc, irc)
+        rsid = rsid or get_relay_server_sid(remoteirc, irc)
 
         for user in users.copy():
             if is_relay_client(irc, user):
@@ -941,9 +1188,12 @@ def relay_joins(irc, channel, users, ts, targetirc=None, **kwargs):
             remoteirc.call_hooks([rsid, 'PYLINK_RELAY_JOIN', {'channel': remotechan, 'users': [u[-1] for u in queued_users]}])
 
     if targetirc:
-        _relay_joins_loop(irc, targetirc, channel, users, ts, **kwargs)
+        remotechan = get_remote_channel(irc, targetirc, channel)
+        # Skip networks that aren't ready yet, or that have no link for the channel in question.
+        if targetirc.connected.is_set() and remotechan is not None:
+            _relay_joins_loop(irc, targetirc, remotechan, reuse_sid, channel, users, ts, **kwargs)
     else:
-        iterate_all(irc, _relay_joins_loop, extra_args=(channel, users, ts), kwargs=kwargs)
+        iterate_relay(irc, channel, _relay_joins_loop, extra_args=(channel, users, ts), kwargs=kwargs)
 
 def relay_part(irc, *args, **kwargs):
     """
@@ -976,7 +1226,7 @@ def relay_part(irc, *args, **kwargs):
         # If the relay client no longer has any channels, quit them to prevent inflating /lusers.
         if is_relay_client(remoteirc, remoteuser) and not remoteirc.users[remoteuser].channels:
             remoteirc.quit(remoteuser, 'Left all shared channels.')
-            del relayusers[(irc.name, user)][remoteirc.name]
+            _remove_relay_user((irc.name, user), remoteirc.name)
 
     iterate_all(irc, _relay_part_loop, extra_args=args, kwargs=kwargs)
 
@@ -1399,7 +1649,7 @@ def handle_quit(irc, numeric, command, args):
                 pass
 
         iterate_all_present(irc, numeric, _handle_quit_func)
-        del relayusers[(irc.name, numeric)]
+        _remove_relay_users((irc.name, numeric))
 
 utils.add_hook(handle_quit, 'QUIT')
 
@@ -1415,10 +1665,11 @@ def handle_squit(irc, numeric, command, args):
         sname = args['name']
         remotenet = sname.split('.', 1)[0]
         del relayservers[irc.name][remotenet]
+        _clear_relay_plans()
 
-        for userpair in relayusers:
-            if userpair[0] == remotenet and irc.name in relayusers[userpair]:
-                del relayusers[userpair][irc.name]
+        for userpair in relayusers_by_net[remotenet].copy():
+            if userpair[0] == remotenet and irc.name in relayusers.get(userpair, {}):
+                _remove_relay_user(userpair, irc.name)
 
         remoteirc = world.networkobjects[remotenet]
         initialize_all(remoteirc)
@@ -1486,7 +1737,7 @@ def handle_part(irc, numeric, command, args):
 
             if not remoteirc.users[user].channels:
                 remoteirc.quit(user, 'Left all shared channels.')
-                del relayusers[(irc.name, numeric)][remoteirc.name]
+                _remove_relay_user((irc.name, numeric), remoteirc.name)
         iterate_all_present(irc, numeric, _handle_part_loop)
 
 utils.add_hook(handle_part, 'PART')
@@ -1520,7 +1771,7 @@ def handle_messages(irc, numeric, command, args):
         return
 
     relay = get_relay(irc, target)
-    remoteusers = relayusers[(irc.name, numeric)]
+    remoteusers = relayusers.get((irc.name, numeric), {})
 
     avail_prefixes = {v: k for k, v in irc.prefixmodes.items()}
     prefixes = []
@@ -1534,13 +1785,10 @@ def handle_messages(irc, numeric, command, args):
               irc.name, args['target'], prefixes, target)
 
     if irc.is_channel(target):
-        def _handle_messages_loop(irc, remoteirc, numeric, command, args, notice,
+        def _handle_messages_loop(irc, remoteirc, real_target, rsid, numeric, command, args, notice,
                                   target, text, msgprefixes):
-            real_target = get_remote_channel(irc, remoteirc, target)
-
-            # Don't relay anything back to the source net, or to disconnected networks
-            # and networks without a relay for this channel.
-            if (not real_target) or (not irc.connected.is_set()):
+            # Don't relay anything from disconnected networks.
+            if not irc.connected.is_set():
                 return
 
             orig_msgprefixes = msgprefixes
@@ -1591,7 +1839,7 @@ def handle_messages(irc, numeric, command, args):
                 # possible - most IRCds except TS6 (charybdis, ratbox, hybrid)
                 # allow this.
                 try:
-                    user = get_relay_server_sid(remoteirc, irc, spawn_if_missing=False) \
+                    user = (rsid or get_relay_server_sid(remoteirc, irc, spawn_if_missing=False)) \
                         if notice else remoteirc.pseudoclient.uid
                     if not user:
                         return
@@ -1627,8 +1875,8 @@ def handle_messages(irc, numeric, command, args):
                             "trying to send a message through it!", irc.name,
                             remoteirc.name, user)
                 return
-        iterate_all(irc, _handle_messages_loop,
-                    extra_args=(numeric, command, args, notice, target, text, prefixes))
+        iterate_relay(irc, target, _handle_messages_loop,
+                      extra_args=(numeric, command, args, notice, target, text, prefixes))
 
     else:
         # Get the real user that the PM was meant for
@@ -1753,7 +2001,7 @@ def handle_kick(irc, source, command, args):
 
         # If the target isn't on any channels, quit them.
         if remoteirc != irc and (not remoteirc.users[real_target].channels) and not origuser:
-            del relayusers[(irc.name, target)][remoteirc.name]
+            _remove_relay_user((irc.name, target), remoteirc.name)
             remoteirc.quit(real_target, 'Left all shared channels.')
 
     # Kick was a relay client but sender does not pass CLAIM restrictions. Bounce a rejoin unless we've reached our limit.
@@ -1786,7 +2034,7 @@ def handle_kick(irc, source, command, args):
     iterate_all(irc, _handle_kick_loop, extra_args=(source, command, args))
 
     if origuser and not irc.users[target].channels:
-        del relayusers[origuser][irc.name]
+        _remove_relay_user(origuser, irc.name)
         irc.quit(target, 'Left all shared channels.')
 
 utils.add_hook(handle_kick, 'KICK')
@@ -1824,17 +2072,14 @@ def handle_mode(irc, numeric, command, args):
     target = args['target']
     modes = args['modes']
 
-    def _handle_mode_loop(irc, remoteirc, numeric, command, target, modes):
+    def _handle_mode_loop(irc, remoteirc, remotechan, rsid, numeric, command, target, modes):
         if irc.is_channel(target):
-            remotechan = get_remote_channel(irc, remoteirc, target)
-            if not remotechan:
-                return
             supported_modes = get_supported_cmodes(irc, remoteirc, target, modes)
 
             # Check if the sender is a user with a relay client; otherwise relay the mode
             # from the corresponding server.
             remotesender = get_remote_user(irc, remoteirc, numeric, spawn_if_missing=False) or \
-                get_relay_server_sid(remoteirc, irc) or remoteirc.sid
+                rsid or get_relay_server_sid(remoteirc, irc) or remoteirc.sid
 
             if not remoteirc.has_cap('can-spawn-clients'):
                 if numeric in irc.servers and not irc.servers[numeric].has_eob:
@@ -1963,7 +2208,10 @@ def handle_mode(irc, numeric, command, args):
             irc.apply_modes(target, reversed_modes)
 
     if modes:
-        iterate_all(irc, _handle_mode_loop, extra_args=(numeric, command, target, modes))
+        if irc.is_channel(target):
+            iterate_relay(irc, target, _handle_mode_loop, extra_args=(numeric, command, target, modes))
+        else:
+            iterate_all(irc, _handle_mode_loop, extra_args=(None, None, numeric, command, target, modes))
 
 utils.add_hook(handle_mode, 'MODE')
 
@@ -1973,15 +2221,11 @@ def handle_topic(irc, numeric, command, args):
     topic = args['text']
 
     if check_claim(irc, channel, numeric):
-        def _handle_topic_loop(irc, remoteirc, numeric, command, args):
-            channel = args['channel']
-            oldtopic = args.get('oldtopic')
+        def _handle_topic_loop(irc, remoteirc, remotechan, rsid, numeric, command, args):
             topic = args['text']
 
-            remotechan = get_remote_channel(irc, remoteirc, channel)
-
             # Don't send if the remote topic is the same as ours.
-            if remotechan is None or remotechan not in remoteirc.channels or \
+            if remotechan not in remoteirc.channels or \
                     topic == remoteirc.channels[remotechan].topic:
                 return
 
@@ -1990,9 +2234,9 @@ def handle_topic(irc, numeric, command, args):
             if remoteuser:
                 remoteirc.topic(remoteuser, remotechan, topic)
             else:
-                rsid = get_relay_server_sid(remoteirc, irc)
+                rsid = rsid or get_relay_server_sid(remoteirc, irc)
                 remoteirc.topic_burst(rsid, remotechan, topic)
-        iterate_all(irc, _handle_topic_loop, extra_args=(numeric, command, args))
+        iterate_relay(irc, channel, _handle_topic_loop, extra_args=(numeric, command, args))
 
     elif oldtopic and _claim_should_bounce(irc, channel):  # Topic change blocked by claim.
         irc.topic_burst(irc.sid, channel, oldtopic)
@@ -2013,7 +2257,7 @@ def handle_kill(irc, numeric, command, args):
 
     # Target user was remote:
     if realuser and realuser[0] != irc.name:
-        del relayusers[realuser][irc.name]
+        _remove_relay_user(realuser, irc.name)
         fwd_reason = 'KILL FWD from %s/%s: %s' % (irc.get_friendly_name(numeric), irc.name, args['text'])
 
         origirc = world.networkobjects[realuser[0]]
@@ -2035,7 +2279,7 @@ def handle_kill(irc, numeric, command, args):
 
             iterate_all(irc, _relay_kill_loop)
 
-            del relayusers[realuser]
+            _remove_relay_users(realuser)
         else:
             # Otherwise, forward kills as kicks where applicable.
             for homechan in origirc.users[realuser[1]].channels.copy():
@@ -2131,6 +2375,8 @@ utils.add_hook(handle_invite, 'INVITE')
 
 def handle_endburst(irc, numeric, command, args):
     if numeric == irc.uplink:
+        # The network is now connected; rebuild fan-out plans to include it.
+        _clear_relay_plans()
         initialize_all(irc)
 utils.add_hook(handle_endburst, "ENDBURST")
 
@@ -2152,11 +2398,12 @@ def handle_disconnect(irc, numeric, command, args):
     log.debug('(%s) Grabbing spawnlocks[%s] from thread %r in function %r', irc.name, irc.name,
               threading.current_thread().name, inspect.currentframe().f_code.co_name)
     with spawnlocks[irc.name]:
-        for k, v in relayusers.copy().items():
-            if irc.name in v:
-                del relayusers[k][irc.name]
-            if k[0] == irc.name:
-                del relayusers[k]
+        for userpair in relayusers_by_net[irc.name].copy():
+            if userpair[0] == irc.name:
+                _remove_relay_users(userpair)
+            else:
+                relayusers.get(userpair, {}).pop(irc.name, None)
+        del relayusers_by_net[irc.name]
     # SQUIT all relay pseudoservers spawned for us, and remove them
     # from our relay subservers index.
     log.debug('(%s) Grabbing spawnlocks_servers[%s] from thread %r in function %r', irc.name, irc.name,
@@ -2183,6 +2430,9 @@ def handle_disconnect(irc, numeric, command, args):
         except KeyError:  # Already removed; ignore.
             pass
 
+    # Drop this network from every cached fan-out plan.
+    _clear_relay_plans()
+
     # Announce the disconnects to every leaf channel where the disconnected network is the owner
     announcement = conf.conf.get('relay', {}).get('disconnect_announcement')
     log.debug('(%s) relay: last connection successful: %s', irc.name, args.get('was_successful'))
@@ -2392,7 +2642,7 @@ def destroy(irc, source, args):
     entry = (network, channel)
     if entry in db:
         stop_relay(entry)
-        del db[entry]
+        _remove_relay(entry)
 
         log.info('(%s) relay: Channel %s destroyed by %s.', irc.name,
                  channel, irc.get_hostmask(source))
@@ -2422,14 +2672,14 @@ def purge(irc, source, args):
         if entry[0] == network:
             count += 1
             stop_relay(entry)
-            del db[entry]
+            _remove_relay(entry)
         else:
             # Drop leaf channels involving the target network
             for link in db[entry]['links'].copy():
                 if link[0] == network:
                     count += 1
                     remove_channel(world.networkobjects.get(network), link[1])
-                    db[entry]['links'].remove(link)
+                    _remove_link(entry, link)
 
     irc.reply("Done. Purged %s entries involving the network %s." % (count, network))
 
@@ -2542,7 +2792,7 @@ def link(irc, source, args):
                           "override this with the --force option)." % (localchan, our_ts, their_ts, localchan))
                 return
 
-        entry['links'].add((irc.name, localchan))
+        _add_link((remotenet, channel), (irc.name, localchan))
         log.info('(%s) relay: Channel %s linked to %s%s by %s.', irc.name,
                  localchan, remotenet, args.channel, irc.get_hostmask(source))
         initialize_channel(irc, localchan)
@@ -2582,13 +2832,13 @@ def delink(irc, source, args):
                 for link in db[entry]['links'].copy():
                     if link[0] == remotenet:
                         remove_channel(world.networkobjects.get(remotenet), link[1])
-                        db[entry]['links'].remove(link)
+                        _remove_link(entry, link)
         elif remotenet:
             irc.error('You can only use this delink syntax from the network that owns this channel.')
             return
         else:
             remove_channel(irc, channel)
-            db[entry]['links'].remove((irc.name, channel))
+            _remove_link(entry, (irc.name, channel))
         irc.reply('Done.')
         log.info('(%s) relay: Channel %s delinked from %s%s by %s.', irc.name,
                  channel, entry[0], entry[1], irc.get_hostmask(source))
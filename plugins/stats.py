@@ -4,7 +4,7 @@ stats.py: Simple statistics for PyLink IRC Services.
 import datetime
 import time
 
-from pylinkirc import conf, utils, world
+from pylinkirc import conf, selectdriver, utils, world
 from pylinkirc.coremods import permissions
 from pylinkirc.log import log
 
@@ -70,10 +70,130 @@ def uptime(irc, source, args):
                   )
                  )
 
+@utils.add_cmd
+def shards(irc, source, args):
+    """takes no arguments.
+
+    Shows the networks and load of each selector driver shard (thread)."""
+    permissions.check_permissions(irc, source, ['stats.shards'])
+
+    if world.socket_driver != 'select':
+        irc.error("Selector shards are not used by the %r socket driver." % world.socket_driver)
+        return
+
+    uptime = max(time.time() - world.start_ts, 1)
+    for shard in selectdriver.get_stats():
+        irc.reply("Shard \x02%s\x02: %s read events, %.1f%% busy; networks: %s" %
+                  (shard['shard'], shard['events'], shard['busy'] / uptime * 100,
+                   ', '.join(shard['networks']) or '(none)'), private=True)
+
+@utils.add_cmd
+def casefoldstats(irc, source, args):
+    """[<network> / --all]
+
+    Shows casefolding cache statistics for the given network (or the current network if not specified).
+    The --all argument can also be given to show statistics for all networks."""
+    permissions.check_permissions(irc, source, ['stats.casefoldstats'])
+
+    network = args[0] if args else irc.name
+    if network == '--all':
+        ircobjs = world.networkobjects.copy()
+    elif network in world.networkobjects:
+        ircobjs = {network: world.networkobjects[network]}
+    else:
+        irc.error("No such network %r." % network)
+        return
+
+    for netname, ircobj in sorted(ircobjs.items()):
+        casefolder = getattr(ircobj, '_casefolder', None)
+        if casefolder is None:
+            continue
+        stats = casefolder.get_stats()
+        irc.reply("\x02%s\x02 (%s): %d/%d cached, %d hits, %d misses (%.1f%% hit rate)" %
+                  (netname, stats['casemapping'], stats['size'], stats['maxsize'], stats['hits'],
+                   stats['misses'], stats['hit_rate'] * 100), private=True)
+
+@utils.add_cmd
+def permstats(irc, source, args):
+    """takes no arguments.
+
+    Shows permission check cache statistics."""
+    permissions.check_permissions(irc, source, ['stats.permstats'])
+
+    stats = permissions.get_stats()
+    irc.reply("Permission checks: %d users cached, %d hits, %d misses (%.1f%% hit rate)" %
+              (stats['users'], stats['hits'], stats['misses'], stats['hit_rate'] * 100), private=True)
+
+def _format_timing_stats(stats, limit=None):
+    """
+    Returns a list of formatted lines for the given timing stats dict (world.hook_stats or
+    world.command_stats), sorted by cumulative run time.
+    """
+    lines = []
+    for (module, funcname, name), timing in sorted(stats.copy().items(), key=lambda item: item[1].total,
+                                                   reverse=True)[:limit]:
+        lines.append('%s.%s (%s): %d calls, %.3fs total, %.1fms max, %.1fms p99' %
+                     (module.rsplit('.', 1)[-1], funcname, name, timing.count, timing.total,
+                      timing.max * 1000, timing.percentile(99) * 1000))
+    return lines
+
+@utils.add_cmd
+def hookstats(irc, source, args):
+    """[hooks/commands/unhandled] [<limit>] / reset
+
+    Shows timing statistics for the hook functions (the default) or commands taking the most time,
+    up to the given limit (defaults to 10). "reset" clears all recorded statistics.
+    Statistics are only recorded when the pylink::hook_profiling option is enabled.
+
+    "unhandled" instead shows the commands received most often on the current network that its
+    protocol module doesn't handle."""
+    permissions.check_permissions(irc, source, ['stats.hookstats'])
+
+    args = list(args)
+    kind = args.pop(0).lower() if args and not args[0].isdigit() else 'hooks'
+
+    if kind == 'reset':
+        world.hook_stats.clear()
+        world.command_stats.clear()
+        for ircobj in world.networkobjects.values():
+            if hasattr(ircobj, 'unhandled_commands'):
+                ircobj.unhandled_commands.clear()
+        irc.reply("Cleared hook, command, and unhandled command statistics.")
+        return
+    elif kind not in ('hooks', 'commands', 'unhandled'):
+        irc.error("Unknown statistics type %r (valid types are: hooks, commands, unhandled, reset)." % kind)
+        return
+
+    try:
+        limit = int(args[0]) if args else 10
+    except ValueError:
+        irc.error("Invalid limit %r." % args[0])
+        return
+
+    if kind == 'unhandled':
+        counter = getattr(irc, 'unhandled_commands', None)
+        if counter is None:
+            irc.error("Network %s doesn't track unhandled commands." % irc.name)
+            return
+        for command, count in counter.most_common(limit):
+            irc.reply("%s: %d" % (command, count), private=True)
+        irc.reply("End of unhandled commands for %s (%d total)." % (irc.name, sum(counter.values())),
+                  private=True)
+        return
+
+    if not conf.conf['pylink'].get('hook_profiling'):
+        irc.reply("Note: hook profiling is currently disabled (pylink::hook_profiling).", private=True)
+
+    lines = _format_timing_stats(world.hook_stats if kind == 'hooks' else world.command_stats, limit)
+    for line in lines:
+        irc.reply(line, private=True)
+    irc.reply("End of %s statistics (%d shown)." % (kind[:-1], len(lines)), private=True)
+
 def handle_stats(irc, source, command, args):
     """/STATS handler. Currently supports the following:
 
     c - link blocks
+    h - hook function timing statistics
     o - oper blocks (accounts)
     u - shows uptime
     """
@@ -119,6 +239,11 @@ def handle_stats(irc, source, command, args):
                 needoper = 'needoper' if accountdata.get('require_oper') else ''
                 _num(243, "O %s * %s :%s" % (hosts, accountname, needoper))
 
+    elif stats_type == 'h':
+        # 249/RPL_STATSDEBUG: ":<text>"
+        for line in _format_timing_stats(world.hook_stats, 20):
+            _num(249, ':%s' % line)
+
     elif stats_type == 'u':
         # 242/RPL_STATSUPTIME: ":Server Up <days> days <hours>:<minutes>:<seconds>"
         _num(242, ':Server Up %s' % timediff(world.start_ts, int(time.time())))
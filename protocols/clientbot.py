@@ -113,7 +113,7 @@ class ClientbotBaseProtocol(PyLinkNetworkCoreWithUtils):
     # Note: clientbot clients are initialized with umode +i by default
     def spawn_client(self, nick, ident='unknown', host='unknown.host', realhost=None, modes={('i', None)},
             server=None, ip='0.0.0.0', realname='', ts=None, opertype=None,
-            manipulatable=False):
+            manipulatable=False, user_class=User):
         """
         STUB: Pretends to spawn a new client with a subset of the given options.
         """
@@ -124,8 +124,8 @@ class ClientbotBaseProtocol(PyLinkNetworkCoreWithUtils):
         ts = ts or int(time.time())
 
         log.debug('(%s) spawn_client stub called, saving nick %s as PUID %s', self.name, nick, uid)
-        u = self.users[uid] = User(self, nick, ts, uid, server, ident=ident, host=host, realname=realname,
-                                   manipulatable=manipulatable, realhost=realhost, ip=ip)
+        u = self.users[uid] = user_class(self, nick, ts, uid, server, ident=ident, host=host, realname=realname,
+                                         manipulatable=manipulatable, realhost=realhost, ip=ip)
         self.servers[server].users.add(uid)
 
         self.apply_modes(uid, modes)
@@ -451,25 +451,11 @@ class ClientbotWrapperProtocol(ClientbotBaseProtocol, IRCCommonProtocol):
 
     def handle_events(self, data):
         """Event handler for the RFC1459/2812 (clientbot) protocol."""
-        data = data.split(" ")
+        tags, sender, command, args = self.parse_message(data)
 
-        tags = self.parse_message_tags(data)
-        if tags:
-            # If we have tags, split off the first argument.
-            data = data[1:]
-
-        try:
-            args = self.parse_prefixed_args(data)
-            sender = args[0]
-            command = args[1]
-            args = args[2:]
-
-        except IndexError:
+        if sender is None:
             # Raw command without an explicit sender; assume it's being sent by our uplink.
-            args = self.parse_args(data)
             idsource = sender = self.uplink
-            command = args[0]
-            args = args[1:]
         else:
             # PyLink as a services framework expects UIDs and SIDs for everything. Since we connect
             # as a bot here, there's no explicit user introduction, so we're going to generate
@@ -493,10 +479,9 @@ class ClientbotWrapperProtocol(ClientbotBaseProtocol, IRCCommonProtocol):
             # Handle IRCv3.2 account-tag.
             self._set_account_name(idsource, tags.get('account'))
 
-        try:
-            func = getattr(self, 'handle_'+command.lower())
-        except AttributeError:  # unhandled command
-            pass
+        func = self._get_command_handler(command)
+        if func is None:  # unhandled command
+            self.unhandled_commands[command] += 1
         else:
             parsed_args = func(idsource, command, args)
             if parsed_args is not None:
@@ -979,7 +964,7 @@ class ClientbotWrapperProtocol(ClientbotBaseProtocol, IRCCommonProtocol):
         # <- :ice MODE ice :+Zi
         target = args[0]
         if self.is_channel(target):
-            oldobj = self._channels[target].deepcopy()
+            oldobj = self._channels[target].snapshot()
         else:
             target = self._get_UID(target, spawn_new=False)
             oldobj = None
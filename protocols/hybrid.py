@@ -95,7 +95,7 @@ class HybridProtocol(TS6Protocol):
 
     def spawn_client(self, nick, ident='null', host='null', realhost=None, modes=set(),
             server=None, ip='0.0.0.0', realname=None, ts=None, opertype=None,
-            manipulatable=False):
+            manipulatable=False, user_class=User):
         """
         Spawns a new client with the given options.
 
@@ -114,7 +114,7 @@ class HybridProtocol(TS6Protocol):
         realhost = realhost or host
         raw_modes = self.join_modes(modes)
 
-        u = self.users[uid] = User(self, nick, ts, uid, server, ident=ident, host=host, realname=realname,
+        u = self.users[uid] = user_class(self, nick, ts, uid, server, ident=ident, host=host, realname=realname,
             realhost=realhost, ip=ip, manipulatable=manipulatable)
 
         self.apply_modes(uid, modes)
@@ -60,7 +60,7 @@ class InspIRCdProtocol(TS6BaseProtocol):
 
     def spawn_client(self, nick, ident='null', host='null', realhost=None, modes=set(),
             server=None, ip='0.0.0.0', realname=None, ts=None, opertype='IRC Operator',
-            manipulatable=False):
+            manipulatable=False, user_class=User):
         """
         Spawns a new client with the given options.
 
@@ -78,9 +78,9 @@ class InspIRCdProtocol(TS6BaseProtocol):
         realname = realname or conf.conf['pylink']['realname']
         realhost = realhost or host
         raw_modes = self.join_modes(modes)
-        u = self.users[uid] = User(self, nick, ts, uid, server, ident=ident, host=host,
-                                   realname=realname, realhost=realhost, ip=ip,
-                                   manipulatable=manipulatable, opertype=opertype)
+        u = self.users[uid] = user_class(self, nick, ts, uid, server, ident=ident, host=host,
+                                         realname=realname, realhost=realhost, ip=ip,
+                                         manipulatable=manipulatable, opertype=opertype)
 
         self.apply_modes(uid, modes)
         self.servers[server].users.add(uid)
@@ -690,7 +690,7 @@ class InspIRCdProtocol(TS6BaseProtocol):
         # insp3:
         # <- :3IN FJOIN #test 1556842195 +nt :o,3INAAAAAA:4
         channel = args[0]
-        chandata = self._channels[channel].deepcopy()
+        chandata = self._channels[channel].snapshot()
         # InspIRCd sends each channel's users in the form of 'modeprefix(es),UID'
         userlist = args[-1].split()
 
@@ -816,7 +816,7 @@ class InspIRCdProtocol(TS6BaseProtocol):
         """Handles the FMODE command, used for channel mode changes."""
         # <- :70MAAAAAA FMODE #chat 1433653462 +hhT 70MAAAAAA 70MAAAAAD
         channel = args[0]
-        oldobj = self._channels[channel].deepcopy()
+        oldobj = self._channels[channel].snapshot()
         modes = args[2:]
         changedmodes = self.parse_modes(channel, modes)
         self.apply_modes(channel, changedmodes)
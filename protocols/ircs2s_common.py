@@ -2,6 +2,8 @@
 ircs2s_common.py: Common base protocol class with functions shared by TS6 and P10-based protocols.
 """
 
+import collections
+import collections.abc
 import re
 import time
 
@@ -9,7 +11,7 @@ from pylinkirc import conf
 from pylinkirc.classes import IRCNetwork, ProtocolError
 from pylinkirc.log import log
 
-__all__ = ['IncrementalUIDGenerator', 'IRCCommonProtocol', 'IRCS2SProtocol']
+__all__ = ['IncrementalUIDGenerator', 'MessageTags', 'IRCCommonProtocol', 'IRCS2SProtocol']
 
 
 class IncrementalUIDGenerator():
@@ -53,12 +55,102 @@ class IncrementalUIDGenerator():
         self.increment()
         return uid
 
+def _unescape_tag(tag):
+    """Unescapes an IRCv3.2 message tag ("key=value" or "key")."""
+    tag = tag.replace('\\s', ' ')
+    tag = tag.replace('\\r', '\r')
+    tag = tag.replace('\\n', '\n')
+    tag = tag.replace('\\:', ';')
+
+    # We want to drop lone \'s but keep \\ as \ ...
+    tag = tag.replace('\\\\', '\x00')
+    tag = tag.replace('\\', '')
+    tag = tag.replace('\x00', '\\')
+    return tag
+
+class MessageTags(collections.abc.Mapping):
+    """
+    Read-only mapping of IRCv3.2 message tags, which keeps the raw tag string (without the
+    leading "@") and only decodes it when it's accessed. Looking up a single key only decodes
+    that tag; iterating over the mapping decodes all of them.
+    """
+    __slots__ = ('_raw', '_tags')
+
+    def __init__(self, raw):
+        self._raw = raw
+        self._tags = None
+
+    def _decode(self):
+        if self._tags is None:
+            self._tags = IRCCommonProtocol._parse_tag_string(self._raw)
+        return self._tags
+
+    def __getitem__(self, key):
+        if self._tags is not None:
+            return self._tags[key]
+
+        # Like in a dict built from the tags, the last occurrence of a key wins.
+        prefix = key + '='
+        value = None
+        for tag in self._raw.split(';'):
+            if tag == key:
+                value = ''
+            elif tag.startswith(prefix):
+                value = tag
+        if value is None:
+            raise KeyError(key)
+        elif value:
+            value = _unescape_tag(value).split('=', 1)[1]
+        return value
+
+    def __iter__(self):
+        return iter(self._decode())
+
+    def __len__(self):
+        return len(self._decode())
+
+    def __bool__(self):
+        return bool(self._raw)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self._raw)
+
 class IRCCommonProtocol(IRCNetwork):
 
     COMMON_PREFIXMODES = [('h', 'halfop'), ('a', 'admin'), ('q', 'owner'), ('y', 'owner')]
 
+    # Maps command names to handler method names; this is filled in for each subclass by
+    # _get_command_handlers() when the first network using it is created.
+    _command_handlers = {}
+
+    # Maximum number of entries in each network's command handler cache. This bounds the memory
+    # used by negative cache entries for junk commands.
+    COMMAND_HANDLER_CACHE_SIZE = 1024
+
+    @classmethod
+    def _get_command_handlers(cls):
+        """
+        Returns the command handler table for this class, building it if this hasn't been done yet.
+        """
+        # Map command names to the handle_* methods defined on this class (including aliases like
+        # handle_354 = handle_352), so that handlers don't have to be looked up by name per line.
+        # This is stored on each class separately so that subclasses don't use their parent's table.
+        if '_command_handlers' not in cls.__dict__:
+            cls._command_handlers = {attr[7:].upper(): attr for attr in dir(cls)
+                                     if attr.startswith('handle_') and callable(getattr(cls, attr))}
+        return cls._command_handlers
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self._get_command_handlers()
+
+        # Caches command names (as received) to bound handler methods, or None for unhandled
+        # commands. This is filled in as commands are received, so that handlers aliased on the
+        # instance in __init__ (e.g. self.handle_squit) are found too.
+        self._command_handler_cache = {}
+
+        # Counts unhandled commands received, by command name.
+        self.unhandled_commands = collections.Counter()
 
         self._caps = {}
         self._use_builtin_005_handling = False  # Disabled by default for greater security
@@ -67,6 +159,21 @@ class IRCCommonProtocol(IRCNetwork):
     def post_connect(self):
         self._caps.clear()
 
+    def _get_command_handler(self, command):
+        """
+        Returns the handler method for the given command, or None if the command is unhandled.
+        """
+        try:
+            return self._command_handler_cache[command]
+        except KeyError:
+            attr = self._command_handlers.get(command.upper(), 'handle_' + command.lower())
+            func = getattr(self, attr, None)
+            if func is None:
+                log.debug('(%s) Ignoring unhandled command %r', self.name, command)
+            if len(self._command_handler_cache) < self.COMMAND_HANDLER_CACHE_SIZE:
+                self._command_handler_cache[command] = func
+            return func
+
     def validate_server_conf(self):
         """Validates that the server block given contains the required keys."""
         for k in self.conf_keys:
@@ -140,6 +247,13 @@ class IRCCommonProtocol(IRCNetwork):
         prefixsearch = re.search(r'\(([A-Za-z]+)\)(.*)', args)
         return dict(zip(prefixsearch.group(1), prefixsearch.group(2)))
 
+    @classmethod
+    def _parse_tag_string(cls, tagstring):
+        """
+        Parses a string of IRCv3.2 message tags (without the leading "@") into a dict.
+        """
+        return cls.parse_isupport([_unescape_tag(tag) for tag in tagstring.split(';')], fallback='')
+
     @classmethod
     def parse_message_tags(cls, data):
         """
@@ -150,23 +264,67 @@ class IRCCommonProtocol(IRCNetwork):
         # Example query:
         # @aaa=bbb;ccc;example.com/ddd=eee :nick!ident@host.com PRIVMSG me :Hello
         if data[0].startswith('@'):
-            tagdata = data[0].lstrip('@').split(';')
-            for idx, tag in enumerate(tagdata):
-                tag = tag.replace('\\s', ' ')
-                tag = tag.replace('\\r', '\r')
-                tag = tag.replace('\\n', '\n')
-                tag = tag.replace('\\:', ';')
-
-                # We want to drop lone \'s but keep \\ as \ ...
-                tag = tag.replace('\\\\', '\x00')
-                tag = tag.replace('\\', '')
-                tag = tag.replace('\x00', '\\')
-                tagdata[idx] = tag
-
-            results = cls.parse_isupport(tagdata, fallback='')
-            return results
+            return cls._parse_tag_string(data[0].lstrip('@'))
         return {}
 
+    @classmethod
+    def parse_message(cls, line):
+        """
+        Splits a raw RFC1459-style line into a (tags, prefix, command, params) tuple in one pass,
+        where tags is a MessageTags mapping of IRCv3.2 message tags (or an empty dict), prefix is
+        the sender prefix without its leading ":" (or None if there isn't one), and params is a
+        list of arguments.
+
+        Like parse_args(), this skips empty arguments caused by repeated spaces, and joins
+        arguments starting with ":" until the end of the line.
+        """
+        length = len(line)
+        pos = 0
+
+        tags = {}
+        if line.startswith('@'):
+            pos = line.find(' ')
+            if pos == -1:
+                pos = length
+            tags = MessageTags(line[1:pos].lstrip('@'))
+            pos += 1
+
+        prefix = None
+        if line.startswith(':', pos):
+            end = line.find(' ', pos)
+            if end == -1:
+                end = length
+            prefix = line[pos+1:end]
+            pos = end + 1
+
+        command = None
+        params = []
+        while pos < length:
+            end = line.find(' ', pos)
+            if end == -1:
+                end = length
+            elif end == pos:  # Empty argument
+                pos += 1
+                continue
+
+            if line[pos] == ':':
+                # ":" is used to begin multi-word arguments that last until the end of the message.
+                arg = line[pos+1:]
+                end = length
+            else:
+                arg = line[pos:end]
+                if not arg.strip():
+                    pos = end + 1
+                    continue
+
+            if command is None:
+                command = arg
+            else:
+                params.append(arg)
+            pos = end + 1
+
+        return tags, prefix, command or '', params
+
     def handle_away(self, source, command, args):
         """Handles incoming AWAY messages."""
         # TS6:
@@ -300,17 +458,10 @@ class IRCS2SProtocol(IRCCommonProtocol):
         Commands sent without an explicit sender prefix will have them set to
         the SID of the uplink server.
         """
-        data = data.split(" ")
+        tags, prefix, raw_command, args = self.parse_message(data)
 
-        tags = self.parse_message_tags(data)
-        if tags:
-            # If we have message tags, split off the first argument.
-            data = data[1:]
-
-        args = self.parse_args(data)
-
-        sender = args[0]
-        sender = sender.lstrip(':')
+        # P10 sends sender prefixes without a leading ":", so those show up as the command here.
+        sender = raw_command if prefix is None else prefix
 
         # If the sender isn't in numeric format, try to convert it automatically.
         sender_sid = self._get_SID(sender)
@@ -322,13 +473,16 @@ class IRCS2SProtocol(IRCCommonProtocol):
         elif sender_uid in self.users:
             # Sender is a user (converting from name to UID gave a valid result).
             sender = sender_uid
-        elif not (args[0].startswith(':')):
+        elif prefix is None:
             # No sender prefix; treat as coming from uplink IRCd.
             sender = self.uplink
-            args.insert(0, sender)
 
-        raw_command = args[1].upper()
-        args = args[2:]
+        if prefix is None and sender in (sender_sid, sender_uid):
+            # This was a bare sender prefix, so the command is the next argument.
+            raw_command = args[0]
+            args = args[1:]
+
+        raw_command = raw_command.upper()
 
         log.debug('(%s) Found message sender as %s, raw_command=%r, args=%r', self.name, sender, raw_command, args)
 
@@ -348,10 +502,9 @@ class IRCS2SProtocol(IRCCommonProtocol):
             args = args[2:]
             log.debug("(%s) Rewriting incoming ENCAP to command %s (args: %s)", self.name, command, args)
 
-        try:
-            func = getattr(self, 'handle_'+command.lower())
-        except AttributeError:  # Unhandled command
-            pass
+        func = self._get_command_handler(command)
+        if func is None:  # Unhandled command
+            self.unhandled_commands[command] += 1
         else:
             parsed_args = func(sender, command, args)
             if parsed_args is not None:
@@ -579,7 +732,7 @@ class IRCS2SProtocol(IRCCommonProtocol):
         # <- ABAAA OM #test +h ABAAA
         target = self._get_UID(args[0])
         if self.is_channel(target):
-            channeldata = self._channels[target].deepcopy()
+            channeldata = self._channels[target].snapshot()
         else:
             channeldata = None
 
@@ -90,7 +90,7 @@ class NgIRCdProtocol(IRCS2SProtocol):
 
     def spawn_client(self, nick, ident='null', host='null', realhost=None, modes=set(),
             server=None, ip='0.0.0.0', realname=None, ts=None, opertype='IRC Operator',
-            manipulatable=False):
+            manipulatable=False, user_class=User):
         """
         Spawns a new client with the given options.
 
@@ -107,10 +107,10 @@ class NgIRCdProtocol(IRCS2SProtocol):
         realname = realname or conf.conf['pylink']['realname']
 
         uid = self._uidgen.next_uid(prefix=nick)
-        userobj = self.users[uid] = User(self, nick, ts or int(time.time()), uid, server,
-                                         ident=ident, host=host, realname=realname,
-                                         manipulatable=manipulatable, opertype=opertype,
-                                         realhost=host)
+        userobj = self.users[uid] = user_class(self, nick, ts or int(time.time()), uid, server,
+                                               ident=ident, host=host, realname=realname,
+                                               manipulatable=manipulatable, opertype=opertype,
+                                               realhost=host)
 
         self.apply_modes(uid, modes)
         self.servers[server].users.add(uid)
@@ -497,7 +497,7 @@ class NgIRCdProtocol(IRCS2SProtocol):
         # <- :ngircd.midnight.local NJOIN #test :tester,@%GL
 
         channel = args[0]
-        chandata = self._channels[channel].deepcopy()
+        chandata = self._channels[channel].snapshot()
         namelist = []
 
         # Reverse the modechar->modeprefix mapping for quicker lookup
@@ -179,6 +179,20 @@ class P10Protocol(IRCS2SProtocol):
     def _send_with_prefix(self, source, text, **kwargs):
         self.send("%s %s" % (source, text), **kwargs)
 
+    def _get_send_command(self, data):
+        # Outgoing P10 lines are prefixed with the sender's numeric (no colon) and use tokens
+        # instead of command names.
+        parts = data.split(' ', 2)
+        if len(parts) > 1 and parts[1] in self.COMMAND_TOKENS:
+            return self.COMMAND_TOKENS[parts[1]]
+        return super()._get_send_command(data)
+
+    def _get_send_source(self, data):
+        parts = data.split(' ', 2)
+        if len(parts) > 1 and parts[1] in self.COMMAND_TOKENS:
+            return parts[0]
+        return super()._get_send_source(data)
+
     @staticmethod
     def access_sort(key):
         """
@@ -276,7 +290,7 @@ class P10Protocol(IRCS2SProtocol):
 
     def spawn_client(self, nick, ident='null', host='null', realhost=None, modes=set(),
             server=None, ip='0.0.0.0', realname=None, ts=None, opertype='IRC Operator',
-            manipulatable=False):
+            manipulatable=False, user_class=User):
         """
         Spawns a new client with the given options.
 
@@ -310,8 +324,8 @@ class P10Protocol(IRCS2SProtocol):
         raw_modes = self.join_modes(modes)
 
         # Initialize an User instance
-        u = self.users[uid] = User(self, nick, ts, uid, server, ident=ident, host=host, realname=realname,
-                                   realhost=realhost, ip=ip, manipulatable=manipulatable, opertype=opertype)
+        u = self.users[uid] = user_class(self, nick, ts, uid, server, ident=ident, host=host, realname=realname,
+                                         realhost=realhost, ip=ip, manipulatable=manipulatable, opertype=opertype)
 
         # Fill in modes and add it to our users index
         self.apply_modes(uid, modes)
@@ -1080,7 +1094,7 @@ class P10Protocol(IRCS2SProtocol):
             return
 
         channel = args[0]
-        chandata = self._channels[channel].deepcopy()
+        chandata = self._channels[channel].snapshot()
 
         bans = []
         if args[-1].startswith('%'):
@@ -1241,7 +1255,7 @@ class P10Protocol(IRCS2SProtocol):
             existing += [(modechar, user) for user in userlist]
 
         # Back up the channel state.
-        oldobj = self._channels[channel].deepcopy()
+        oldobj = self._channels[channel].snapshot()
 
         changedmodes = []
 
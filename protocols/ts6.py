@@ -44,7 +44,7 @@ class TS6Protocol(TS6BaseProtocol):
 
     def spawn_client(self, nick, ident='null', host='null', realhost=None, modes=set(),
             server=None, ip='0.0.0.0', realname=None, ts=None, opertype='IRC Operator',
-            manipulatable=False):
+            manipulatable=False, user_class=User):
         """
         Spawns a new client with the given options.
 
@@ -64,9 +64,9 @@ class TS6Protocol(TS6BaseProtocol):
         ts = ts or int(time.time())
         realname = realname or conf.conf['pylink']['realname']
         raw_modes = self.join_modes(modes)
-        u = self.users[uid] = User(self, nick, ts, uid, server, ident=ident, host=host,
-                                   realname=realname, realhost=realhost or host, ip=ip,
-                                   manipulatable=manipulatable, opertype=opertype)
+        u = self.users[uid] = user_class(self, nick, ts, uid, server, ident=ident, host=host,
+                                         realname=realname, realhost=realhost or host, ip=ip,
+                                         manipulatable=manipulatable, opertype=opertype)
 
         self.apply_modes(uid, modes)
         self.servers[server].users.add(uid)
@@ -500,7 +500,7 @@ class TS6Protocol(TS6BaseProtocol):
         # parameters: channelTS, channel, simple modes, opt. mode parameters..., nicklist
         # <- :0UY SJOIN 1451041566 #channel +nt :@0UYAAAAAB
         channel = args[1]
-        chandata = self._channels[channel].deepcopy()
+        chandata = self._channels[channel].snapshot()
         userlist = args[-1].split()
 
         modestring = args[2:-1] or args[2]
@@ -652,7 +652,7 @@ class TS6Protocol(TS6BaseProtocol):
         # <- :42XAAAAAB TMODE 1437450768 #test -c+lkC 3 agte4
         # <- :0UYAAAAAD TMODE 0 #a +h 0UYAAAAAD
         channel = args[1]
-        oldobj = self._channels[channel].deepcopy()
+        oldobj = self._channels[channel].snapshot()
         modes = args[2:]
         changedmodes = self.parse_modes(channel, modes)
         self.apply_modes(channel, changedmodes)
@@ -102,7 +102,7 @@ class UnrealProtocol(TS6BaseProtocol):
     ### OUTGOING COMMAND FUNCTIONS
     def spawn_client(self, nick, ident='null', host='null', realhost=None, modes=set(),
             server=None, ip='0.0.0.0', realname=None, ts=None, opertype='IRC Operator',
-            manipulatable=False):
+            manipulatable=False, user_class=User):
         """
         Spawns a new client with the given options.
 
@@ -126,7 +126,7 @@ class UnrealProtocol(TS6BaseProtocol):
         modes |= {('+x', None), ('+t', None)}
 
         raw_modes = self.join_modes(modes)
-        u = self.users[uid] = User(self,  nick, ts, uid, server, ident=ident, host=host, realname=realname,
+        u = self.users[uid] = user_class(self,  nick, ts, uid, server, ident=ident, host=host, realname=realname,
             realhost=realhost, ip=ip, manipulatable=manipulatable, opertype=opertype)
         self.apply_modes(uid, modes)
         self.servers[server].users.add(uid)
@@ -627,7 +627,7 @@ class UnrealProtocol(TS6BaseProtocol):
         # <- :001 SJOIN 1444361345 #test :001AAAAAA @001AAAAAB +001AAAAAC
         # <- :001 SJOIN 1483250129 #services +nt :+001OR9V02 @*~001DH6901 &*!*@test "*!*@blah.blah '*!*@yes.no
         channel = args[1]
-        chandata = self._channels[channel].deepcopy()
+        chandata = self._channels[channel].snapshot()
         userlist = args[-1].split()
 
         namelist = []
@@ -758,7 +758,7 @@ class UnrealProtocol(TS6BaseProtocol):
         # Also, we need to get rid of that extra space following the +f argument. :|
         if self.is_channel(args[0]):
             channel = args[0]
-            oldobj = self._channels[channel].deepcopy()
+            oldobj = self._channels[channel].snapshot()
 
             modes = [arg for arg in args[1:] if arg]  # normalize whitespace
             parsedmodes = self.parse_modes(channel, modes)
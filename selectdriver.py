@@ -1,54 +1,262 @@
 """
 Socket handling driver using the selectors module. epoll, kqueue, and devpoll
 are used internally when available.
+
+Networks can be spread across multiple selector threads ("shards") by setting
+pylink::selector_shards, so that one busy network (e.g. a long relay hook chain)
+doesn't stall reads for every other link. Networks are assigned to shards using
+the per-server "selector_shard" option, or by consistent hashing of the network
+name otherwise. Unpinned networks are also periodically moved from the busiest
+shard to the quietest one as their load changes.
 """
 
+import bisect
+import hashlib
 import selectors
 import threading
+import time
 
-from pylinkirc import world
+from pylinkirc import conf, world
 from pylinkirc.log import log
 
-__all__ = ['register', 'unregister', 'start']
+__all__ = ['register', 'unregister', 'start', 'get_stats']
 
 
 SELECT_TIMEOUT = 0.5
 
-selector = selectors.DefaultSelector()
+# Number of points each shard gets on the consistent hash ring.
+HASH_RING_REPLICAS = 64
+
+# Minimum difference in load (the fraction of time a shard spends processing
+# reads) between the busiest and quietest shard before networks are moved.
+REBALANCE_THRESHOLD = 0.1
+
+class _Shard():
+    """
+    Represents one selector thread and the networks assigned to it.
+    """
+    def __init__(self, num):
+        self.num = num
+        self.selector = selectors.DefaultSelector()
+        self.networks = set()
+
+        # Cumulative read events and time spent processing them, per network and in total.
+        # These are only updated from the shard's own thread.
+        self.events = {}
+        self.busy = {}
+        self.total_events = 0
+        self.total_busy = 0
+
+        # Networks queued to move off this shard: (irc, target shard) pairs. Moves are done by
+        # the shard's own thread so that a network is never read from two threads at once.
+        self.pending_moves = []
+
+    def __repr__(self):
+        return '<selectdriver shard %s>' % self.num
 
-def _process_conns():
-    """Main loop which processes connected sockets."""
+    def _process_moves(self):
+        """Moves networks queued by the rebalancer to their new shards."""
+        while self.pending_moves:
+            irc, target = self.pending_moves.pop()
+            with _lock:
+                if _assignments.get(irc) is not self or irc._socket is None:
+                    # The network disconnected in the meantime.
+                    continue
+                log.info('selectdriver: moving network %s from shard %s to shard %s', irc.name,
+                         self.num, target.num)
+                self.selector.unregister(irc._socket)
+                self.networks.discard(irc)
+                _assignments[irc] = target
+                _overrides[irc.name] = target.num
+                target.networks.add(irc)
+                target.selector.register(irc._socket, selectors.EVENT_READ, data=irc)
 
-    while not world.shutting_down.is_set():
-        for socketkey, mask in selector.select(timeout=SELECT_TIMEOUT):
-            irc = socketkey.data
-            try:
-                if mask & selectors.EVENT_READ and not irc._aborted.is_set():
-                    irc._run_irc()
-            except:
-                log.exception('Error in select driver loop:')
-                continue
+    def _record_event(self, irc, elapsed):
+        """Updates the read statistics after processing an event for a network."""
+        self.total_events += 1
+        self.total_busy += elapsed
+        with _lock:
+            # The network may have been unregistered while processing the event (e.g. when it
+            # disconnected); don't add it back to the statistics in that case.
+            if irc in self.networks:
+                self.events[irc] = self.events.get(irc, 0) + 1
+                self.busy[irc] = self.busy.get(irc, 0) + elapsed
+
+    def run(self):
+        """Main loop which processes connected sockets."""
+        while not world.shutting_down.is_set():
+            for socketkey, mask in self.selector.select(timeout=SELECT_TIMEOUT):
+                irc = socketkey.data
+                started = time.perf_counter()
+                try:
+                    if mask & selectors.EVENT_READ and not irc._aborted.is_set():
+                        irc._run_irc()
+                except:
+                    log.exception('Error in select driver loop:')
+                    continue
+                finally:
+                    self._record_event(irc, time.perf_counter() - started)
+
+            if self.pending_moves:
+                self._process_moves()
+            _maybe_rebalance()
+
+_lock = threading.RLock()
+_shards = []
+_ring = []  # Sorted list of (hash, shard number) tuples
+_assignments = {}  # Network object => shard
+_overrides = {}  # Network name => shard number, for networks moved by the rebalancer
+_threads = []
+
+_last_rebalance = time.time()
+_last_busy = {}  # Network object => cumulative busy time at the last rebalance
+_rebalance_lock = threading.Lock()
+
+def _hash(key):
+    """Returns a stable integer hash of the given string."""
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+def _init_shards():
+    """Creates the configured number of shards, if this hasn't been done yet."""
+    with _lock:
+        if _shards:
+            return
+        try:
+            count = max(1, int(conf.conf['pylink'].get('selector_shards', 1)))
+        except (TypeError, ValueError):
+            log.warning('selectdriver: invalid pylink::selector_shards value %r; using 1 shard',
+                        conf.conf['pylink'].get('selector_shards'))
+            count = 1
+
+        _shards.extend(_Shard(num) for num in range(count))
+        _ring.extend(sorted((_hash('%s-%s' % (num, replica)), num)
+                            for num in range(count) for replica in range(HASH_RING_REPLICAS)))
+
+def _get_pinned_shard(irc):
+    """
+    Returns the shard number a network is pinned to via its "selector_shard" option, or None.
+    """
+    num = irc.serverdata.get('selector_shard')
+    if num is None:
+        return
+    if not isinstance(num, int) or not 0 <= num < len(_shards):
+        log.warning('(%s) selectdriver: ignoring invalid selector_shard %r (valid range is 0-%s)',
+                    irc.name, num, len(_shards) - 1)
+        return
+    return num
+
+def _get_shard(irc):
+    """Picks the shard for a network."""
+    num = _get_pinned_shard(irc)
+    if num is None:
+        num = _overrides.get(irc.name)
+    if num is None or num >= len(_shards):
+        idx = bisect.bisect(_ring, (_hash(irc.name),)) % len(_ring)
+        num = _ring[idx][1]
+    return _shards[num]
+
+def _maybe_rebalance():
+    """
+    Moves one unpinned network from the busiest to the quietest shard, if the difference
+    in load between them is large enough. This runs at most once per rebalance interval.
+    """
+    global _last_rebalance
+
+    interval = conf.conf['pylink'].get('selector_rebalance_interval', 60)
+    if len(_shards) < 2 or not interval or time.time() - _last_rebalance < interval:
+        return
+    if not _rebalance_lock.acquire(blocking=False):
+        return
+
+    try:
+        now = time.time()
+        window = now - _last_rebalance
+        _last_rebalance = now
+
+        with _lock:
+            # Find the load of each network over the last window.
+            # Networks that moved have busy time counted on more than one shard, so add these up.
+            totals = {}
+            for shard in _shards:
+                for irc, busy in list(shard.busy.items()):
+                    totals[irc] = totals.get(irc, 0) + busy
+            netloads = {}
+            for irc, busy in totals.items():
+                netloads[irc] = (busy - _last_busy.get(irc, 0)) / window
+                _last_busy[irc] = busy
+            shardloads = {shard: sum(netloads.get(irc, 0) for irc in shard.networks)
+                          for shard in _shards}
+
+            busiest = max(_shards, key=shardloads.get)
+            quietest = min(_shards, key=shardloads.get)
+            difference = shardloads[busiest] - shardloads[quietest]
+            if difference < REBALANCE_THRESHOLD:
+                return
+
+            # Pick the busiest network whose move wouldn't simply reverse the imbalance.
+            candidates = [irc for irc in busiest.networks
+                          if _get_pinned_shard(irc) is None and 0 < netloads.get(irc, 0) < difference]
+            if candidates:
+                irc = max(candidates, key=netloads.get)
+                log.debug('selectdriver: rebalancing; shard loads are %s', shardloads)
+                busiest.pending_moves.append((irc, quietest))
+    finally:
+        _rebalance_lock.release()
 
 def register(irc):
     """
-    Registers a network to the global selectors instance.
+    Registers a network to its shard's selectors instance.
     """
-    log.debug('selectdriver: registering %s for network %s', irc._socket, irc.name)
-    selector.register(irc._socket, selectors.EVENT_READ, data=irc)
+    _init_shards()
+    with _lock:
+        shard = _get_shard(irc)
+        log.debug('selectdriver: registering %s for network %s on shard %s', irc._socket, irc.name,
+                  shard.num)
+        shard.selector.register(irc._socket, selectors.EVENT_READ, data=irc)
+        shard.networks.add(irc)
+        _assignments[irc] = shard
 
 def unregister(irc):
     """
-    Removes a network from the global selectors instance.
+    Removes a network from its shard's selectors instance.
+    """
+    with _lock:
+        shard = _assignments.pop(irc, None)
+        if shard is None:
+            raise KeyError('%s is not registered' % irc.name)
+        shard.networks.discard(irc)
+        for oldshard in _shards:
+            oldshard.events.pop(irc, None)
+            oldshard.busy.pop(irc, None)
+        _last_busy.pop(irc, None)
+
+        if irc._socket.fileno() != -1:
+            log.debug('selectdriver: de-registering %s for network %s', irc._socket, irc.name)
+            shard.selector.unregister(irc._socket)
+        else:
+            log.debug('selectdriver: skipping de-registering %s for network %s', irc._socket, irc.name)
+
+def get_stats():
+    """
+    Returns a list of per-shard statistics: each entry is a dict with the keys "shard",
+    "networks" (sorted list of network names), "events" (read events processed), and "busy"
+    (total seconds spent processing reads).
     """
-    if irc._socket.fileno() != -1:
-        log.debug('selectdriver: de-registering %s for network %s', irc._socket, irc.name)
-        selector.unregister(irc._socket)
-    else:
-        log.debug('selectdriver: skipping de-registering %s for network %s', irc._socket, irc.name)
+    with _lock:
+        return [{'shard': shard.num, 'networks': sorted(irc.name for irc in shard.networks),
+                 'events': shard.total_events, 'busy': shard.total_busy}
+                for shard in _shards]
 
 def start():
     """
-    Starts a thread to process connections.
+    Starts a thread for each shard to process connections.
     """
-    t = threading.Thread(target=_process_conns, name="Selector driver loop")
-    t.start()
+    _init_shards()
+    for shard in _shards:
+        if len(_shards) == 1:
+            name = "Selector driver loop"
+        else:
+            name = "Selector driver loop %s" % shard.num
+        t = threading.Thread(target=shard.run, name=name)
+        _threads.append(t)
+        t.start()
@@ -4,13 +4,19 @@ structures.py - PyLink data structures module.
 This module contains custom data structures that may be useful in various situations.
 """
 
+import bisect
 import collections
 import collections.abc
+import ipaddress
 import json
 import os
 import pickle
+import queue
+import socket
 import string
+import sys
 import threading
+import time
 from copy import copy, deepcopy
 
 from . import conf
@@ -18,9 +24,10 @@ from .log import log
 
 __all__ = ['KeyedDefaultdict', 'CopyWrapper', 'CaseInsensitiveFixedSet',
           'CaseInsensitiveDict', 'IRCCaseInsensitiveDict',
-          'CaseInsensitiveSet', 'IRCCaseInsensitiveSet',
+          'CaseInsensitiveSet', 'IRCCaseInsensitiveSet', 'IRCModeStore', 'IRCCasefolder',
           'CamelCaseToSnakeCase', 'DataStore', 'JSONDataStore',
-          'PickleDataStore']
+          'PickleDataStore', 'LaneQueue', 'TokenBucket', 'TimingStats', 'PrefixIndex',
+          'IPRadixTree']
 
 
 _BLACKLISTED_COPY_TYPES = []
@@ -41,16 +48,28 @@ class CopyWrapper():
     """
     Base container class implementing copy methods.
     """
+    __slots__ = ()
 
     def copy(self):
         """Returns a shallow copy of this object instance."""
         return copy(self)
 
+    def _iter_attrs(self):
+        """Yields (name, value) pairs for all instance attributes, including slotted ones."""
+        for klass in type(self).__mro__:
+            slots = klass.__dict__.get('__slots__', ())
+            if isinstance(slots, str):
+                slots = (slots,)
+            for attr in slots:
+                if attr not in ('__dict__', '__weakref__') and hasattr(self, attr):
+                    yield attr, getattr(self, attr)
+        yield from getattr(self, '__dict__', {}).items()
+
     def __deepcopy__(self, memo):
         """Returns a deep copy of the channel object."""
         newobj = copy(self)
         #log.debug('CopyWrapper: _BLACKLISTED_COPY_TYPES = %s', _BLACKLISTED_COPY_TYPES)
-        for attr, val in self.__dict__.items():
+        for attr, val in list(self._iter_attrs()):
             # We can't pickle IRCNetwork, so just return a reference of it.
             if not isinstance(val, tuple(_BLACKLISTED_COPY_TYPES)):
                 #log.debug('CopyWrapper: copying attr %r', attr)
@@ -176,10 +195,196 @@ class IRCCaseInsensitiveSet(CaseInsensitiveSet):
     def __copy__(self):
         return self.__class__(self._irc, data=self._data.copy())
 
+class IRCCasefolder():
+    """
+    IRC casefolding for one network, using precomputed translation tables for each casemapping and
+    a bounded cache of folded strings.
+
+    Folded strings are interned, so that the case insensitive keys used by e.g.
+    IRCCaseInsensitiveDict and UserMapping.bynick share one string object per name.
+    """
+    # Text is translated as UTF-8 bytes, so that only ASCII characters are changed: Unicode in
+    # channel names, etc. *is* case sensitive! This is also faster than str.translate().
+    # For RFC1459, PyLink has always folded {}|~ to []\^, so this is kept as is.
+    TABLES = {'ascii': bytes.maketrans(string.ascii_uppercase.encode(), string.ascii_lowercase.encode()),
+              'rfc1459': bytes.maketrans(string.ascii_uppercase.encode() + b'{}|~',
+                                         string.ascii_lowercase.encode() + b'[]\\^')}
+    DEFAULT_TABLE = 'ascii'
+
+    def __init__(self, casemapping='rfc1459', maxsize=8192):
+        self.maxsize = maxsize
+        self._cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.set_casemapping(casemapping)
+
+    def set_casemapping(self, casemapping):
+        """Changes the casemapping used, clearing any cached results."""
+        self.casemapping = casemapping
+        self._table = self.TABLES.get(casemapping, self.TABLES[self.DEFAULT_TABLE])
+        self._cache.clear()
+
+    def fold(self, text):
+        """
+        Returns the lowercase representation of text. Anything that isn't a string is returned as is.
+        """
+        if not isinstance(text, str):
+            return text
+
+        folded = self._cache.get(text)
+        if folded is not None:
+            self.hits += 1
+            return folded
+
+        self.misses += 1
+        folded = sys.intern(text.encode().translate(self._table).decode())
+        cache = self._cache
+        if len(cache) >= self.maxsize:
+            try:
+                # Evict the oldest entry.
+                cache.popitem(last=False)
+            except KeyError:
+                # Another thread emptied the cache in the meantime.
+                pass
+        cache[text] = folded
+        return folded
+
+    def clear(self):
+        """Clears the cache and its statistics."""
+        self._cache.clear()
+        self.hits = self.misses = 0
+
+    def get_stats(self):
+        """Returns a dict of cache statistics."""
+        lookups = self.hits + self.misses
+        return {'casemapping': self.casemapping, 'size': len(self._cache), 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0}
+
+class IRCModeStore(collections.abc.MutableSet, CopyWrapper):
+    """
+    A set of (mode character, argument) pairs, indexed by mode character.
+
+    Mode characters with more than one entry (e.g. bans) map to an insertion ordered dict of their
+    mode pairs, keyed by the IRC case folded argument, so that single list mode entries can be
+    looked up and removed without going through the entire mode list. Mode characters with only
+    one entry map to their mode pair directly.
+    """
+    __slots__ = ('_irc', '_data')
+
+    def __init__(self, irc, data=()):
+        self._irc = irc
+        self._data = {}
+        for modepair in data:
+            self.add(modepair)
+
+    def _keymangle(self, arg):
+        """Converts the given mode argument to lowercase."""
+        if isinstance(arg, str):
+            return self._irc.to_lower(arg)
+        return arg
+
+    def _from_iterable(self, it):
+        """Returns a new iterable instance given the data in 'it'."""
+        return self.__class__(self._irc, it)
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, set(self))
+
+    def __iter__(self):
+        for entry in self._data.values():
+            if isinstance(entry, dict):
+                yield from entry.values()
+            else:
+                yield entry
+
+    def __len__(self):
+        return sum(len(entry) if isinstance(entry, dict) else 1 for entry in self._data.values())
+
+    def __contains__(self, modepair):
+        try:
+            mode, arg = modepair
+        except (TypeError, ValueError):
+            return False
+        return self.find(mode, arg) == modepair
+
+    def __copy__(self):
+        newobj = self.__class__(self._irc)
+        newobj._data = {mode: entry.copy() if isinstance(entry, dict) else entry
+                        for mode, entry in self._data.items()}
+        return newobj
+
+    def add(self, modepair):
+        mode, arg = modepair
+        entry = self._data.get(mode)
+        if entry is None:
+            self._data[mode] = modepair
+        elif isinstance(entry, dict):
+            entry[self._keymangle(arg)] = modepair
+        else:
+            key = self._keymangle(arg)
+            oldkey = self._keymangle(entry[1])
+            if key == oldkey:
+                self._data[mode] = modepair
+            else:
+                self._data[mode] = {oldkey: entry, key: modepair}
+
+    def discard(self, modepair):
+        if modepair in self:
+            self.discard_mode(*modepair)
+
+    def clear(self):
+        self._data.clear()
+
+    def discard_mode(self, mode, arg=None):
+        """
+        Removes the entry of the given mode character whose argument matches arg case
+        insensitively, or all of the mode's entries if arg is None.
+        """
+        entry = self._data.get(mode)
+        if entry is None:
+            return
+        if arg is None:
+            del self._data[mode]
+        elif isinstance(entry, dict):
+            entry.pop(self._keymangle(arg), None)
+            if not entry:
+                del self._data[mode]
+        elif self._keymangle(entry[1]) == self._keymangle(arg):
+            del self._data[mode]
+
+    def find(self, mode, arg):
+        """
+        Returns the (mode, argument) pair set for the given mode character and (case insensitive)
+        argument, or None if there is no such entry.
+        """
+        entry = self._data.get(mode)
+        if entry is None:
+            return None
+        elif isinstance(entry, dict):
+            return entry.get(self._keymangle(arg))
+        elif self._keymangle(entry[1]) == self._keymangle(arg):
+            return entry
+        return None
+
+    def has_mode(self, mode):
+        """Returns whether the given mode character is set, with any argument."""
+        return mode in self._data
+
+    def get_args(self, mode):
+        """Returns a list of all arguments set for the given mode character, in the order they were set."""
+        entry = self._data.get(mode)
+        if entry is None:
+            return []
+        elif isinstance(entry, dict):
+            return [modepair[1] for modepair in entry.values()]
+        return [entry[1]]
+
 class CamelCaseToSnakeCase():
     """
     Class which automatically converts missing attributes from camel case to snake case.
     """
+    __slots__ = ()
 
     def __getattr__(self, attr):
         """
@@ -312,3 +517,422 @@ class PickleDataStore(DataStore):
                 pickle.dump(self.store, f, protocol=4)
 
                 os.rename(self.tmp_filename, self.filename)
+
+class LaneQueue():
+    """
+    Thread-safe FIFO queue with multiple priority lanes: items are always taken from the lowest
+    numbered non-empty lane first. maxsize (0 for unlimited) applies to all lanes combined.
+    """
+    def __init__(self, maxsize=0, lanes=1):
+        self.maxsize = maxsize
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.lanes = [collections.deque() for _ in range(lanes)]
+
+    def _qsize(self):
+        return sum(map(len, self.lanes))
+
+    def qsize(self):
+        """Returns the amount of items in the queue."""
+        with self.mutex:
+            return self._qsize()
+
+    def empty(self):
+        """Returns whether the queue is empty."""
+        return not self.qsize()
+
+    def put_nowait(self, item, lane=0):
+        """
+        Adds an item to the end of the given lane, raising queue.Full if the queue is full.
+        """
+        with self.mutex:
+            if self.maxsize > 0 and self._qsize() >= self.maxsize:
+                raise queue.Full
+            self.lanes[lane].append(item)
+            self.not_empty.notify()
+
+    def put_front(self, item, lane=0):
+        """
+        Adds an item to the front of the given lane, ignoring maxsize. This is used to return
+        items that couldn't be processed yet, and to stop consumers early.
+        """
+        with self.mutex:
+            self.lanes[lane].appendleft(item)
+            self.not_empty.notify()
+
+    def put_back(self, item, lane=0):
+        """
+        Adds an item to the end of the given lane, ignoring maxsize. This is used to move items
+        that were already queued to another lane.
+        """
+        with self.mutex:
+            self.lanes[lane].append(item)
+            self.not_empty.notify()
+
+    def get_lane(self, block=True, timeout=None):
+        """
+        Removes and returns the next item in the queue as a (lane, item) tuple, raising
+        queue.Empty if there is none (after waiting for up to timeout seconds, if block is True).
+        """
+        with self.not_empty:
+            if block and not self.not_empty.wait_for(self._qsize, timeout):
+                raise queue.Empty
+            for num, lane in enumerate(self.lanes):
+                if lane:
+                    return (num, lane.popleft())
+            raise queue.Empty
+
+    def get(self, block=True, timeout=None):
+        """
+        Removes and returns the next item in the queue, raising queue.Empty if there is none
+        (after waiting for up to timeout seconds, if block is True).
+        """
+        return self.get_lane(block, timeout)[1]
+
+    def get_nowait(self):
+        """Removes and returns the next item in the queue, raising queue.Empty if there is none."""
+        return self.get(False)
+
+    def clear(self):
+        """Removes all items from the queue."""
+        with self.mutex:
+            for lane in self.lanes:
+                lane.clear()
+
+class TokenBucket():
+    """
+    Token bucket rate limiter: tokens refill at "rate" per second, and up to "burst" tokens
+    can be saved up and taken at once. This is not thread-safe.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self._last = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def delay(self, tokens=1):
+        """Returns how long to wait (in seconds) before the given amount of tokens is available."""
+        self._refill()
+        if self.tokens >= tokens:
+            return 0
+        return (tokens - self.tokens) / self.rate
+
+    def take(self, tokens=1):
+        """Takes the given amount of tokens from the bucket."""
+        self._refill()
+        self.tokens -= tokens
+
+class TimingStats():
+    """
+    Tracks the call count and the total, maximum, and percentile run times of a function.
+    Percentiles are computed over the most recent "samples" calls.
+    """
+    def __init__(self, samples=1000):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.samples = collections.deque(maxlen=samples)
+
+    def add(self, elapsed):
+        """Records a call that took the given amount of seconds."""
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        self.samples.append(elapsed)
+
+    def percentile(self, pct):
+        """Returns the given percentile (0-100) of the recent run times."""
+        if not self.samples:
+            return 0
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+class PrefixIndex():
+    """
+    A mapping of string keys to sets of values, which can also find all values whose keys start
+    with a given prefix.
+
+    Keys are kept in a sorted list, so prefix lookups take O(log n) plus the number of matching
+    keys. New keys are only merged into the sorted list on the next lookup, so that adding many
+    keys at once stays cheap.
+    """
+    __slots__ = ('_data', '_keys', '_pending')
+
+    def __init__(self):
+        self._data = {}
+        self._keys = []
+        self._pending = set()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def add(self, key, value):
+        """Adds value to the set of values for key."""
+        values = self._data.get(key)
+        if values is None:
+            values = self._data[key] = set()
+            self._pending.add(key)
+        values.add(value)
+
+    def discard(self, key, value):
+        """Removes value from the set of values for key, if present."""
+        values = self._data.get(key)
+        if values is None:
+            return
+        values.discard(value)
+        if not values:
+            del self._data[key]
+            if key in self._pending:
+                self._pending.discard(key)
+            else:
+                del self._keys[bisect.bisect_left(self._keys, key)]
+
+    def clear(self):
+        self._data.clear()
+        self._keys.clear()
+        self._pending.clear()
+
+    def get(self, key):
+        """Returns the set of values for key (this is empty if key doesn't exist)."""
+        return self._data.get(key, set())
+
+    def _get_range(self, prefix):
+        """Returns the range of positions in the key list holding keys that start with prefix."""
+        keys = self._keys
+        if self._pending:
+            # Sorting a sorted list with a few new items at the end is close to O(n).
+            keys.extend(self._pending)
+            keys.sort()
+            self._pending.clear()
+
+        start = bisect.bisect_left(keys, prefix)
+        if not prefix:
+            return start, len(keys)
+        elif prefix[-1] == chr(sys.maxunicode):
+            end = start
+            while end < len(keys) and keys[end].startswith(prefix):
+                end += 1
+            return start, end
+        # The first string after all strings starting with prefix.
+        end = bisect.bisect_left(keys, prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+        return start, end
+
+    def count_prefix(self, prefix):
+        """Returns the amount of keys starting with prefix."""
+        start, end = self._get_range(prefix)
+        return end - start
+
+    def find_prefix(self, prefix):
+        """Returns a set of all values whose keys start with prefix."""
+        start, end = self._get_range(prefix)
+        results = set()
+        for key in self._keys[start:end]:
+            results.update(self._data[key])
+        return results
+
+class IPRadixTree():
+    """
+    A path-compressed binary (PATRICIA) trie mapping IPv4 and IPv6 ranges to sets of values
+    (e.g. rule IDs). Single addresses are stored as /32 or /128 ranges.
+
+    This can find the values of all ranges covering an address, or all ranges inside a given
+    range, in O(prefix length) plus the size of the result. Counting the values inside a range
+    is O(prefix length).
+    """
+    __slots__ = ('_roots', '_size')
+
+    class _Node():
+        __slots__ = ('key', 'length', 'values', 'children', 'count')
+
+        def __init__(self, key, length, values=None):
+            self.key = key  # The range's network address, as an integer
+            self.length = length  # The range's prefix length
+            self.values = values or set()
+            self.children = [None, None]
+            # The amount of values stored in this node and all nodes below it
+            self.count = len(self.values)
+
+    WIDTHS = {4: 32, 6: 128}
+
+    def __init__(self):
+        self._roots = {version: self._Node(0, 0) for version in self.WIDTHS}
+        self._size = 0
+
+    def __len__(self):
+        """Returns the amount of (range, value) pairs stored."""
+        return self._size
+
+    @classmethod
+    def _parse(cls, target):
+        """
+        Returns a (version, network address, prefix length) tuple for the given ipaddress
+        address or network object, or the string form of one. ValueError is raised if the
+        target is invalid.
+        """
+        if isinstance(target, str):
+            if '/' in target:
+                target = ipaddress.ip_network(target)
+            else:
+                # inet_pton() is a lot faster than the ipaddress module, which is only used as a
+                # fallback for the few addresses it accepts that inet_pton() doesn't (e.g. scoped
+                # IPv6 addresses).
+                for family, version in ((socket.AF_INET, 4), (socket.AF_INET6, 6)):
+                    try:
+                        packed = socket.inet_pton(family, target)
+                    except OSError:
+                        continue
+                    return (version, int.from_bytes(packed, 'big'), cls.WIDTHS[version])
+                target = ipaddress.ip_address(target)
+
+        if isinstance(target, (ipaddress.IPv4Network, ipaddress.IPv6Network)):
+            return (target.version, int(target.network_address), target.prefixlen)
+        elif isinstance(target, (ipaddress.IPv4Address, ipaddress.IPv6Address)):
+            return (target.version, int(target), target.max_prefixlen)
+        raise ValueError('%r is not an IP address or network' % (target,))
+
+    @staticmethod
+    def _get_bit(key, pos, width):
+        """Returns the bit at the given position (counting from the left) of key."""
+        return (key >> (width - pos - 1)) & 1
+
+    @staticmethod
+    def _contains(node, key, width):
+        """Returns whether the given node's range contains the given key, up to the node's length."""
+        shift = width - node.length
+        return (node.key >> shift) == (key >> shift)
+
+    def add(self, target, value):
+        """Adds value to the set of values for the given range."""
+        version, key, length = self._parse(target)
+        width = self.WIDTHS[version]
+        path = []
+        node = self._roots[version]
+
+        while True:
+            if node.length == length:
+                # The root is the only node that can be reached without matching the whole key.
+                if value not in node.values:
+                    node.values.add(value)
+                    path.append(node)
+                    break
+                return
+
+            path.append(node)
+            # This is called for every user in UserIndex, so _get_bit() is inlined here.
+            bit = (key >> (width - node.length - 1)) & 1
+            child = node.children[bit]
+            if child is None:
+                node.children[bit] = self._Node(key, length, {value})
+                break
+
+            # Find the amount of leading bits shared between the child and the new range.
+            common = width - (child.key ^ key).bit_length()
+            if child.length <= common and child.length <= length:
+                # The child's range contains the new range; keep going down.
+                node = child
+                continue
+            common = min(common, length)
+
+            if common == length:
+                # The new range contains the child's range: insert it in between.
+                newnode = self._Node(key, length, {value})
+            else:
+                # The ranges diverge: add a branch node for their common prefix.
+                mask = ((1 << common) - 1) << (width - common)
+                newnode = self._Node(key & mask, common)
+                newnode.children[self._get_bit(key, common, width)] = self._Node(key, length, {value})
+            newnode.children[self._get_bit(child.key, common, width)] = child
+            newnode.count = child.count + 1
+            node.children[bit] = newnode
+            break
+
+        for node in path:
+            node.count += 1
+        self._size += 1
+
+    def discard(self, target, value):
+        """Removes value from the set of values for the given range, if present."""
+        version, key, length = self._parse(target)
+        width = self.WIDTHS[version]
+        path = []
+        node = self._roots[version]
+
+        while node.length < length:
+            path.append(node)
+            node = node.children[self._get_bit(key, node.length, width)]
+            if node is None or not self._contains(node, key, width):
+                return
+        if node.length != length or value not in node.values:
+            return
+
+        node.values.discard(value)
+        for parent in path:
+            parent.count -= 1
+        node.count -= 1
+        self._size -= 1
+
+        # Remove nodes that no longer hold values or branch, starting from the bottom.
+        while path and not node.values:
+            parent = path.pop()
+            children = [child for child in node.children if child is not None]
+            if len(children) > 1:
+                break
+            parent.children[parent.children.index(node)] = children[0] if children else None
+            node = parent
+
+    def covering(self, target):
+        """Returns a set of the values of all ranges containing the given address or range."""
+        version, key, length = self._parse(target)
+        width = self.WIDTHS[version]
+        node = self._roots[version]
+        results = set()
+
+        while node is not None and node.length <= length and self._contains(node, key, width):
+            results.update(node.values)
+            if node.length == width:
+                break
+            node = node.children[self._get_bit(key, node.length, width)]
+        return results
+
+    def _find_within(self, target):
+        """Returns the topmost node inside the given range, or None if there isn't one."""
+        version, key, length = self._parse(target)
+        width = self.WIDTHS[version]
+        node = self._roots[version]
+
+        while node is not None and node.length < length:
+            if not self._contains(node, key, width):
+                return None
+            node = node.children[self._get_bit(key, node.length, width)]
+
+        if node is None or (key >> (width - length)) != (node.key >> (width - length)):
+            return None
+        return node
+
+    def count_within(self, target):
+        """Returns the amount of values stored for ranges inside the given range."""
+        node = self._find_within(target)
+        return node.count if node else 0
+
+    def within(self, target):
+        """Returns a set of the values of all ranges inside the given range (including itself)."""
+        results = set()
+        node = self._find_within(target)
+        if node is None:
+            return results
+
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            results.update(node.values)
+            stack.extend(child for child in node.children if child is not None)
+        return results
@@ -0,0 +1,96 @@
+"""
+Test cases for asyncdriver.py and the asyncio parts of classes.IRCNetwork.
+"""
+
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from pylinkirc import asyncdriver, classes, conf, world
+from pylinkirc.protocols import inspircd
+
+from test_irc_network import SocketTestNetwork
+
+
+class AsyncDriverTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Run the event loop in our own thread, so that it can be stopped after each test.
+        thread = threading.Thread(target=asyncdriver.loop.run_forever, daemon=True)
+        patcher = patch.object(asyncdriver, '_loop_thread', thread)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(asyncdriver.loop.call_soon_threadsafe, asyncdriver.loop.stop)
+
+    def _wait_for(self, func, timeout=2):
+        deadline = time.time() + timeout
+        while not func():
+            if time.time() > deadline:
+                self.fail('Timed out waiting for %s' % func)
+            time.sleep(0.01)
+
+    def test_timer(self):
+        fired = threading.Event()
+        asyncdriver.call_later(0.01, fired.set)
+        self.assertTrue(fired.wait(2))
+
+    def test_timer_cancel(self):
+        fired = threading.Event()
+        # Cancelled before the timer is even scheduled on the loop...
+        asyncdriver.call_later(0, fired.set).cancel()
+        # ... and after.
+        timer = asyncdriver.call_later(0.05, fired.set)
+        self._wait_for(lambda: timer._handle is not None)
+        timer.cancel()
+        self.assertFalse(fired.wait(0.2))
+
+    def test_queue_task(self):
+        irc = SocketTestNetwork()
+        self.addCleanup(irc.peer.close)
+        self.addCleanup(irc._socket.close)
+        irc._aborted_send = threading.Event()
+
+        with patch.dict(world.networkobjects, test=irc):
+            future = asyncdriver.run_coroutine(irc._process_queue_async())
+            self._wait_for(lambda: irc._queue_event is not None)
+
+            # Queueing a line from another thread wakes up the queue task.
+            irc.send(':0AL PRIVMSG #test :hello')
+            irc.peer.settimeout(2)
+            self.assertEqual(irc.peer.recv(1024), b':0AL PRIVMSG #test :hello\r\n')
+
+            # This is how disconnect() stops the queue task.
+            irc._queue.put_front(None, classes.SENDQ_LANE_KEEPALIVE)
+            irc._wake_queue_task()
+            future.result(2)
+        self.assertIsNone(irc._queue_event)
+        self.assertTrue(irc._aborted_send.is_set())
+
+    def test_reconnect_cancel(self):
+        # This creates a default server block for the network.
+        conf.conf['servers']['asynctest']
+        irc = inspircd.Class('asynctest')
+        with patch.object(world, 'socket_driver', 'asyncio'), \
+                patch.dict(world.networkobjects, asynctest=irc), \
+                patch.object(irc, '_get_autoconnect_delay', return_value=0.1), \
+                patch.object(irc, 'connect') as connect:
+            irc._start_reconnect()
+            timer = irc._reconnect_timer
+            self.assertIsNotNone(timer)
+            multiplier = irc.autoconnect_active_multiplier
+
+            # Disconnecting a removed network cancels the pending reconnect for good.
+            del world.networkobjects['asynctest']
+            irc.disconnect()
+            self.assertIsNone(irc._reconnect_timer)
+            self.assertTrue(timer._cancelled)
+            time.sleep(0.2)
+            # The timer callback never ran.
+            self.assertEqual(irc.autoconnect_active_multiplier, multiplier)
+            self.assertFalse(connect.called)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,436 @@
+"""
+Test cases for the User, Channel and Server state classes.
+"""
+
+import ipaddress
+import unittest
+from unittest.mock import patch
+
+from pylinkirc import classes, conf, structures, utils, world
+from pylinkirc.coremods import exttargets  # Registers exttarget handlers
+from pylinkirc.protocols import inspircd
+
+
+class StateClassesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # This creates a default server block for the network.
+        conf.conf['servers']['classtest']
+        self.irc = inspircd.Class('classtest')
+        self.irc.servers['0AL'] = classes.Server(self.irc, None, 'pylink.example.com', internal=True)
+        self.irc.users['0ALAAAAAA'] = classes.User(self.irc, 'user1', 0, '0ALAAAAAA', '0AL')
+
+    def test_lazy_user_containers(self):
+        user = self.irc.users['0ALAAAAAA']
+        self.assertIsNone(user._channels)
+        self.assertIs(user.modes, classes.User.EMPTY_MODES)
+
+        self.irc.apply_modes('0ALAAAAAA', [('+i', None)])
+        self.assertEqual(user.modes, {('i', None)})
+        self.assertFalse(classes.User.EMPTY_MODES)
+
+        user.channels.add('#Test')
+        self.assertIn('#test', user.channels)
+        self.assertNotIn('_channels', user.get_fields())
+
+    def test_user_subclass_fields(self):
+        class SubclassUser(classes.User):
+            __slots__ = ('remote',)
+
+        user = SubclassUser(self.irc, 'user2', 0, '0ALAAAAAB', '0AL')
+        user.remote = ('othernet', '1SVAAAAAA')
+        self.assertEqual(user.get_fields()['remote'], ('othernet', '1SVAAAAAA'))
+        self.assertNotIn('remote', self.irc.users['0ALAAAAAA'].get_fields())
+
+    def test_lazy_prefixmodes(self):
+        c = self.irc._channels['#test']
+        c.users.add('0ALAAAAAA')
+        self.irc.apply_modes('#test', [('+n', None), ('-o', '0ALAAAAAA')])
+        self.assertIsNone(c._prefixmodes)
+        self.assertFalse(c.is_op_plus('0ALAAAAAA'))
+        self.assertEqual(c.get_prefix_modes('0ALAAAAAA'), [])
+
+        self.irc.apply_modes('#test', [('+o', '0ALAAAAAA')])
+        self.assertEqual(c.prefixmodes['op'], {'0ALAAAAAA'})
+        self.assertTrue(c.isOp('0ALAAAAAA'))  # CamelCase alias
+        c.removeuser('0ALAAAAAA')
+        self.assertFalse(c.is_op('0ALAAAAAA'))
+
+    def test_channel_deepcopy(self):
+        c = self.irc._channels['#test']
+        c.users.add('0ALAAAAAA')
+        c.prefixmodes['voice'].add('0ALAAAAAA')
+        c.topic = 'hello'
+        c.notes = ['plugin data']
+
+        oldchan = c.deepcopy()
+        c.users.clear()
+        c.prefixmodes['voice'].clear()
+        c.notes.append('more data')
+        self.assertEqual(oldchan.users, {'0ALAAAAAA'})
+        self.assertEqual(oldchan.prefixmodes['voice'], {'0ALAAAAAA'})
+        self.assertEqual(oldchan.notes, ['plugin data'])
+        self.assertEqual(oldchan.topic, 'hello')
+        self.assertIs(oldchan._irc, self.irc)
+
+    def test_channel_snapshot(self):
+        c = self.irc._channels['#test']
+        c.users.update({'0ALAAAAAA', '0ALAAAAAB'})
+        self.irc.apply_modes('#test', [('+o', '0ALAAAAAA'), ('+b', '*!*@bad.host')])
+
+        oldchan = c.snapshot()
+        users = c._users
+        self.assertIs(oldchan._users, users)  # Nothing is copied yet
+        self.irc.apply_modes('#test', [('-o', '0ALAAAAAA'), ('-b', '*!*@bad.host'), ('+v', '0ALAAAAAB')])
+        c.remove_user('0ALAAAAAB')
+        c.users.add('0ALAAAAAC')
+        self.assertIsNot(c._users, users)
+
+        # Only the channel copied its sets: the snapshot keeps the originals.
+        self.assertIs(oldchan.users, users)
+
+        self.assertEqual(oldchan.users, {'0ALAAAAAA', '0ALAAAAAB'})
+        self.assertEqual(oldchan.modes, {('b', '*!*@bad.host')})
+        self.assertTrue(oldchan.is_op('0ALAAAAAA'))
+        self.assertFalse(oldchan.is_voice('0ALAAAAAB'))
+        self.assertEqual(c.users, {'0ALAAAAAA', '0ALAAAAAC'})
+        self.assertFalse(c.modes)
+        self.assertFalse(c.is_op('0ALAAAAAA'))
+
+        # Reversing modes against a snapshot uses the old state.
+        self.assertEqual(self.irc.reverse_modes('#test', [('-b', '*!*@bad.host')], oldobj=oldchan),
+                         [('+b', '*!*@bad.host')])
+        self.assertEqual(self.irc.reverse_modes('#test', [('-b', '*!*@bad.host')]), [])
+
+    def test_channel_snapshot_unread(self):
+        c = self.irc._channels['#test']
+        c.users.add('0ALAAAAAA')
+        users = c._users
+
+        # Snapshots freed before anything reads them are never copied.
+        oldchan = c.snapshot()
+        del oldchan
+        c.users.add('0ALAAAAAB')
+        self.assertIs(c._users, users)
+        self.assertIsNone(c._shared_with)
+
+        # Likewise when the snapshot is read after the channel is gone.
+        oldchan = c.snapshot()
+        del self.irc._channels['#test'], c
+        self.assertEqual(oldchan.users, {'0ALAAAAAA', '0ALAAAAAB'})
+        self.assertIs(oldchan._users, users)
+
+    def test_server(self):
+        server = self.irc.servers['0AL']
+        self.assertEqual(server.hopcount, 1)
+        server.remote = 'othernet'  # Plugins can still add their own attributes
+        self.assertEqual(server.__dict__, {'remote': 'othernet'})
+
+class ModeStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # This creates a default server block for the network.
+        conf.conf['servers']['classtest']
+        self.irc = inspircd.Class('classtest')
+
+    def test_mode_store(self):
+        modes = structures.IRCModeStore(self.irc, [('n', None), ('l', '30'), ('b', '*!*@A.host'),
+                                                   ('b', '*!*@b.host')])
+        self.assertEqual(modes, {('n', None), ('l', '30'), ('b', '*!*@A.host'), ('b', '*!*@b.host')})
+        self.assertEqual(len(modes), 4)
+        self.assertIn(('b', '*!*@A.host'), modes)
+        self.assertNotIn(('b', '*!*@a.host'), modes)
+        self.assertEqual(modes.find('b', '*!*@a.HOST'), ('b', '*!*@A.host'))
+        self.assertEqual(modes.get_args('b'), ['*!*@A.host', '*!*@b.host'])
+        self.assertTrue(modes.has_mode('l'))
+
+        modes.discard_mode('b', '*!*@a.host')
+        modes.discard_mode('n')
+        self.assertEqual(modes, {('l', '30'), ('b', '*!*@b.host')})
+        self.assertEqual(modes.copy(), modes)
+        self.assertIsInstance(modes - {('l', '30')}, structures.IRCModeStore)
+
+    def test_apply_modes(self):
+        c = self.irc._channels['#test']
+        self.irc.apply_modes('#test', [('+b', '*!*@host%d' % num) for num in range(100)])
+        self.irc.apply_modes('#test', [('+l', '30'), ('+l', '25'), ('+n', None), ('-b', '*!*@HOST5')])
+        self.assertIsInstance(c.modes, structures.IRCModeStore)
+        self.assertEqual(len(c.modes), 101)
+        self.assertEqual(c.modes.get_args('l'), ['25'])
+        self.assertIsNone(c.modes.find('b', '*!*@host5'))
+
+        # Removals are case insensitive, and only apply to modes that were set.
+        self.assertEqual(self.irc.parse_modes('#test', ['-bb+b-b', '*!*@HOST1', '*!*@nonexistent',
+                                                        '*!*@new', '*!*@NEW']),
+                         [('-b', '*!*@host1'), ('+b', '*!*@new'), ('-b', '*!*@new')])
+        self.assertEqual(self.irc.reverse_modes('#test', '-b+b *!*@HOST1 *!*@host2'), '+b *!*@host1')
+
+class MatchHostTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # This creates a default server block for the network.
+        conf.conf['servers']['classtest']
+        self.irc = inspircd.Class('classtest')
+        self.irc.servers['0AL'] = classes.Server(self.irc, None, 'pylink.example.com', internal=True)
+        self.irc.users['0ALAAAAAA'] = user = classes.User(
+            self.irc, 'Nick{1}', 0, '0ALAAAAAA', '0AL', ident='~ident', host='cloaked.example.com',
+            realhost='Real.Example.com', ip='192.0.2.10')
+        user.account = 'MyAccount'
+        self.irc.users['0ALAAAAAB'] = classes.User(self.irc, 'other', 0, '0ALAAAAAB', '0AL',
+                                                   host='other.host', ip='2001:db8::1')
+
+    def test_match_host(self):
+        f = self.irc.match_host
+        self.assertTrue(f('nick[1]!*@*', '0ALAAAAAA'))  # RFC1459 casemapping
+        self.assertTrue(f('*!~IDENT@*.example.com', '0ALAAAAAA'))
+        self.assertTrue(f('*!*@real.example.com', '0ALAAAAAA'))
+        self.assertFalse(f('*!*@real.example.com', '0ALAAAAAA', realhost=False))
+        self.assertTrue(f('*!*@192.0.2.10', '0ALAAAAAA'))
+        self.assertFalse(f('*!*@192.0.2.10', '0ALAAAAAA', ip=False))
+        self.assertTrue(f('!*!*@other.host', '0ALAAAAAA'))
+        self.assertFalse(f('!*!*@*', '0ALAAAAAA'))
+
+        # Hosts are matched as plain text.
+        self.assertTrue(f('*!*@*.Example.com', 'nick!user@test.example.com'))
+        self.assertFalse(f('myaccount', 'nick!user@test.example.com'))
+
+    def test_match_host_cidr(self):
+        f = self.irc.match_host
+        self.assertTrue(f('*!*@192.0.2.0/24', '0ALAAAAAA'))
+        self.assertTrue(f('nick*!*@192.0.2.0/24', '0ALAAAAAA'))
+        self.assertFalse(f('other!*@192.0.2.0/24', '0ALAAAAAA'))
+        self.assertFalse(f('*!*@192.0.2.0/24', '0ALAAAAAA', ip=False))
+        self.assertFalse(f('*!*@192.0.2.0/24', '0ALAAAAAB'))
+        self.assertTrue(f('*!*@2001:db8::/32', '0ALAAAAAB'))
+
+    def test_match_host_exttargets(self):
+        f = self.irc.match_host
+        self.assertTrue(f('myaccount', '0ALAAAAAA'))  # Implicit $pylinkacc
+        self.assertTrue(f('$pylinkacc', '0ALAAAAAA'))
+        self.assertFalse(f('$pylinkacc', '0ALAAAAAB'))
+        self.assertTrue(f('!$pylinkacc', '0ALAAAAAB'))
+        self.assertFalse(f('$nonexistent', '0ALAAAAAA'))
+        self.assertTrue(f('$and:(*!*@*.example.com+$pylinkacc:myaccount)', '0ALAAAAAA'))
+
+        # Globs without wildcards don't match missing (None) fields.
+        self.irc.users['0ALAAAAAB'].realname = None
+        self.assertFalse(f('$realname:bob', '0ALAAAAAB'))
+        self.assertTrue(f('!$realname:bob', '0ALAAAAAB'))
+
+    def test_compiled_exttargets(self):
+        compiled = []
+        def compile_test(irc, host):
+            compiled.append(host)
+            name = host.split(':')[1]
+            return lambda irc, uid: irc.users[uid].nick == name
+        handler = exttargets.compiled(compile_test)
+        self.assertTrue(handler(self.irc, 'test:other', '0ALAAAAAB'))  # Uncompiled call
+
+        with patch.dict(world.exttarget_handlers, {'test': handler}):
+            for _ in range(3):
+                self.assertTrue(self.irc.match_host('$and:($test:other+*!*@other.host)', '0ALAAAAAB'))
+                self.assertFalse(self.irc.match_host('$test:other', '0ALAAAAAA'))
+            self.assertEqual(compiled, ['test:other', 'test:other'])
+
+            # Replaced handlers are used right away.
+            world.exttarget_handlers['test'] = lambda irc, host, uid: True
+            self.assertTrue(self.irc.match_host('$test:other', '0ALAAAAAA'))
+
+    def test_compiled_masks(self):
+        mask = self.irc.compile_mask('*!*@CLOAKED.example.com')
+        self.assertIs(self.irc.compile_mask('*!*@CLOAKED.example.com'), mask)
+        self.assertEqual(mask.glob, '*!*@cloaked.example.com')
+        self.assertTrue(mask.match(self.irc, '0ALAAAAAA'))
+        self.assertEqual(self.irc.compile_mask('!$account:x').exttarget, 'account:x')
+        self.assertIsNotNone(self.irc.compile_mask('*!*@10.0.0.0/8').cidr)
+
+        # Masks are recompiled when the casemapping changes.
+        self.irc.casemapping = 'ascii'
+        self.assertIsNot(self.irc.compile_mask('*!*@CLOAKED.example.com'), mask)
+        self.assertFalse(self.irc.match_host('nick[1]!*@*', '0ALAAAAAA'))
+
+    def test_match_all(self):
+        self.assertEqual(list(self.irc.match_all('*!*@*')), ['0ALAAAAAA', '0ALAAAAAB'])
+        self.assertEqual(list(self.irc.match_all('*!*@2001:db8::/32')), ['0ALAAAAAB'])
+
+    def test_mask_set(self):
+        masks = ['*!*@*', 'nick{1}!*@*', '*!*@*.example.com', '*!*@other.host', '*!*@192.0.2.0/24',
+                 'Nick[1]!~ident@cloaked.example.com', '!$pylinkacc', '$pylinkacc', 'myaccount',
+                 '*!*@2001:db8::1', 'other*', '*', '*!*@other.*', '?ther!*@*', '*!*@nomatch.*']
+        maskset = utils.MaskSet(self.irc, {mask: num for num, mask in enumerate(masks)})
+        self.assertEqual(len(maskset), len(masks))
+
+        for target in ('0ALAAAAAA', '0ALAAAAAB', 'other!null@other.host', 'nomatch'):
+            for ip, realhost in ((True, True), (False, False)):
+                expected = [(mask, num) for num, mask in enumerate(masks)
+                            if self.irc.match_host(mask, target, ip=ip, realhost=realhost)]
+                self.assertEqual(maskset.match(target, ip=ip, realhost=realhost), expected)
+
+        maskset.discard('*')
+        maskset.add('*!*@real.example.com', 'new')
+        self.assertEqual(maskset.match('0ALAAAAAB'), [('*!*@*', 0), ('*!*@other.host', 3),
+                                                      ('!$pylinkacc', 6), ('*!*@2001:db8::1', 9),
+                                                      ('*!*@other.*', 12), ('?ther!*@*', 13)])
+        self.assertIn(('*!*@real.example.com', 'new'), maskset.match('0ALAAAAAA'))
+
+    def test_mask_set_cidr(self):
+        masks = ['*!*@192.0.2.0/24', 'nick*!*@192.0.2.0/28', '*!*@192.0.2.128/25', '*!*@0.0.0.0/0',
+                 '*!*@2001:db8::/32', '!*!*@192.0.2.0/24', '*!*@192.0.2.10/32', '*!*@1.2.3.4/32']
+        maskset = utils.MaskSet(self.irc, masks)
+        self.assertEqual([mask for mask, _ in maskset.match('0ALAAAAAA')],
+                         ['*!*@192.0.2.0/24', 'nick*!*@192.0.2.0/28', '*!*@0.0.0.0/0',
+                          '*!*@192.0.2.10/32'])
+        self.assertEqual([mask for mask, _ in maskset.match('0ALAAAAAB')],
+                         ['*!*@2001:db8::/32', '!*!*@192.0.2.0/24'])
+        self.assertEqual([mask for mask, _ in maskset.match('0ALAAAAAA', ip=False)],
+                         ['!*!*@192.0.2.0/24'])
+
+        # CIDR masks can still match literally.
+        self.assertEqual([mask for mask, _ in maskset.match('a!b@1.2.3.4/32')],
+                         ['!*!*@192.0.2.0/24', '*!*@1.2.3.4/32'])
+
+class UserIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # This creates a default server block for the network.
+        conf.conf['servers']['classtest']
+        self.irc = inspircd.Class('classtest')
+        self.irc.servers['0AL'] = classes.Server(self.irc, None, 'pylink.example.com', internal=True)
+        for num, (host, ip) in enumerate([('a.Example.com', '192.0.2.1'), ('b.example.com', '192.0.2.2'),
+                                          ('other.host', '198.51.100.1'), ('192.0.2.3', '192.0.2.3'),
+                                          ('ipv6.host', '2001:db8::1')]):
+            uid = '0ALAAAAA%d' % num
+            self.irc.users[uid] = classes.User(self.irc, 'nick%d' % num, 0, uid, '0AL', ident='user%d' % num,
+                                               host=host, realhost=host, ip=ip)
+        for num in range(5):
+            # Lookups matching most users are skipped, so add some unrelated users.
+            uid = '0ALAAAAB%d' % num
+            self.irc.users[uid] = classes.User(self.irc, 'filler%d' % num, 0, uid, '0AL',
+                                               host='filler%d.net' % num, ip='203.0.113.%d' % num)
+        self.irc._channels['#test'].users.update({'0ALAAAAA0', '0ALAAAAA2'})
+
+    def find(self, mask):
+        return self.irc.users.index.find(self.irc.compile_mask(mask))
+
+    def test_prefix_index(self):
+        index = structures.PrefixIndex()
+        for key, value in (('abc', 1), ('abd', 2), ('ab', 3), ('b', 4), ('abc', 5)):
+            index.add(key, value)
+        self.assertEqual(index.find_prefix('ab'), {1, 2, 3, 5})
+        self.assertEqual(index.find_prefix('abc'), {1, 5})
+        self.assertEqual(index.count_prefix('ab'), 3)
+        self.assertEqual(index.get('abc'), {1, 5})
+        index.discard('abc', 1)
+        index.discard('abc', 5)
+        self.assertNotIn('abc', index)
+        self.assertEqual(index.find_prefix(''), {2, 3, 4})
+
+    def test_ip_radix_tree(self):
+        tree = structures.IPRadixTree()
+        for network, value in (('192.0.2.0/24', 1), ('192.0.2.0/25', 2), ('192.0.2.10', 3),
+                               ('0.0.0.0/0', 4), ('192.0.2.128/25', 5), ('2001:db8::/32', 6),
+                               ('2001:db8::1', 7)):
+            tree.add(network, value)
+        self.assertEqual(len(tree), 7)
+        self.assertEqual(tree.covering('192.0.2.10'), {1, 2, 3, 4})
+        self.assertEqual(tree.covering('192.0.2.200'), {1, 4, 5})
+        self.assertEqual(tree.covering('198.51.100.1'), {4})
+        self.assertEqual(tree.covering(ipaddress.ip_network('192.0.2.0/26')), {1, 2, 4})
+        self.assertEqual(tree.covering('2001:db8::1'), {6, 7})
+        self.assertEqual(tree.within('192.0.2.0/24'), {1, 2, 3, 5})
+        self.assertEqual(tree.count_within('192.0.2.0/24'), 4)
+        self.assertEqual(tree.within('::/0'), {6, 7})
+        self.assertEqual(tree.within('10.0.0.0/8'), set())
+
+        tree.discard('192.0.2.0/25', 2)
+        tree.discard('192.0.2.0/25', 2)
+        tree.discard('192.0.2.1', 1)  # Not present
+        self.assertEqual(len(tree), 6)
+        self.assertEqual(tree.covering('192.0.2.10'), {1, 3, 4})
+        self.assertEqual(tree.count_within('192.0.2.0/24'), 3)
+        self.assertRaises(ValueError, tree.add, 'not an ip', 8)
+
+    def test_find(self):
+        self.assertEqual(self.find('*!*@*.EXAMPLE.com'), {'0ALAAAAA0', '0ALAAAAA1'})
+        self.assertEqual(self.find('*!*@192.0.2.*'), {'0ALAAAAA0', '0ALAAAAA1', '0ALAAAAA3'})
+        self.assertEqual(self.find('*!*@192.0.2.0/30'), {'0ALAAAAA0', '0ALAAAAA1', '0ALAAAAA3'})
+        self.assertEqual(self.find('*!*@2001:db8::/32'), {'0ALAAAAA4'})
+        self.assertEqual(self.find('nick2!*@*'), {'0ALAAAAA2'})
+        self.assertEqual(self.find('*!user1*@*'), {'0ALAAAAA1'})
+        self.assertIsNone(self.find('*!*@*'))
+        self.assertIsNone(self.find('$pylinkacc'))
+        self.assertIsNone(self.find('!*!*@*.example.com'))
+
+    def test_index_updates(self):
+        self.irc.users.index  # Create the index
+        user = self.irc.users['0ALAAAAA2']
+        user.host = 'c.example.com'
+        user.nick = 'Renamed'
+        self.assertEqual(self.find('*!*@*.example.com'), {'0ALAAAAA0', '0ALAAAAA1', '0ALAAAAA2'})
+        self.assertEqual(self.find('renamed!*@*'), {'0ALAAAAA2'})
+        self.assertEqual(self.find('nick2!*@*'), set())
+        self.assertEqual(user.get_fields()['host'], 'c.example.com')
+
+        del self.irc.users['0ALAAAAA0']
+        self.assertEqual(self.find('*!*@*.example.com'), {'0ALAAAAA1', '0ALAAAAA2'})
+
+        # Users that can't be split into nick, ident and host are always candidates.
+        self.irc.users['0ALAAAAA1'].ident = 'bad@ident'
+        self.assertEqual(self.find('*!*@other.host'), {'0ALAAAAA1', '0ALAAAAA2'})  # Real host of 2
+
+    def test_match_all(self):
+        f = self.irc.match_all
+        self.assertEqual(list(f('*!*@*.example.com')), ['0ALAAAAA0', '0ALAAAAA1'])
+        self.assertEqual(list(f('*!*@192.0.2.0/24')), ['0ALAAAAA0', '0ALAAAAA1', '0ALAAAAA3'])
+        self.assertEqual(list(f('*!*@*.example.com', channel='#TEST')), ['0ALAAAAA0'])
+        self.assertEqual(list(f('*', channel='#test')), [])
+        self.assertEqual(list(f('*!*@*', channel='#test')), ['0ALAAAAA0', '0ALAAAAA2'])
+        self.assertEqual(list(f('*!*@*', channel='#nonexistent')), [])
+        self.assertEqual(list(self.irc.match_all_re(r'nick\d!.*', channel='#test')), ['0ALAAAAA0', '0ALAAAAA2'])
+
+class CasefolderTestCase(unittest.TestCase):
+
+    def test_casefolding(self):
+        casefolder = structures.IRCCasefolder()
+        self.assertEqual(casefolder.fold('Nick{Away}|~'), 'nick[away]\\^')
+        self.assertEqual(casefolder.fold('ÄBC'), 'Äbc')  # Only ASCII is folded
+        self.assertIsNone(casefolder.fold(None))
+        self.assertEqual(casefolder.fold(''), '')
+
+        casefolder.set_casemapping('ascii')
+        self.assertEqual(casefolder.fold('Nick{Away}'), 'nick{away}')
+        casefolder.set_casemapping('unknown')
+        self.assertEqual(casefolder.fold('Nick{Away}'), 'nick{away}')
+
+    def test_cache(self):
+        casefolder = structures.IRCCasefolder(maxsize=2)
+        first = casefolder.fold('FIRST')
+        self.assertIs(casefolder.fold(''.join(['Fir', 'st'])), first)  # Folded strings are interned
+        casefolder.fold('second')
+        casefolder.fold('third')
+        self.assertEqual(casefolder.get_stats(), {'casemapping': 'rfc1459', 'size': 2, 'maxsize': 2,
+                                                  'hits': 0, 'misses': 4, 'hit_rate': 0.0})
+        casefolder.fold('third')
+        self.assertEqual(casefolder.get_stats()['hit_rate'], 0.2)
+
+    def test_network_casemapping(self):
+        # This creates a default server block for the network.
+        conf.conf['servers']['classtest']
+        irc = inspircd.Class('classtest')
+        irc2 = inspircd.Class('classtest')
+        self.assertEqual(irc.to_lower('A{B}'), 'a[b]')
+        irc.casemapping = 'ascii'
+        self.assertEqual(irc.to_lower('A{B}'), 'a{b}')
+        self.assertEqual(irc2.to_lower('A{B}'), 'a[b]')  # Each network has its own casefolder
+
+    def test_to_lower_override(self):
+        class SubclassProtocol(inspircd.Class):
+            def to_lower(self, text):
+                return text.upper()
+
+        conf.conf['servers']['classtest']
+        irc = SubclassProtocol('classtest')
+        self.assertEqual(irc.to_lower('Nick'), 'NICK')
+
+if __name__ == '__main__':
+    unittest.main()
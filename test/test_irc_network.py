@@ -0,0 +1,236 @@
+"""
+Test cases for the socket handling parts of classes.IRCNetwork.
+"""
+
+import collections
+import socket
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+from pylinkirc import classes, structures, world
+
+
+class SocketTestNetwork(classes.IRCNetwork):
+    """IRCNetwork stub with a real socket, which records the lines it parses."""
+    def __init__(self):
+        self._buffer = bytearray()
+        self._recv_buffer = bytearray(self.RECV_SIZE_MAX)
+        self._recv_size = self.RECV_SIZE_MIN
+        self._aborted = threading.Event()
+        self.encoding = 'utf-8'
+        self.ssl = False
+        self.name = 'test'
+        self.lines = []
+        self._socket, self.peer = socket.socketpair()
+        self._socket.setblocking(False)
+        self._queue = structures.LaneQueue(lanes=classes.SENDQ_LANE_BULK+1)
+        self.send_stats = collections.Counter()
+        self.pingfreq = 90
+        self.connected = threading.Event()
+        self.connected.set()
+        self._send_bucket = None
+        self._held_sources = collections.Counter()
+        self._queue_event = None
+        self._write_lock = threading.Lock()
+
+    def parse_irc_command(self, line):
+        self.lines.append(line)
+
+class IRCNetworkSocketTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.irc = SocketTestNetwork()
+
+    def tearDown(self):
+        self.irc._socket.close()
+        self.irc.peer.close()
+
+    def test_partial_lines(self):
+        self.irc.peer.sendall(b':0AL PING 0AL 70M\r\n:0AL PRIV')
+        self.irc._run_irc()
+        self.assertEqual(self.irc.lines, [':0AL PING 0AL 70M'])
+        self.assertEqual(self.irc._buffer, b':0AL PRIV')
+
+        self.irc.peer.sendall(b'MSG #test :hello\n\r\n:0AL ENDBURST\r\n')
+        self.irc._run_irc()
+        self.assertEqual(self.irc.lines, [':0AL PING 0AL 70M', ':0AL PRIVMSG #test :hello', '',
+                                          ':0AL ENDBURST'])
+        self.assertEqual(self.irc._buffer, b'')
+
+    def test_decode_errors(self):
+        self.irc.peer.sendall(b':0AL PRIVMSG #test :\xff\xfe\r\n')
+        self.irc._run_irc()
+        self.assertEqual(self.irc.lines, [':0AL PRIVMSG #test :��'])
+
+    def test_adaptive_recv_size(self):
+        line = b':0AL PRIVMSG #test :' + b'a' * 100 + b'\r\n'
+        self.irc.peer.sendall(line * 1000)
+        self.irc._run_irc()
+        self.assertEqual(self.irc._recv_size, self.irc.RECV_SIZE_MIN * 2)
+        while len(self.irc.lines) < 1000:
+            self.irc._run_irc()
+        self.assertEqual(self.irc._recv_size, self.irc.RECV_SIZE_MAX)
+
+        # Small reads shrink the read size again.
+        self.irc.peer.sendall(line)
+        self.irc._run_irc()
+        self.assertEqual(self.irc._recv_size, self.irc.RECV_SIZE_MAX // 2)
+
+    def _recv_all(self):
+        data = b''
+        self.irc.peer.settimeout(0.1)
+        try:
+            while True:
+                data += self.irc.peer.recv(65536)
+        except socket.timeout:
+            return data
+
+    def test_batched_send(self):
+        for num in range(100):
+            self.irc._queue.put_nowait(':0AL PRIVMSG #test :message %s' % num)
+        with patch.dict(world.networkobjects, test=self.irc):
+            batch, stop, delay = self._get_send_batch()
+        self.assertFalse(stop)
+        self.assertEqual(delay, 0)
+        self.assertEqual(len(batch), 100)
+        self.assertTrue(self.irc._queue.empty())
+
+        self.irc._send_batch(batch)
+        self.assertEqual(self.irc.send_stats, {'lines': 100, 'writes': 1, 'bytes': len(b''.join(batch))})
+        self.assertEqual(self._recv_all(), b''.join(b':0AL PRIVMSG #test :message %d\r\n' % num
+                                                    for num in range(100)))
+
+    def test_concurrent_writes(self):
+        lines = [b':0AL PRIVMSG #test :' + b'a' * 400 + b'\r\n'] * 5000
+        writer = threading.Thread(target=self.irc._send_batch, args=(lines,))
+        writer.start()
+        # Wait until the write is blocked on a full socket buffer.
+        while not self.irc._write_lock.locked():
+            time.sleep(0.001)
+
+        # Unqueued lines wait for the write in progress instead of being sent in the middle of it.
+        sender = threading.Thread(target=self.irc.send, args=(':0AL PONG 0AL 70M',),
+                                  kwargs={'queue': False})
+        sender.start()
+        data = self._recv_all()
+        writer.join()
+        sender.join()
+        self.assertEqual(data, b''.join(lines) + b':0AL PONG 0AL 70M\r\n')
+
+    def test_write_timeout(self):
+        self.irc.pingfreq = 0.1
+        with self.assertRaises(socket.timeout):
+            self.irc._write(b'a' * 10000000)
+        self.assertFalse(self.irc._write_lock.locked())
+
+    def test_unqueued_send_async(self):
+        # With the asyncio driver, unqueued lines go to the front of the queue instead, since the
+        # queue task may be partway through a write.
+        self.irc._queue_event = threading.Event()
+        self.irc._queue_event.set()
+        self.irc.send(':0AL PRIVMSG #test :hello')
+        self.irc.send(':0AL PONG 0AL 70M', queue=False)
+        self.assertEqual(self.irc._queue.get_lane(False), (classes.SENDQ_LANE_KEEPALIVE, ':0AL PONG 0AL 70M'))
+        self.assertEqual(self._recv_all(), b'')
+
+    def test_batch_limits(self):
+        line = ':0AL PRIVMSG #test :' + 'a' * 400
+        for num in range(100):
+            self.irc.send(line)
+        # This is how disconnect() stops the queue.
+        self.irc._queue.put_front(None, classes.SENDQ_LANE_KEEPALIVE)
+
+        with patch.dict(world.networkobjects, test=self.irc):
+            batch, stop, delay = self._get_send_batch()
+            self.assertTrue(stop)
+            self.assertFalse(batch)
+
+            batch, stop, delay = self._get_send_batch()
+            self.assertFalse(stop)
+            self.assertGreaterEqual(len(b''.join(batch)), self.irc.SEND_BATCH_BYTES)
+            self.assertLess(len(batch), 100)
+
+    def _get_send_batch(self):
+        lane, data = self.irc._queue.get_lane(False)
+        return self.irc._get_send_batch(data, lane)
+
+    def test_send_lanes(self):
+        self.irc.send(':0AL PRIVMSG #test :hello')
+        self.irc.send(':0AL UID 0ALAAAAAA 1565000000 user host host ident 127.0.0.1 1565000000 +i :realname')
+        self.irc.send(':0AL FMODE #test 1565000000 +b *!*@bad.host')
+        self.irc.send(':0AL PING 0AL 70M')
+        # Only keepalives go ahead; everything else is sent in order.
+        self.assertEqual([self.irc._queue.get() for _ in range(4)],
+                         [':0AL PING 0AL 70M', ':0AL PRIVMSG #test :hello',
+                          ':0AL UID 0ALAAAAAA 1565000000 user host host ident 127.0.0.1 1565000000 +i :realname',
+                          ':0AL FMODE #test 1565000000 +b *!*@bad.host'])
+
+    def _get_sent_lines(self):
+        lines = []
+        with patch.dict(world.networkobjects, test=self.irc):
+            while not self.irc._queue.empty():
+                batch, stop, delay = self._get_send_batch()
+                lines += [line.decode().rstrip('\r\n') for line in batch]
+                if delay:
+                    break
+        return lines
+
+    def test_send_order(self):
+        lines = [':0ALAAAAAA PRIVMSG #test :hello', ':0ALAAAAAA QUIT :bye',
+                 ':0AL FJOIN #new 1565000000 + :,0ALAAAAAB', ':0AL FMODE #new 1565000000 +nt',
+                 ':0ALAAAAAB NICK newnick 1565000000', 'PING :irc.example.com']
+        for line in lines:
+            self.irc.send(line)
+        self.assertEqual(self._get_sent_lines(), lines[-1:] + lines[:-1])
+
+    def test_send_order_flow_control(self):
+        self.irc._send_bucket = bucket = structures.TokenBucket(0.001, 10)
+        bucket.tokens = 0
+        lines = [':0ALAAAAAA PRIVMSG #test :hello', ':0ALAAAAAA QUIT :bye',
+                 ':0AL FJOIN #new 1565000000 + :,0ALAAAAAB', ':0AL FMODE #new 1565000000 +nt',
+                 ':0ALAAAAAB PRIVMSG #new :hi']
+        for line in lines:
+            self.irc.send(line)
+
+        # With the bucket empty, nothing is sent, but the PRIVMSG and the QUIT following it from
+        # the same sender are held back.
+        self.assertEqual(self._get_sent_lines(), [])
+        self.assertEqual(self.irc._held_sources, {'0ALAAAAAA': 2})
+
+        # Once there are tokens again, the FJOIN and FMODE go first, in order, while the QUIT
+        # still comes after the PRIVMSG before it.
+        bucket.tokens = 10
+        self.assertEqual(self._get_sent_lines(), [lines[2], lines[3], lines[0], lines[1], lines[4]])
+        self.assertFalse(self.irc._held_sources)
+
+    def test_flow_control(self):
+        self.irc._send_bucket = structures.TokenBucket(1, 2)
+        for num in range(3):
+            self.irc.send(':0AL PRIVMSG #test :message %s' % num)
+        self.irc.send('PONG :irc.example.com')
+
+        with patch.dict(world.networkobjects, test=self.irc):
+            # Keepalive lines don't use up tokens, and the rest are sent until the bucket empties.
+            batch, stop, delay = self._get_send_batch()
+            self.assertEqual(len(batch), 3)
+            self.assertGreater(delay, 0)
+            self.assertEqual(self.irc._queue.qsize(), 1)
+
+            # Queued lines are sent in full during bursts.
+            self.irc.connected.clear()
+            batch, stop, delay = self._get_send_batch()
+            self.assertEqual(len(batch), 1)
+            self.assertEqual(delay, 0)
+
+    def test_line_sanitising(self):
+        self.irc.S2S_BUFSIZE = 20
+        encoded = self.irc._encode_line(':0AL PRIVMSG #test :line1\nline2')
+        self.assertEqual(encoded, b':0AL PRIVMSG #test :\r\n')
+        self.irc.S2S_BUFSIZE = 0
+        encoded = self.irc._encode_line(':0AL PRIVMSG #test :line1\nline2')
+        self.assertEqual(encoded, b':0AL PRIVMSG #test :line1 line2\r\n')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -62,6 +62,17 @@ class MessageParserTest(unittest.TestCase):
                     parts = IRCCommonProtocol.parse_args(inp)
                 self.assertEqual(expected, parts, "Parse test failed for string: %r" % inp)
 
+    def testMessageTokenize(self):
+        for testdata in self.MESSAGE_SPLIT_TEST_DATA['tests']:
+            inp = testdata['input']
+            atoms = testdata['atoms']
+
+            with self.subTest():
+                _, prefix, command, params = IRCCommonProtocol.parse_message(inp)
+                self.assertEqual(atoms.get('source'), prefix, "Parse test failed for string: %r" % inp)
+                self.assertEqual(atoms.get('verb', ''), command, "Parse test failed for string: %r" % inp)
+                self.assertEqual(atoms.get('params', []), params, "Parse test failed for string: %r" % inp)
+
     @unittest.skip("Not quite working yet")
     def testMessageTags(self):
         for testdata in self.MESSAGE_SPLIT_TEST_DATA['tests']:
@@ -0,0 +1,116 @@
+"""
+Tests for the single pass message tokenizer (IRCCommonProtocol.parse_message).
+"""
+import unittest
+
+from pylinkirc.protocols.ircs2s_common import IRCCommonProtocol, MessageTags
+
+parse_message = IRCCommonProtocol.parse_message
+
+# Lines taken from real bursts and from ircdocs/parser-tests (msg-split.yaml)
+TEST_LINES = [
+    'foo bar baz asdf',
+    ':coolguy foo bar baz asdf',
+    'foo bar baz :asdf quux',
+    'foo bar baz :',
+    'foo bar baz ::asdf',
+    ':coolguy foo bar baz :asdf quux',
+    ':coolguy foo bar baz :  asdf quux ',
+    ':coolguy PRIVMSG bar :lol :) ',
+    ':coolguy foo bar baz :',
+    ':coolguy foo bar baz :  ',
+    '@a=b;c=32;k;rt=ql7 foo',
+    '@a=b\\\\and\\nk;c=72\\s45;d=gh\\:764 foo',
+    '@c;h=;a=b :quux ab cd',
+    ':src JOIN #chan',
+    ':src JOIN :#chan',
+    ':src AWAY',
+    ':src AWAY ',
+    ':cool\tguy foo bar baz',
+    ':coolguy!ag@net\x035w\x03ork.admin PRIVMSG foo :bar baz',
+    ':coolguy!~ag@n\x02et\x0305w\x0fork.admin PRIVMSG foo :bar baz',
+    '@tag1=value1;tag2;vendor1/tag3=value2;vendor2/tag4= :irc.example.com COMMAND param1 param2 :param3 param3',
+    ':irc.example.com COMMAND param1 param2 :param3 param3',
+    '@tag1=value1;tag2;vendor1/tag3=value2;vendor2/tag4 COMMAND param1 param2 :param3 param3',
+    'COMMAND',
+    '@foo=\\\\\\\\:\\\\s\\s\\r\\n COMMAND',
+    ':gravel.mozilla.org 432  #momo :Erroneous Nickname: Illegal characters',
+    ':gravel.mozilla.org MODE #tckk +n ',
+    ':services.esper.net MODE #foo-bar +o foobar  ',
+    '@tag1=value\\\\ntest COMMAND',
+    '@tag1=value\\1 COMMAND',
+    '@tag1=value1\\ COMMAND',
+    '@tag1=1;tag2=3;tag3=4;tag1=5 COMMAND',
+    '@tag1=1;tag2=3;tag3=4;tag1=5;vendor/tag2=8 COMMAND',
+    ':SomeOp MODE #channel :+i',
+    ':SomeOp MODE #channel +oo SomeUser :AnotherUser',
+    # InspIRCd / TS6 / P10 style S2S lines
+    ':70M UID 70MAAAAAB 1429934638 GL 0::1 hidden-7j810p.0::1 gl 0::1 1429934638 +Wioswx +ACGKNOQXacfgklnoqvx :realname',
+    ':70M FJOIN #chat 1423790411 +AFPfjnt 6:5 7:5 :o,1SRAABIT4 v,1IOAAF53R <...>',
+    ':42XAAAAAB PRIVMSG #test :hello world  with  spaces',
+    ':00A ENCAP * SU 42XAAAAAC :GLolol',
+    'SERVER test.server 1 :Test server',
+    'PASS :abcd',
+    'AB N GL 1 1460673049 ~gl nefarious.midnight.vpn +iw B]AAAB ABAAA :realname',
+    'ABAAA P #test :hello',
+    'AB G !1460745823.89510 Ay 1460745823.89510',
+]
+
+def legacy_parse(line):
+    """
+    Splits a line the way handle_events() did before parse_message() was introduced, returning
+    the same (tags, prefix, command, params) format.
+    """
+    data = line.split(" ")
+    tags = IRCCommonProtocol.parse_message_tags(data)
+    if tags:
+        data = data[1:]
+
+    if data[0].startswith(':'):
+        args = IRCCommonProtocol.parse_prefixed_args(data)
+        prefix = args[0]
+        args = args[1:]
+    else:
+        prefix = None
+        args = IRCCommonProtocol.parse_args(data)
+    return tags, prefix, args[0] if args else '', args[1:]
+
+class MessageTokenizerTest(unittest.TestCase):
+
+    def test_matches_legacy_parser(self):
+        for line in TEST_LINES:
+            with self.subTest(line=line):
+                self.assertEqual(legacy_parse(line), parse_message(line))
+
+    def test_parse_message(self):
+        self.assertEqual(parse_message('@a=b;c :nick!user@host PRIVMSG #chan :hello world'),
+                         ({'a': 'b', 'c': ''}, 'nick!user@host', 'PRIVMSG', ['#chan', 'hello world']))
+        self.assertEqual(parse_message('PING :irc.example.com'),
+                         ({}, None, 'PING', ['irc.example.com']))
+        self.assertEqual(parse_message(':src'), ({}, 'src', '', []))
+        self.assertEqual(parse_message(':src :text'), ({}, 'src', 'text', []))
+
+    def test_message_tags(self):
+        tags = MessageTags('time=2019-08-07T12:00:00.000Z;msgid=abc\\sdef;account=GL;example.com/flag;'
+                           'account=jlu5;empty=')
+        self.assertTrue(tags)
+        self.assertEqual(tags['account'], 'jlu5')  # The last value wins
+        self.assertEqual(tags.get('msgid'), 'abc def')
+        self.assertEqual(tags['example.com/flag'], '')
+        self.assertEqual(tags['empty'], '')
+        self.assertIsNone(tags.get('acc'))
+        self.assertNotIn('account=', tags)
+        # Single lookups don't decode the entire tag string
+        self.assertIsNone(tags._tags)
+
+        expected = {'time': '2019-08-07T12:00:00.000Z', 'msgid': 'abc def', 'account': 'jlu5',
+                    'example.com/flag': '', 'empty': ''}
+        self.assertEqual(dict(tags), expected)
+        self.assertEqual(tags, expected)
+        self.assertEqual(len(tags), 5)
+        self.assertEqual(tags['account'], 'jlu5')
+
+        self.assertFalse(MessageTags(''))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+"""
+Test cases for coremods/permissions.py
+"""
+
+import unittest
+from unittest.mock import patch
+
+from pylinkirc import classes, conf, utils
+from pylinkirc.coremods import exttargets  # Registers exttarget handlers
+from pylinkirc.coremods import permissions
+from pylinkirc.protocols import inspircd
+
+
+class PermissionsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # This creates a default server block for the network.
+        conf.conf['servers']['permtest']
+        self.irc = inspircd.Class('permtest')
+        self.irc.servers['0AL'] = classes.Server(self.irc, None, 'pylink.example.com', internal=True)
+        self.irc.servers['1SV'] = classes.Server(self.irc, '0AL', 'irc.example.com')
+        self.irc.users['1SVAAAAAA'] = classes.User(self.irc, 'user', 0, '1SVAAAAAA', '1SV',
+                                                   host='staff.example.com', ip='192.0.2.10')
+        self.irc.users['1SVAAAAAB'] = classes.User(self.irc, 'other', 0, '1SVAAAAAB', '1SV',
+                                                   host='other.host', ip='198.51.100.1')
+
+        self.permissions = {'*!*@staff.example.com': ['commands.*', 'Opercmds.Kill'],
+                            '*!*@192.0.2.0/24': ['networks.remote'],
+                            '$pylinkacc:admin': ['*'],
+                            '$channel:#staff': ['opercmds.mode']}
+        patcher = patch.dict(conf.conf, {'permissions': self.permissions, 'login': {},
+                                         'permissions_merge_defaults': False})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        permissions._clear_cache()
+
+    def check(self, uid, *perms):
+        try:
+            return permissions.check_permissions(self.irc, uid, list(perms))
+        except utils.NotAuthorizedError:
+            return False
+
+    def test_check_permissions(self):
+        self.assertTrue(self.check('1SVAAAAAA', 'commands.status'))
+        self.assertTrue(self.check('1SVAAAAAA', 'opercmds.kill'))
+        self.assertTrue(self.check('1SVAAAAAA', 'networks.remote'))  # Matched by IP
+        self.assertTrue(self.check('1SVAAAAAA', 'automode.manage', 'commands.echo'))
+        self.assertFalse(self.check('1SVAAAAAA', 'automode.manage'))
+        self.assertFalse(self.check('1SVAAAAAB', 'commands.status'))
+
+        self.irc.users['1SVAAAAAB'].account = 'Admin'
+        self.assertTrue(self.check('1SVAAAAAB', 'automode.manage'))
+        self.irc.users['1SVAAAAAB'].account = ''
+        self.assertFalse(self.check('1SVAAAAAB', 'automode.manage'))
+
+    def test_cache(self):
+        self.assertTrue(self.check('1SVAAAAAA', 'commands.status'))
+        stats = permissions.get_stats()
+        self.assertTrue(self.check('1SVAAAAAA', 'commands.status'))
+        self.assertEqual(permissions.get_stats()['hits'], stats['hits'] + 1)
+
+        # Host changes go through the CHGHOST hook.
+        self.irc.users['1SVAAAAAA'].host = 'not.staff'
+        self.irc.call_hooks(['1SV', 'CHGHOST', {'target': '1SVAAAAAA', 'newhost': 'not.staff'}])
+        self.assertFalse(self.check('1SVAAAAAA', 'commands.status'))
+
+        self.irc.call_hooks(['1SVAAAAAA', 'QUIT', {'text': 'bye'}])
+        self.assertNotIn('1SVAAAAAA', permissions._decisions[self.irc.name])
+
+    def test_channel_not_cached(self):
+        self.assertFalse(self.check('1SVAAAAAB', 'opercmds.mode'))
+        self.irc._channels['#staff'].users.add('1SVAAAAAB')
+        self.assertTrue(self.check('1SVAAAAAB', 'opercmds.mode'))
+
+    def test_recompile(self):
+        self.assertFalse(self.check('1SVAAAAAB', 'servermaps.map'))
+
+        permissions.add_default_permissions({'*!*@other.host': ['servermaps.map']})
+        try:
+            with patch.dict(conf.conf, {'permissions_merge_defaults': True}):
+                self.assertTrue(self.check('1SVAAAAAB', 'servermaps.map'))
+        finally:
+            permissions.remove_default_permissions({'*!*@other.host': ['servermaps.map']})
+
+        # A rehash loads a new permissions block.
+        conf.conf['permissions'] = {'*!*@other.host': ['servermaps.*']}
+        self.assertTrue(self.check('1SVAAAAAB', 'servermaps.map'))
+        self.assertFalse(self.check('1SVAAAAAA', 'commands.status'))
+
+if __name__ == '__main__':
+    unittest.main()
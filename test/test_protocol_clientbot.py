@@ -31,6 +31,30 @@ class ClientbotProtocolTest(ptf.BaseProtocolTest):
             check('100', '100')    # already a UID
             check('Test', 'Test')  # non-existent
 
+    def test_get_command_handler(self):
+        # Class level aliases and instance level aliases are both found
+        self.assertEqual(self.p._get_command_handler('354'), self.p.handle_352)
+        self.assertEqual(self.p._get_command_handler('privmsg'), self.p.handle_privmsg)
+        self.assertEqual(self.p._get_command_handler('NOTICE'), self.p.handle_privmsg)
+        self.assertEqual(self.p._get_command_handler('465'), self.p.handle_error)
+
+        self.assertIsNone(self.p._get_command_handler('SOMETHINGWEIRD'))
+        self.assertIn('SOMETHINGWEIRD', self.p._command_handler_cache)
+
+    def test_command_handlers_per_class(self):
+        class SubclassProtocol(self.proto_class):
+            def handle_somethingnew(self, source, command, args):
+                pass
+
+        self.assertNotIn('SOMETHINGNEW', self.proto_class._get_command_handlers())
+        self.assertEqual(SubclassProtocol._get_command_handlers()['SOMETHINGNEW'],
+                         'handle_somethingnew')
+        self.assertEqual(SubclassProtocol._get_command_handlers()['354'], 'handle_354')
+
+    def test_unhandled_commands(self):
+        self.p.handle_events(':irc.example.com SOMETHINGWEIRD pylink :hello')
+        self.p.handle_events(':irc.example.com SOMETHINGWEIRD pylink :hello')
+        self.assertEqual(self.p.unhandled_commands['SOMETHINGWEIRD'], 2)
 
     # In the future we will have protocol specific test cases here
 
@@ -0,0 +1,197 @@
+"""
+Test cases for the Relay plugin's internal state.
+"""
+
+import threading
+import unittest
+from unittest.mock import patch
+
+from pylinkirc import classes, conf, world
+from pylinkirc.plugins import relay
+from pylinkirc.protocols import inspircd
+
+
+def tearDownModule():
+    # Stop the DB save loop started when the plugin was imported.
+    if relay.datastore.exportdb_timer:
+        relay.datastore.exportdb_timer.cancel()
+
+class FakeNetwork():
+    def __init__(self, name):
+        self.name = name
+        self.replies = []
+        self.connected = threading.Event()
+        self.connected.set()
+
+    def to_lower(self, text):
+        return text.lower()
+
+    def reply(self, text, **kwargs):
+        self.replies.append(text)
+
+def make_entry(*links):
+    return {'links': set(links), 'blocked_nets': set(), 'allowed_nets': set(), 'claim': []}
+
+class RelayIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        patchers = [patch.dict(relay.db, clear=True), patch.dict(relay.relay_links, clear=True),
+                    patch.dict(relay.relay_plans, clear=True), patch.dict(relay.relayservers, clear=True),
+                    patch.dict(relay.relayusers, clear=True), patch.dict(relay.relayusers_by_net, clear=True)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        relay.db[('hub', '#chat')] = make_entry(('leaf1', '#chat'), ('leaf2', '#lobby'))
+        relay.db[('leaf1', '#dev')] = make_entry(('hub', '#dev'))
+        relay._rebuild_relay_links()
+
+    def test_get_relay(self):
+        self.assertEqual(relay.get_relay(FakeNetwork('hub'), '#Chat'), ('hub', '#chat'))
+        self.assertEqual(relay.get_relay(FakeNetwork('leaf1'), '#chat'), ('hub', '#chat'))
+        self.assertEqual(relay.get_relay(FakeNetwork('leaf2'), '#LOBBY'), ('hub', '#chat'))
+        self.assertEqual(relay.get_relay(FakeNetwork('hub'), '#dev'), ('leaf1', '#dev'))
+        self.assertIsNone(relay.get_relay(FakeNetwork('leaf2'), '#chat'))
+
+    def test_link_delink(self):
+        relay._add_link(('hub', '#chat'), ('leaf3', '#chat'))
+        self.assertIn(('leaf3', '#chat'), relay.db[('hub', '#chat')]['links'])
+        self.assertEqual(relay.get_relay(FakeNetwork('leaf3'), '#chat'), ('hub', '#chat'))
+
+        relay._remove_link(('hub', '#chat'), ('leaf1', '#chat'))
+        self.assertNotIn(('leaf1', '#chat'), relay.db[('hub', '#chat')]['links'])
+        self.assertIsNone(relay.get_relay(FakeNetwork('leaf1'), '#chat'))
+
+        relay._remove_relay(('hub', '#chat'))
+        self.assertNotIn(('hub', '#chat'), relay.db)
+        self.assertEqual(relay.relay_links, {('hub', '#dev'): ('leaf1', '#dev')})
+
+    def test_purge(self):
+        irc = FakeNetwork('hub')
+        with patch.object(relay.permissions, 'check_permissions'):
+            relay.purge(irc, 'someone', ['leaf1'])
+        self.assertEqual(irc.replies, ['Done. Purged 2 entries involving the network leaf1.'])
+        self.assertEqual(relay.db, {('hub', '#chat'): make_entry(('leaf2', '#lobby'))})
+        self.assertEqual(relay.relay_links, {('leaf2', '#lobby'): ('hub', '#chat')})
+
+    def test_relay_targets(self):
+        networks = {name: FakeNetwork(name) for name in ('hub', 'leaf1', 'leaf2', 'other')}
+        networks['leaf2'].connected.clear()
+        relay.relayservers['leaf1']['hub'] = '1AA'
+
+        with patch.dict(world.networkobjects, networks):
+            targets = relay.get_relay_targets(networks['hub'], '#chat')
+            self.assertEqual(targets, [(networks['leaf1'], '#chat', '1AA')])
+            self.assertIs(relay.get_relay_targets(networks['hub'], '#chat'), targets)
+
+            calls = []
+            relay.iterate_relay(networks['hub'], '#chat', lambda *args: calls.append(args),
+                                extra_args=('text',))
+            self.assertEqual(calls, [(networks['hub'], networks['leaf1'], '#chat', '1AA', 'text')])
+
+            # Plans are rebuilt when the links change.
+            networks['leaf2'].connected.set()
+            relay._add_link(('hub', '#chat'), ('other', '#chat2'))
+            self.assertCountEqual(relay.get_relay_targets(networks['leaf1'], '#chat'),
+                                  [(networks['hub'], '#chat', None),
+                                   (networks['leaf2'], '#lobby', None),
+                                   (networks['other'], '#chat2', None)])
+            self.assertEqual(relay.get_relay_targets(networks['other'], '#elsewhere'), [])
+
+    def test_plan_burst(self):
+        networks = {name: FakeNetwork(name) for name in ('hub', 'leaf1', 'leaf2')}
+        networks['leaf2'].connected.clear()
+        relay.db[('leaf2', '#help')] = make_entry(('hub', '#help'))
+
+        with patch.dict(world.networkobjects, networks):
+            channels, targets = relay._plan_burst(networks['hub'])
+        self.assertEqual(channels, {'#chat', '#dev', '#help'})
+        # Disconnected networks are skipped.
+        self.assertEqual(list(targets), ['leaf1'])
+        self.assertCountEqual(targets['leaf1'], [('#chat', '#chat'), ('#dev', '#dev')])
+
+    def test_burst_thread_errors(self):
+        hub, leaf1 = FakeNetwork('hub'), FakeNetwork('leaf1')
+        with patch.object(relay, '_burst_network', side_effect=KeyError('#chat')), \
+                patch.object(relay.log, 'exception') as exception:
+            relay._burst_network_thread(hub, leaf1, [('#chat', '#chat')])
+        self.assertEqual(exception.call_count, 1)
+
+    def test_relayusers_index(self):
+        relay._add_relay_user(('hub', '1AAAAAAAA'), 'leaf1', '2AAAAAAAA')
+        relay._add_relay_user(('hub', '1AAAAAAAA'), 'leaf2', '3AAAAAAAA')
+        relay._add_relay_user(('leaf1', '2AAAAAAAB'), 'hub', '1AAAAAAAB')
+        relay._add_relay_user(('leaf2', '3AAAAAAAB'), 'hub', '1AAAAAAAC')
+        self.assertEqual(relay.relayusers_by_net['leaf1'], {('hub', '1AAAAAAAA'), ('leaf1', '2AAAAAAAB')})
+
+        relay._remove_relay_user(('hub', '1AAAAAAAA'), 'leaf2')
+        self.assertEqual(relay.relayusers[('hub', '1AAAAAAAA')], {'leaf1': '2AAAAAAAA'})
+        self.assertEqual(relay.relayusers_by_net['leaf2'], {('leaf2', '3AAAAAAAB')})
+
+        irc = FakeNetwork('leaf1')
+        with patch.dict(world.networkobjects, clear=True):
+            relay.handle_disconnect(irc, None, 'PYLINK_DISCONNECT', {'was_successful': False})
+        self.assertEqual(relay.relayusers, {('hub', '1AAAAAAAA'): {},
+                                            ('leaf2', '3AAAAAAAB'): {'hub': '1AAAAAAAC'}})
+        self.assertNotIn('leaf1', relay.relayusers_by_net)
+        self.assertEqual(relay.relayusers_by_net['hub'], {('hub', '1AAAAAAAA'), ('leaf2', '3AAAAAAAB')})
+
+class NormalizeNickTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # This creates a default server block for the network.
+        conf.conf['servers']['relaytest']
+        self.irc = inspircd.Class('relaytest')
+        self.irc.serverdata = {}
+        self.irc.maxnicklen = 16
+
+    def _add_user(self, nick, uid):
+        self.irc.users[uid] = classes.User(self.irc, nick, 0, uid, '0AL')
+
+    def test_normalize_nick(self):
+        self.assertEqual(relay.normalize_nick(self.irc, 'net', 'GL'), 'GL/net')
+        self.assertEqual(relay.normalize_nick(self.irc, 'net', 'a long (nick) name'), 'a-long-[nick/net')
+        self.assertEqual(relay.normalize_nick(self.irc, 'net', '1nick'), '_1nick/net')
+
+        # Slashes are replaced on IRCds that don't support them.
+        self.irc.protocol_caps.discard('slash-in-nicks')
+        self.assertEqual(relay.normalize_nick(self.irc, 'net', 'a/b'), 'a|b|net')
+
+    def test_nick_collisions(self):
+        self.irc.serverdata['relay_tag_nicks'] = False
+        self.assertEqual(relay.normalize_nick(self.irc, 'net', 'guest1'), 'guest1')
+
+        self._add_user('guest1', '0ALAAAAAA')
+        self._add_user('guest1/net', '0ALAAAAAB')
+        self._add_user('guest1//net', '0ALAAAAAC')
+        self.assertEqual(relay.normalize_nick(self.irc, 'net', 'GUEST1'), 'GUEST1///net')
+        # Nick changes don't collide with the user's own nick.
+        self.assertEqual(relay.normalize_nick(self.irc, 'net', 'guest1', uid='0ALAAAAAA'), 'guest1')
+        self.assertEqual(relay.normalize_nick(self.irc, 'net', 'guest1', times_tagged=1,
+                                              uid='0ALAAAAAB'), 'guest1/net')
+
+class RelayClientTestCase(unittest.TestCase):
+
+    def test_relay_client(self):
+        # This creates a default server block for the network.
+        conf.conf['servers']['relaytest']
+        irc = inspircd.Class('relaytest')
+        host = ''.join(['relay', '.example.com'])
+        u1 = relay.RelayClient(irc, 'user1/net', 0, '0ALAAAAAA', '0AL', host=host, realhost=host)
+        host2 = ''.join(['relay.', 'example.com'])
+        u2 = relay.RelayClient(irc, 'user2/net', 0, '0ALAAAAAB', '0AL', host=host2, realhost=host2)
+        self.assertIs(u1.host, u2.host)
+        self.assertIs(u1.modes, u2.modes)
+        self.assertFalse(u1.modes)
+        self.assertFalse(hasattr(u1, 'remote'))
+
+        u1.remote = ('othernet', '1AAAAAAAA')
+        self.assertFalse(u1.__dict__)
+        fields = u1.get_fields()
+        self.assertEqual(fields['remote'], ('othernet', '1AAAAAAAA'))
+        self.assertEqual(fields['nick'], 'user1/net')
+        self.assertEqual(fields['host'], 'relay.example.com')
+        self.assertNotIn('channels', fields)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+"""
+Test cases for selectdriver.py
+"""
+
+import socket
+import threading
+import unittest
+from unittest.mock import patch
+
+from pylinkirc import conf, selectdriver
+
+
+class FakeNetwork():
+    def __init__(self, name, **serverdata):
+        self.name = name
+        self.serverdata = serverdata
+        self._socket, self._peer = socket.socketpair()
+        self._aborted = threading.Event()
+
+class SelectDriverTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.networks = []
+        self._reset(4)
+
+    def tearDown(self):
+        for irc in self.networks:
+            irc._socket.close()
+            irc._peer.close()
+        self._reset(1)
+
+    def _reset(self, shards):
+        selectdriver._shards.clear()
+        selectdriver._ring.clear()
+        selectdriver._assignments.clear()
+        selectdriver._overrides.clear()
+        selectdriver._last_busy.clear()
+        with patch.dict(conf.conf['pylink'], selector_shards=shards):
+            selectdriver._init_shards()
+
+    def _network(self, name, **serverdata):
+        irc = FakeNetwork(name, **serverdata)
+        self.networks.append(irc)
+        return irc
+
+    def test_consistent_assignment(self):
+        first = [selectdriver._get_shard(self._network('net%s' % n)).num for n in range(50)]
+        second = [selectdriver._get_shard(self._network('net%s' % n)).num for n in range(50)]
+        self.assertEqual(first, second)
+        # Networks should be spread across more than one shard.
+        self.assertGreater(len(set(first)), 1)
+
+    def test_pinned_shard(self):
+        irc = self._network('pinned', selector_shard=3)
+        selectdriver.register(irc)
+        self.assertIs(selectdriver._assignments[irc], selectdriver._shards[3])
+
+        # Out of range values are ignored.
+        irc2 = self._network('pinned2', selector_shard=10)
+        self.assertIsNone(selectdriver._get_pinned_shard(irc2))
+
+    def test_register_unregister(self):
+        irc = self._network('testnet')
+        selectdriver.register(irc)
+        shard = selectdriver._assignments[irc]
+        self.assertIn(irc, shard.networks)
+        self.assertEqual(shard.selector.get_key(irc._socket).data, irc)
+
+        selectdriver.unregister(irc)
+        self.assertNotIn(irc, shard.networks)
+        self.assertRaises(KeyError, shard.selector.get_key, irc._socket)
+        self.assertRaises(KeyError, selectdriver.unregister, irc)
+
+    def test_stats_after_unregister(self):
+        irc = self._network('testnet')
+        selectdriver.register(irc)
+        shard = selectdriver._assignments[irc]
+        shard._record_event(irc, 0.5)
+        self.assertEqual(shard.busy[irc], 0.5)
+
+        # Events that finish after the network was unregistered (e.g. when the read handler
+        # disconnected it) only count towards the shard totals.
+        selectdriver.unregister(irc)
+        shard._record_event(irc, 0.25)
+        self.assertNotIn(irc, shard.events)
+        self.assertNotIn(irc, shard.busy)
+        self.assertEqual(shard.total_events, 2)
+        self.assertEqual(shard.total_busy, 0.75)
+
+        with patch.object(selectdriver, '_last_rebalance', 0), \
+                patch('time.time', return_value=100):
+            selectdriver._maybe_rebalance()
+        self.assertNotIn(irc, selectdriver._last_busy)
+
+    def test_rebalance(self):
+        busy = self._network('busy', selector_shard=0)
+        quiet = self._network('quiet', selector_shard=0)
+        pinned = self._network('pinned', selector_shard=0)
+        for irc in (busy, quiet, pinned):
+            selectdriver.register(irc)
+
+        # Unpin the networks we want the rebalancer to consider.
+        del busy.serverdata['selector_shard']
+        del quiet.serverdata['selector_shard']
+
+        source = selectdriver._shards[0]
+        source.busy.update({busy: 5, quiet: 3, pinned: 20})
+        with patch.object(selectdriver, '_last_rebalance', 0), \
+                patch('time.time', return_value=100):
+            selectdriver._maybe_rebalance()
+
+        # The busy network is picked, since moving the pinned one isn't allowed.
+        self.assertEqual(len(source.pending_moves), 1)
+        self.assertIs(source.pending_moves[0][0], busy)
+
+        source._process_moves()
+        target = selectdriver._assignments[busy]
+        self.assertIsNot(target, source)
+        self.assertEqual(target.selector.get_key(busy._socket).data, busy)
+        self.assertNotIn(busy, source.networks)
+        # Reconnects keep the network on its new shard.
+        self.assertIs(selectdriver._get_shard(busy), target)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,9 +2,11 @@
 Test cases for utils.py
 """
 
+import collections
 import unittest
+from unittest.mock import patch
 
-from pylinkirc import utils
+from pylinkirc import conf, utils, world
 
 
 class UtilsTestCase(unittest.TestCase):
@@ -271,5 +273,50 @@ class UtilsTestCase(unittest.TestCase):
         with self.assertRaises(ValueError):
             f([], set())  # mismatched type
 
+    def test_add_hook(self):
+        def hook1(irc, source, command, args):
+            pass
+        def hook2(irc, source, command, args):
+            pass
+        def hook3(irc, source, command, args):
+            pass
+
+        with patch.object(world, 'hooks', collections.defaultdict(list)), \
+                patch.object(world, '_hook_dispatch', {}):
+            utils.add_hook(hook1, 'privmsg')
+            utils.add_hook(hook2, 'PRIVMSG', priority=500)
+            utils.add_hook(hook3, 'PRIVMSG')
+            self.assertEqual(world._hook_dispatch, {'PRIVMSG': (hook2, hook1, hook3)})
+
+            world.hooks['PRIVMSG'].remove((500, hook2))
+            utils._rebuild_hook_dispatch()
+            self.assertEqual(world._hook_dispatch, {'PRIVMSG': (hook1, hook3)})
+
+            world.hooks['PRIVMSG'].clear()
+            utils._rebuild_hook_dispatch('PRIVMSG')
+            self.assertEqual(world._hook_dispatch, {})
+
+    def test_record_timing(self):
+        class FakeIRC():
+            name = 'test'
+
+        stats = {}
+        key = ('pylinkirc.plugins.test', 'identify', 'identify')
+        with patch.dict(conf.conf['pylink'], slow_hook_threshold=0.5), \
+                patch.object(utils.log, 'warning') as warning:
+            for num in range(100):
+                utils._record_timing(stats, key, 0.01 * num, FakeIRC())
+
+            timing = stats[key]
+            self.assertEqual(timing.count, 100)
+            self.assertAlmostEqual(timing.total, 49.5)
+            self.assertAlmostEqual(timing.max, 0.99)
+            self.assertAlmostEqual(timing.percentile(99), 0.99)
+            self.assertAlmostEqual(timing.percentile(50), 0.5)
+            # Calls taking 0.51-0.99 seconds are logged
+            self.assertEqual(warning.call_count, 49)
+            self.assertEqual(warning.call_args[0][1:], ('test', 'hook', 'pylinkirc.plugins.test',
+                                                        'identify', 'identify', 0.99))
+
 if __name__ == '__main__':
     unittest.main()
@@ -7,18 +7,20 @@ framework.
 
 import argparse
 import collections
+import collections.abc
 import functools
 import importlib
 import ipaddress
 import os
 import re
 import string
+import time
 
 # Load the protocol and plugin packages.
 from pylinkirc import plugins, protocols
 
 from . import conf, structures, world
-from .log import log
+from .log import debug_enabled, log
 
 __all__ = ['PLUGIN_PREFIX', 'PROTOCOL_PREFIX', 'NORMALIZEWHITESPACE_RE',
            'NotAuthorizedError', 'InvalidArgumentsError', 'ProtocolError',
@@ -26,7 +28,7 @@ __all__ = ['PLUGIN_PREFIX', 'PROTOCOL_PREFIX', 'NORMALIZEWHITESPACE_RE',
            'ServiceBot', 'register_service', 'unregister_service',
            'wrap_arguments', 'IRCParser', 'strip_irc_formatting',
            'remove_range', 'get_hostname_type', 'parse_duration', 'match_text',
-           'merge_iterables']
+           'CompiledMask', 'MaskSet', 'merge_iterables']
 
 
 PLUGIN_PREFIX = plugins.__name__ + '.'
@@ -63,8 +65,42 @@ def add_hook(func, command, priority=100):
     command = command.upper()
     world.hooks[command].append((priority, func))
     world.hooks[command].sort(key=lambda pair: pair[0], reverse=True)
+    _rebuild_hook_dispatch(command)
     return func
 
+def _rebuild_hook_dispatch(command=None):
+    """
+    Rebuilds the hook dispatch table used by call_hooks() for the given hook name, or for all
+    hooks if no name is given. This must be called whenever world.hooks is changed.
+    """
+    if command is None:
+        world._hook_dispatch = {name: tuple(pair[1] for pair in hookpairs)
+                                for name, hookpairs in world.hooks.items() if hookpairs}
+    elif world.hooks.get(command):
+        world._hook_dispatch[command] = tuple(pair[1] for pair in world.hooks[command])
+    else:
+        world._hook_dispatch.pop(command, None)
+
+def _record_timing(stats, key, elapsed, irc):
+    """
+    Records the run time of a hook or command function in the given stats dict (world.hook_stats
+    or world.command_stats), logging a warning if it took longer than pylink::slow_hook_threshold.
+
+    The warning only names the function and command: the arguments are left out since they may
+    contain passwords (e.g. for IDENTIFY).
+    """
+    try:
+        stats[key].add(elapsed)
+    except KeyError:
+        stats[key] = timing = structures.TimingStats()
+        timing.add(elapsed)
+
+    threshold = conf.conf['pylink'].get('slow_hook_threshold', 0.5)
+    if threshold and elapsed > threshold:
+        log.warning('(%s) Slow %s %s.%s (for %s) took %.3f seconds', irc.name,
+                    'command' if stats is world.command_stats else 'hook', key[0], key[1], key[2],
+                    elapsed)
+
 def expand_path(path):
     """
     Returns a path expanded with environment variables and home folders (~) expanded, in that order."""
@@ -289,7 +325,10 @@ class ServiceBot():
             return
 
         log.info('(%s/%s) Calling command %r for %s', irc.name, self.name, cmd, irc.get_hostmask(source))
+        profile = conf.conf['pylink'].get('hook_profiling')
         for func in self.commands[cmd]:
+            if profile:
+                started = time.perf_counter()
             try:
                 func(irc, source, cmd_args)
             except NotAuthorizedError as e:
@@ -301,6 +340,10 @@ class ServiceBot():
             except Exception as e:
                 log.exception('Unhandled exception caught in command %r', cmd)
                 self.reply(irc, 'Uncaught exception in command %r: %s: %s' % (cmd, type(e).__name__, str(e)))
+            finally:
+                if profile:
+                    _record_timing(world.command_stats, (func.__module__, func.__name__, cmd),
+                                   time.perf_counter() - started, irc)
 
     def add_cmd(self, func, name=None, featured=False, aliases=None):
         """Binds an IRC command function to the given command name."""
@@ -861,6 +904,293 @@ def match_text(glob, text, filterfunc=str.lower):
 
     return re.match(_glob2re(glob), text)
 
+def _compile_glob(glob):
+    """
+    Returns a function checking whether text matches the given IRC-style glob. Globs without
+    wildcards are compared as plain strings.
+    """
+    if '*' in glob or '?' in glob:
+        return re.compile(_glob2re(glob)).match
+    # Not glob.__eq__, which returns NotImplemented (which is truthy) for non-str text like None.
+    return lambda text: text == glob
+
+@functools.lru_cache(maxsize=4096)
+def _parse_ip(ip):
+    """Returns the given IP address as an ipaddress object, or None if it is invalid."""
+    try:
+        return ipaddress.ip_address(ip)
+    except ValueError:
+        return None
+
+def _get_match_hosts(irc, uid, ip=True, realhost=True):
+    """
+    Returns a tuple of the casefolded hostmasks that match_host() checks for the given UID.
+    """
+    hosts = [irc.to_lower(irc.get_hostmask(uid))]
+    if ip:
+        hosts.append(irc.to_lower(irc.get_hostmask(uid, ip=True)))
+    if realhost:
+        hosts.append(irc.to_lower(irc.get_hostmask(uid, realhost=True)))
+    return tuple(set(hosts)) if len(hosts) > 1 else tuple(hosts)
+
+class CompiledMask():
+    """
+    A hostmask or exttarget parsed once for repeated matching under a network's match_host()
+    rules. Use the network's compile_mask() method to get (cached) instances of this class.
+    """
+    __slots__ = ('mask', 'casemapping', 'invert', 'glob', 'exttarget', 'exttarget_name',
+                 'cidr', 'cidr_header', '_match', '_exttarget_match')
+
+    def __init__(self, irc, mask):
+        self.mask = mask
+        self.casemapping = irc.casemapping
+
+        # Allow queries like !$exttarget to invert the given match.
+        self.invert = mask.startswith('!')
+        glob = mask.lstrip('!')
+
+        # This is used for host targets, and for UID targets when the glob isn't an exttarget.
+        self.glob = irc.to_lower(glob)
+        self._match = _compile_glob(self.glob)
+
+        self.exttarget = self.exttarget_name = None
+        # The exttarget handler this mask was last compiled for, and its compiled match function.
+        self._exttarget_match = (None, None)
+        self.cidr = self.cidr_header = None
+
+        if not irc.is_hostmask(glob) and not any(char in glob for char in '$:()'):
+            # Implicitly convert matches for *sane* account names to "$pylinkacc:accountname".
+            # XXX: we should probably add proper rules on what's a valid account name
+            glob = '$pylinkacc:' + glob
+
+        if glob.startswith('$'):
+            # Exttargets start with $. The handler itself is looked up when matching, so that
+            # exttargets added by plugins loaded later are also found.
+            self.exttarget = glob.lstrip('$')
+            self.exttarget_name = self.exttarget.split(':', 1)[0]
+        elif '@' in glob:
+            # Support CIDR ranges in the host portion.
+            header, cidrtarget = glob.split('@', 1)
+            try:
+                self.cidr = ipaddress.ip_network(cidrtarget)
+            except ValueError:
+                pass
+            else:
+                self.cidr_header = header
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.mask)
+
+    def match(self, irc, target, ip=True, realhost=True, hosts=None):
+        """
+        Returns whether the given host or UID matches this mask, like irc.match_host().
+
+        hosts optionally gives the result of _get_match_hosts() for a UID target, so that callers
+        matching one user against many masks only have to build these once.
+        """
+        return self._match_core(irc, target, ip, realhost, hosts) != self.invert
+
+    def _match_core(self, irc, target, ip, realhost, hosts):
+        """
+        Core processor for match(), minus the inversion check.
+        """
+        if target not in irc.users:
+            # We were given a host, use that.
+            return bool(self._match(irc.to_lower(target)))
+
+        if self.exttarget_name is not None:
+            handler = world.exttarget_handlers.get(self.exttarget_name)
+            if handler:
+                # Handler exists. Return what it finds, compiling the exttarget first if the
+                # handler supports it. Plugins can replace handlers at any time, so this is
+                # redone whenever the handler changes.
+                compiled_handler, predicate = self._exttarget_match
+                if compiled_handler is not handler:
+                    compiler = getattr(handler, 'compile', None)
+                    predicate = compiler(irc, self.exttarget) if compiler else None
+                    self._exttarget_match = (handler, predicate)
+
+                if predicate is not None:
+                    result = bool(predicate(irc, target))
+                else:
+                    result = bool(handler(irc, self.exttarget, target))
+                if debug_enabled():
+                    log.debug('(%s) Got %s from exttarget %s in match_host() glob $%s for target %s',
+                              irc.name, result, self.exttarget_name, self.exttarget, target)
+                return result
+            else:
+                log.debug('(%s) Unknown exttarget %s in match_host() glob $%s', irc.name,
+                          self.exttarget_name, self.exttarget)
+                return False
+
+        if hosts is None:
+            hosts = _get_match_hosts(irc, target, ip=ip, realhost=realhost)
+
+        if ip and self.cidr is not None:
+            real_ip = irc.users[target].ip
+            address = _parse_ip(real_ip)
+            if address is not None and address in self.cidr:
+                # If the CIDR matches, pretend that the lookup target was the IP and not the
+                # CIDR range.
+                if debug_enabled():
+                    log.debug('(%s) Found matching CIDR %s for %s, replacing target glob with IP %s',
+                              irc.name, self.cidr, target, real_ip)
+                matcher = _compile_glob(irc.to_lower('@'.join((self.cidr_header, real_ip))))
+                return any(matcher(host) for host in hosts)
+
+        matcher = self._match
+        for host in hosts:
+            if matcher(host):
+                return True
+        return False
+
+class MaskSet():
+    """
+    A collection of masks (hostmasks or exttargets), each with an optional value, that can find
+    all masks matching a target in a single pass.
+
+    Plain globs are indexed by their longest literal prefix or suffix (e.g. "*!*@*.example.com"
+    is filed under ".example.com"), and CIDR masks are also stored in a radix tree by their
+    range, so only masks that could possibly match a target are checked. Exttargets, inverted
+    masks and globs without any literal prefix or suffix are checked for every target.
+    """
+    def __init__(self, irc, masks=None):
+        self.irc = irc
+        # Maps masks to their values, in the order they were added.
+        self.masks = {}
+        self._index = None
+        if masks:
+            self.update(masks)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.masks)
+
+    def __len__(self):
+        return len(self.masks)
+
+    def __iter__(self):
+        return iter(self.masks)
+
+    def __contains__(self, mask):
+        return mask in self.masks
+
+    def add(self, mask, value=None):
+        """Adds a mask with the given value, replacing any existing value for it."""
+        if mask not in self.masks:
+            self._index = None
+        self.masks[mask] = value
+
+    def update(self, masks):
+        """Adds masks from a mapping of masks to values, or an iterable of masks."""
+        if isinstance(masks, collections.abc.Mapping):
+            masks = masks.items()
+        else:
+            masks = ((mask, None) for mask in masks)
+        for mask, value in masks:
+            self.add(mask, value)
+
+    def discard(self, mask):
+        """Removes the given mask, if present."""
+        if mask in self.masks:
+            del self.masks[mask]
+            self._index = None
+
+    def clear(self):
+        """Removes all masks."""
+        self.masks.clear()
+        self._index = None
+
+    def _build_index(self):
+        """Compiles all masks and sorts them into literal, prefix, suffix and fallback indexes."""
+        exact = collections.defaultdict(list)
+        prefixes = collections.defaultdict(list)
+        suffixes = collections.defaultdict(list)
+        cidrs = {}
+        cidr_tree = structures.IPRadixTree()
+        others = []
+
+        for position, mask in enumerate(self.masks):
+            compiled = self.irc.compile_mask(mask)
+            entry = (position, mask, compiled)
+
+            if compiled.invert or compiled.exttarget_name:
+                others.append(entry)
+                continue
+            elif compiled.cidr:
+                # CIDR masks can match either by IP or as text, so they're indexed both ways.
+                cidrs[position] = entry
+                cidr_tree.add(compiled.cidr, position)
+
+            glob = compiled.glob
+            wildcards = [pos for pos, char in enumerate(glob) if char in '*?']
+            if not wildcards:
+                exact[glob].append(entry)
+                continue
+
+            prefix = glob[:wildcards[0]]
+            suffix = glob[wildcards[-1]+1:]
+            if len(prefix) >= len(suffix) and prefix:
+                prefixes[prefix].append(entry)
+            elif suffix:
+                suffixes[suffix].append(entry)
+            else:
+                others.append(entry)
+
+        self._index = (self.irc.casemapping, dict(exact), dict(prefixes),
+                       sorted({len(prefix) for prefix in prefixes}), dict(suffixes),
+                       sorted({len(suffix) for suffix in suffixes}), cidrs, cidr_tree, others)
+        return self._index
+
+    def match(self, target, ip=True, realhost=True):
+        """
+        Returns a list of (mask, value) pairs for all masks matching the given host or UID,
+        in the order they were added. The ip and realhost options work as in irc.match_host().
+        """
+        irc = self.irc
+        index = self._index
+        if index is None or index[0] != irc.casemapping:
+            index = self._build_index()
+        _, exact, prefixes, prefix_lengths, suffixes, suffix_lengths, cidrs, cidr_tree, others = index
+
+        candidates = {}
+        if target in irc.users:
+            hosts = _get_match_hosts(irc, target, ip=ip, realhost=realhost)
+            if ip and cidrs:
+                # Find CIDR masks whose range covers the target's IP.
+                try:
+                    positions = cidr_tree.covering(irc.users[target].ip)
+                except ValueError:
+                    positions = ()
+                for position in positions:
+                    candidates[position] = cidrs[position]
+        else:
+            hosts = (irc.to_lower(target),)
+
+        # Find masks whose literal part matches one of the target's hosts.
+        for host in hosts:
+            for entry in exact.get(host, ()):
+                candidates[entry[0]] = entry
+            hostlen = len(host)
+            for length in prefix_lengths:
+                if length > hostlen:
+                    break
+                for entry in prefixes.get(host[:length], ()):
+                    candidates[entry[0]] = entry
+            for length in suffix_lengths:
+                if length > hostlen:
+                    break
+                for entry in suffixes.get(host[-length:], ()):
+                    candidates[entry[0]] = entry
+
+        results = []
+        for entry in others:
+            candidates[entry[0]] = entry
+        for position in sorted(candidates):
+            _, mask, compiled = candidates[position]
+            if compiled.match(irc, target, ip=ip, realhost=realhost, hosts=hosts):
+                results.append((mask, self.masks[mask]))
+        return results
+
 def merge_iterables(A, B):
     """
     Merges the values in two iterables. A and B must be of the same type, and one of the following:
@@ -8,7 +8,8 @@ from collections import defaultdict, deque
 
 __all__ = ['testing', 'hooks', 'networkobjects', 'plugins', 'services',
            'exttarget_handlers', 'started', 'start_ts', 'shutting_down',
-           'source', 'fallback_hostname', 'daemon']
+           'source', 'fallback_hostname', 'daemon', 'socket_driver', 'hook_stats',
+           'command_stats']
 
 # This indicates whether we're running in tests mode. What it actually does
 # though is control whether IRC connections should be threaded or not.
@@ -21,7 +22,19 @@ networkobjects = {}
 plugins = {}
 services = {}
 
+# Maps hook names to tuples of their hook functions, sorted by priority. This is derived from
+# "hooks" above for faster dispatch, and is rebuilt by utils._rebuild_hook_dispatch() whenever
+# hooks are added or removed.
+_hook_dispatch = {}
+
+# Hook and command timing statistics, recorded when pylink::hook_profiling is enabled. These map
+# (plugin module, function name, hook or command name) tuples to structures.TimingStats instances.
+hook_stats = {}
+command_stats = {}
+
 # Registered extarget handlers. This maps exttarget names (strings) to handling functions.
+# Handlers may also have a "compile" attribute: a function taking (irc, exttarget) and returning
+# a function taking (irc, uid), which utils.CompiledMask uses to parse each exttarget only once.
 exttarget_handlers = {}
 
 # Trigger to be set when all IRC objects are initially created.
@@ -48,3 +61,7 @@ _should_remove_pid = False
 
 # Determines whether we're daemonized.
 daemon = False
+
+# Name of the socket driver used for network connections ("select" or "asyncio"). This is set from
+# the pylink::socket_driver option on startup and cannot be changed afterwards.
+socket_driver = 'select'